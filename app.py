@@ -1,8 +1,7 @@
 import os
 import logging
 import re
-from flask import Flask, request, jsonify, abort
-import smtplib
+from flask import Flask, Response, request, jsonify, abort, stream_with_context
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
@@ -10,9 +9,32 @@ from email import encoders
 from dotenv import load_dotenv, set_key
 from datetime import datetime
 import uuid
-from concurrent.futures import ThreadPoolExecutor
+import hmac
+import queue
+import json
 import csv
 import time
+from smtp_pool import smtp_pool
+from delivery_queue import email_queue, start_workers, job_state
+from async_engine import start_async_engine
+from delivery_scheduler import Envelope, ENVELOPE_TO_HEADER
+from csv_log_writer import CSVLogWriter
+from log_reader import LogReader
+from log_export import EXPORT_FORMATS, export_log, export_filename, parse_date_bound
+from status_store import email_statuses, EmailState, FINAL_STATES
+from email_templates import email_templates, RenderedMessage, TEMPLATE_NAME_REGEX
+from attachments import attachment_store, attach_files, StreamedMessage
+from metrics import Gauge, render_metrics
+from flow_control import IntakeGate, INTAKE_REJECTED
+from supervisor import SERVER_MODE, SERVER_ROLE, run_supervisor, serve_intake, run_delivery
+from status_feed import StatusFeed, FEED_BATCH, STATUS_WAIT_MAX, STATUS_STREAM_HEARTBEAT
+from webhooks import get_webhook_url_error, start_webhook_dispatcher
+from profiler import profiler, PROFILE_MAX_SECONDS
+from tracing import tracer, recent_traces
+from delivery_stats import STATS_TOP, delivery_stats, stats_summary
+from idempotency import get_key_error, request_key, recent_keys
+from lifecycle import DRAIN_MAX_TIMEOUT, DRAIN_TIMEOUT, delivery_lifecycle, drain_delivery, load_warm_state, serve_app
+from sender_pool import sender_pool
 
 # Suppress Flask's request log messages
 log = logging.getLogger('werkzeug')
@@ -29,138 +51,785 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "default_secret_key")
 
-# Dictionary to track the status of email requests
-email_status = {}
-
 # Email validation pattern
 EMAIL_REGEX = re.compile(r"[^@]+@[^@]+\.[^@]+")
 
-# Create a thread pool executor to manage the email sending asynchronously
-executor = ThreadPoolExecutor(max_workers=5)
+# Optional per-email campaign tag (for /email-events) and status webhook URL
+TAG_MAX_LENGTH = 64
+WEBHOOK_URL_REGEX = re.compile(r"https?://[^\s/]+\S*")
+WEBHOOK_URL_MAX_LENGTH = 2048
+
+# Delivery engine: "thread" (worker threads with blocking smtplib) or "async" (one asyncio event loop)
+DELIVERY_ENGINE = os.getenv("DELIVERY_ENGINE", "thread")
+
+# Longest single NDJSON line accepted by /send-emails
+BULK_MAX_LINE_BYTES = 64 * 1024
+
+# Lines from /send-emails committed to the delivery queue together
+BULK_COMMIT_SIZE = 500
+
+# Most request IDs accepted by one batch status lookup, and most emails listed by one status query
+STATUS_BATCH_MAX = int(os.getenv("STATUS_BATCH_MAX", 10000))
+STATUS_LIST_MAX = 10000
+
+# Token the /admin routes (profiling and tracing) require in the X-Admin-Token header; they are off while it is unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Returned by the send endpoints while no sending account is configured
+NO_SENDER_ACCOUNTS = "No sending accounts: add them to data.csv, or set USER_EMAIL and USER_APP_PASSWORD in .env"
 
 # CSV file path
 CSV_FILE_PATH = "email_log.csv"
+CSV_HEADER = ["Request ID", "Sender Email", "Recipient", "Subject", "Date", "Status"]
+
+# Background writer that batches log rows from all delivery workers; flushed on the way out of a restart too
+csv_log = CSVLogWriter(CSV_FILE_PATH, CSV_HEADER)
+delivery_lifecycle.on_exit(csv_log.close)
+
+# Look up statuses that aged out of the status store and the queue in the CSV log
+STATUS_LOG_FALLBACK = os.getenv("STATUS_LOG_FALLBACK", "false").lower() == "true"
+log_reader = LogReader(CSV_FILE_PATH)
+
+# New sends are refused with 429 while too many emails are waiting in the queue
+intake_gate = IntakeGate(email_queue)
+
+# Status changes pushed to long-poll status requests and /email-events streams
+status_feed = StatusFeed(email_queue)
+
+# Gauges for /metrics, read when the endpoint is scraped
+Gauge("email_queue_depth", "Emails waiting for or undergoing delivery.", function=email_queue.depth)
+Gauge("email_status_store_size", "Requests held in the in-memory status store.", function=lambda: len(email_statuses))
 
 def initialize_csv_log():
     """Create a CSV log file if it doesn't exist and add headers."""
     if not os.path.exists(CSV_FILE_PATH):
         with open(CSV_FILE_PATH, mode="w", newline='') as file:
             writer = csv.writer(file)
-            writer.writerow(["Request ID", "Sender Email", "Recipient", "Subject", "Date", "Status"])
+            writer.writerow(CSV_HEADER)
 
 def log_email_to_csv(request_id, sender_email, recipient, subject, status, error_details=None):
-    """Log email request details to a CSV file with detailed error info."""
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(CSV_FILE_PATH, mode="a", newline='') as file:
-        writer = csv.writer(file)
+    """Queue email request details for the CSV log writer, with detailed error info."""
+    with tracer.span("log", request_id=request_id):
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         if error_details:
-            writer.writerow([request_id, sender_email, recipient, subject, now, status, error_details])
+            csv_log.write([request_id, sender_email, recipient, subject, now, status, error_details])
         else:
-            writer.writerow([request_id, sender_email, recipient, subject, now, status])
+            csv_log.write([request_id, sender_email, recipient, subject, now, status])
 
-def send_email(subject, recipient, body, is_html, request_id, sender_email, sender_password, sender_name, cc=None, bcc=None):
-    """Send an email to multiple recipients and log the action in a CSV file."""
-    try:
-        message = MIMEMultipart()
-        message["From"] = f"{sender_name} <{sender_email}>"
-        message["To"] = recipient
-        if cc:
-            message["Cc"] = cc
-        if bcc:
-            message["Bcc"] = bcc
-        message["Subject"] = subject
-        message.attach(MIMEText(body, "html" if is_html else "plain"))
-
-        # Send the email
-        smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
-        smtp_port = int(os.getenv("SMTP_PORT", 587))
-        
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.send_message(message)
-
-        # Log success to the CSV file
-        log_email_to_csv(request_id, sender_email, recipient, subject, "sent")
-        email_status[request_id] = "sent"  # Update the status
-    except Exception as e:
-        # Log failure to the CSV file
-        log_email_to_csv(request_id, sender_email, recipient, subject, f"failed ({e})")
-        email_status[request_id] = f"failed ({e})"  # Update the status
-
-def send_email_with_retry(subject, recipients, body, is_html, request_id, sender_email, sender_password, sender_name, cc=None, bcc=None, retries=3, delay=5):
-    """Send an email with retry mechanism using exponential backoff."""
-    attempt = 0
-    while attempt < retries:
-        try:
-            send_email(subject, recipients, body, is_html, request_id, sender_email, sender_password, sender_name, cc, bcc)
-            return
-        except Exception as e:
-            attempt += 1
-            if attempt < retries:
-                print(f"Attempt {attempt} failed. Retrying in {delay} seconds...")
-                time.sleep(delay)
-                delay *= 2  # Exponential backoff
-            else:
-                print(f"Failed to send email after {retries} attempts.")
-                email_status[request_id] = f"failed ({e})"
+def build_email_message(subject, recipient, body, is_html, sender_email, sender_name, cc=None, bcc=None):
+    """Build the MIME message for an email."""
+    message = MIMEMultipart()
+    message["From"] = f"{sender_name} <{sender_email}>"
+    message["To"] = recipient
+    if cc:
+        message["Cc"] = cc
+    if bcc:
+        message["Bcc"] = bcc
+    message["Subject"] = subject
+    message.attach(MIMEText(body, "html" if is_html else "plain"))
+    return message
+
+def deliver_message(sender_email, sender_password, message, to_addrs=None):
+    """Send a MIME message, rendered template or message with streamed attachments over the connection pool.
+
+    Sends to `to_addrs` instead of the message's recipients if given; returns the refused recipients.
+    """
+    smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+    smtp_port = int(os.getenv("SMTP_PORT", 587))
+    if isinstance(message, StreamedMessage):
+        return smtp_pool.send_stream(smtp_server, smtp_port, sender_email, sender_password, message.from_addr, to_addrs or message.to_addrs, message.iter_chunks)
+    elif isinstance(message, RenderedMessage):
+        return smtp_pool.sendmail(smtp_server, smtp_port, sender_email, sender_password, message.from_addr, to_addrs or message.to_addrs, message.data)
+    else:
+        return smtp_pool.send_message(smtp_server, smtp_port, sender_email, sender_password, message, to_addrs=to_addrs)
+
+def send_email(subject, recipient, body, is_html, request_id, sender_email, sender_password, sender_name, cc=None, bcc=None, attachments=None):
+    """Send an email to multiple recipients and log the action in a CSV file.
+
+    Failures are raised so the caller can decide whether to retry; they are logged by the retry scheduler.
+    """
+    with tracer.span("build"):
+        message = build_email_message(subject, recipient, body, is_html, sender_email, sender_name, cc, bcc)
+        if attachments:
+            message = attach_files(message, attachments)
+
+    # Send the email
+    deliver_message(sender_email, sender_password, message)
+
+    # Log success to the CSV file
+    log_email_to_csv(request_id, sender_email, recipient, subject, "sent")
+    return "sent"
+
+def render_template_email(template_name, variables, recipient, sender_email, sender_name, cc=None, bcc=None):
+    """Render a registered template for one recipient from its cached, pre-encoded MIME parts."""
+    template = email_templates.get(template_name)
+    if template is None:
+        raise ValueError(f"Unknown template {template_name}")
+    return template.render(variables, recipient, sender_email, sender_name, cc, bcc)
+
+def send_template_email(template_name, variables, recipient, request_id, sender_email, sender_password, sender_name, cc=None, bcc=None, attachments=None):
+    """Send a registered template to one recipient and log the action in a CSV file."""
+    with tracer.span("build"):
+        message = render_template_email(template_name, variables, recipient, sender_email, sender_name, cc, bcc)
+        if attachments:
+            message = attach_files(message, attachments)
+
+    deliver_message(sender_email, sender_password, message)
+
+    log_email_to_csv(request_id, sender_email, recipient, message.subject, "sent")
+    return "sent"
+
+def get_validation_error(data):
+    """Return the reason the email data is invalid, or None if it is valid."""
+    if not isinstance(data, dict):
+        return "Request body must be a JSON object"
+
+    error = get_attachments_error(data.get("attachments")) or get_notification_error(data)
+    if error:
+        return error
+
+    if "template" in data:
+        return get_template_send_error(data)
 
-def validate_email_data(data):
-    """Validate the email data."""
     subject = data.get("subject")
     recipient = data.get("recipient")
     body = data.get("body")
     
     if not all([subject, recipient, body]):
-        abort(400, description="Missing required fields")
+        return "Missing required fields"
     
-    if not EMAIL_REGEX.match(recipient):
-        abort(400, description="Invalid email format")
+    if not isinstance(recipient, str) or not EMAIL_REGEX.match(recipient):
+        return "Invalid email format"
+
+    if not isinstance(subject, str) or not isinstance(body, str):
+        return "Subject and body must be strings"
     
     if len(subject) > 255 or len(body) > 10000:
-        abort(400, description="Subject or body exceeds character limits")
+        return "Subject or body exceeds character limits"
+    return None
+
+def get_attachments_error(attachments):
+    """Return the reason an attachment list is invalid, or None if it is valid (or absent)."""
+    if attachments is None:
+        return None
+    if not isinstance(attachments, list):
+        return "Attachments must be a list"
+    for attachment in attachments:
+        if not isinstance(attachment, dict) or not isinstance(attachment.get("filename"), str):
+            return "Each attachment needs an id and a filename"
+        if not attachment_store.exists(attachment.get("id")):
+            return "Unknown attachment"
+    return None
+
+def get_notification_error(data):
+    """Return the reason the tag or webhook URL is invalid, or None if they are valid (or absent)."""
+    tag = data.get("tag")
+    if tag is not None and (not isinstance(tag, str) or not tag or len(tag) > TAG_MAX_LENGTH):
+        return f"Tag must be a string of 1 to {TAG_MAX_LENGTH} characters"
+    webhook_url = data.get("webhook_url")
+    if webhook_url is not None and (not isinstance(webhook_url, str) or len(webhook_url) > WEBHOOK_URL_MAX_LENGTH
+                                    or not WEBHOOK_URL_REGEX.fullmatch(webhook_url)):
+        return "Invalid webhook URL"
+    if webhook_url is not None:
+        return get_webhook_url_error(webhook_url)
+    return None
+
+def get_template_send_error(data):
+    """Return the reason a template send request is invalid, or None if it is valid."""
+    template_name = data.get("template")
+    template = email_templates.get(template_name) if isinstance(template_name, str) else None
+    if template is None:
+        return "Unknown template"
+
+    recipient = data.get("recipient")
+    if not isinstance(recipient, str) or not EMAIL_REGEX.match(recipient):
+        return "Invalid email format"
+
+    variables = data.get("variables", {})
+    if not isinstance(variables, dict):
+        return "Template variables must be a JSON object"
+    missing = template.missing_variables(variables)
+    if missing:
+        return f"Missing template variables: {', '.join(missing)}"
+    return None
+
+def get_template_error(data):
+    """Return the reason a template definition is invalid, or None if it is valid."""
+    if not isinstance(data, dict):
+        return "Request body must be a JSON object"
+
+    name = data.get("name")
+    subject = data.get("subject")
+    body = data.get("body")
+    if not name or not subject or not body:
+        return "Missing required fields"
+
+    if not isinstance(name, str) or not TEMPLATE_NAME_REGEX.fullmatch(name):
+        return "Invalid template name"
+
+    if not isinstance(subject, str) or not isinstance(body, str):
+        return "Subject and body must be strings"
+
+    if len(subject) > 255 or len(body) > 10000:
+        return "Subject or body exceeds character limits"
+    return None
+
+def validate_email_data(data):
+    """Validate the email data."""
+    error = get_validation_error(data)
+    if error:
+        abort(400, description=error)
+
+def queue_full_response(retry_after):
+    """429 response asking the client to come back in `retry_after` seconds."""
+    response = jsonify({"error": "Too many emails waiting to be sent, retry later", "retry_after": retry_after})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(retry_after)
+    return response
 
 @app.route("/send-email", methods=["POST"])
 def handle_send_email():
+    accepted = time.time()
+    retry_after = intake_gate.admit()
+    if retry_after is not None:
+        INTAKE_REJECTED.inc()
+        return queue_full_response(retry_after)
+
     data = request.json
     validate_email_data(data)
-    
-    subject = data["subject"]
-    recipient = data["recipient"]
-    body = data["body"]
-    is_html = data.get("is_html", False)
-    cc = data.get("cc", None)
-    bcc = data.get("bcc", None)
+    client_key = request.headers.get("Idempotency-Key")
+    key_error = get_key_error(client_key)
+    if key_error:
+        abort(400, description=key_error)
+
+    # The sending account is picked from the pool when the email is delivered
+    if not sender_pool.has_accounts():
+        return jsonify({"error": NO_SENDER_ACCOUNTS}), 400
+
+    payload = build_job_payload(data)
+    key = request_key(client_key, payload)
+
+    # A retried request gets the first one's ID back instead of being sent again
+    holder = recent_keys.get(key) if key else None
+    if holder is None:
+        # Generate a unique request ID for this email request
+        request_id = str(uuid.uuid4())
+        trace = tracer.start(request_id, payload, accepted)
+
+        # Queue the email durably; the delivery workers pick it up from there
+        with tracer.span("enqueue", [trace]):
+            holder = email_queue.enqueue(request_id, payload, key)
+        if holder is None:
+            if key:
+                recent_keys.add(key, request_id)
+            return jsonify({"message": "Email request processed", "request_id": request_id}), 200
+
+    result = replay_result(key, holder)
+    if "error" in result:
+        return jsonify(result), 422
+    response = jsonify({"message": "Email request processed", "request_id": result["request_id"]})
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
 
-    # Get the email, password, and sender name from the environment variables
-    sender_email = os.getenv("USER_EMAIL")
-    sender_password = os.getenv("USER_APP_PASSWORD")
-    sender_name = os.getenv("EMAIL_FROM_NAME")
+def replay_result(key, holder):
+    """The result for a send whose idempotency key is held by (request ID, fingerprint): the first
+    request's ID, or an error if the key was used for a different email."""
+    request_id, email_fingerprint = holder
+    if email_fingerprint != key.fingerprint:
+        return {"error": "Idempotency key was already used for a different email"}
+    return {"request_id": request_id, "duplicate": True}
 
-    if not sender_email or not sender_password:
-        return jsonify({"error": "Missing user credentials in .env"}), 400
+def build_job_payload(data):
+    """Return the queued form of a validated email request; the sender is left to the delivery scheduler."""
+    if "template" in data:
+        # The subject is rendered now so that logs and status lookups don't need the template
+        variables = data.get("variables", {})
+        return {
+            "template": data["template"],
+            "variables": variables,
+            "subject": email_templates.get(data["template"]).render_subject(variables),
+            "recipient": data["recipient"],
+            "cc": data.get("cc"),
+            "bcc": data.get("bcc"),
+            "attachments": data.get("attachments"),
+            "tag": data.get("tag"),
+            "webhook_url": data.get("webhook_url"),
+        }
+    return {
+        "subject": data["subject"],
+        "recipient": data["recipient"],
+        "body": data["body"],
+        "is_html": data.get("is_html", False),
+        "cc": data.get("cc"),
+        "bcc": data.get("bcc"),
+        "attachments": data.get("attachments"),
+        "tag": data.get("tag"),
+        "webhook_url": data.get("webhook_url"),
+    }
 
-    # Generate a unique request ID for this email request
-    request_id = str(uuid.uuid4())
+def process_queued_email(job):
+    """Deliver a job leased from the queue and return its final status; failures are raised for the retry scheduler."""
+    if isinstance(job, Envelope):
+        return send_envelope(job)
+    payload = job.payload
+    sender = job.sender
+    if "template" in payload:
+        return send_template_email(payload["template"], payload["variables"], payload["recipient"], job.request_id,
+                                   sender.email, sender.password, sender.name, payload["cc"], payload["bcc"],
+                                   payload.get("attachments"))
+    return send_email(payload["subject"], payload["recipient"], payload["body"], payload["is_html"], job.request_id,
+                      sender.email, sender.password, sender.name, payload["cc"], payload["bcc"],
+                      payload.get("attachments"))
 
-    # Send the email asynchronously using the thread pool
-    executor.submit(send_email_with_retry, subject, recipient, body, is_html, request_id, sender_email, sender_password, sender_name, cc, bcc)
+def start_delivery(recover=True):
+    """Start the configured delivery engine; with recover=True, first requeue what the previous run left unacknowledged."""
+    # Carry on with the quotas and circuit breakers of the process this one replaces
+    load_warm_state()
+    if DELIVERY_ENGINE == "async":
+        start_async_engine(email_queue, prepare_queued_email, record_queued_email_result, recover=recover)
+    else:
+        start_workers(email_queue, process_queued_email, record_queued_email_result, recover=recover)
+    start_webhook_dispatcher(email_queue)
 
-    return jsonify({"message": "Email request processed", "request_id": request_id}), 200
+def iter_ndjson_lines(stream, chunk_size=64 * 1024):
+    """Yield (line number, parsed JSON or None, error or None) for each non-blank line of the stream."""
+    line_number = 0
+    partial = b""
+    oversized = False
+    while True:
+        chunk = stream.read(chunk_size)
+        lines = (partial + chunk).split(b"\n")
+        # The last piece has no newline yet (or is the final line once the stream is exhausted)
+        partial = lines.pop() if chunk else b""
+        for line in lines:
+            line_number += 1
+            if oversized or len(line) > BULK_MAX_LINE_BYTES:
+                oversized = False
+                yield line_number, None, "Line exceeds size limit"
+            elif line.strip():
+                try:
+                    yield line_number, json.loads(line), None
+                except ValueError:
+                    yield line_number, None, "Invalid JSON"
+        if not chunk:
+            return
+        if len(partial) > BULK_MAX_LINE_BYTES:
+            # Don't buffer the rest of an oversized line
+            oversized = True
+            partial = b""
+
+def prepare_queued_email(job):
+    """Return (username, password, message) for a leased job or Envelope, for the async delivery engine."""
+    payload = job.payload
+    sender = job.sender
+    # One message goes to every recipient of an envelope, so it can't name any of them
+    recipient = ENVELOPE_TO_HEADER if isinstance(job, Envelope) else payload["recipient"]
+    if "template" in payload:
+        message = render_template_email(payload["template"], payload["variables"], recipient,
+                                        sender.email, sender.name, payload["cc"], payload["bcc"])
+    else:
+        message = build_email_message(payload["subject"], recipient, payload["body"], payload["is_html"],
+                                      sender.email, sender.name, payload["cc"], payload["bcc"])
+    if payload.get("attachments"):
+        message = attach_files(message, payload["attachments"])
+    return sender.email, sender.password, message
+
+def send_envelope(envelope):
+    """Send identical queued emails in one SMTP transaction and log the accepted ones; returns the refused recipients."""
+    with tracer.span("build"):
+        sender_email, sender_password, message = prepare_queued_email(envelope)
+    refused = deliver_message(sender_email, sender_password, message, envelope.recipients)
+    for job, error in envelope.outcomes(refused):
+        if error is None:
+            log_email_to_csv(job.request_id, job.account, job.payload["recipient"], job.payload["subject"], "sent")
+    return refused
+
+def record_queued_email_result(job, status):
+    """Log the outcome of a delivery attempt: every outcome for the async engine, deferrals and failures for the workers."""
+    payload = job.payload
+    log_email_to_csv(job.request_id, job.account, payload["recipient"], payload["subject"], status)
+
+@app.route("/send-emails", methods=["POST"])
+def handle_send_emails():
+    """Accept a newline-delimited JSON stream of emails and answer with one NDJSON result per line."""
+    if not sender_pool.has_accounts():
+        return jsonify({"error": NO_SENDER_ACCOUNTS}), 400
+
+    retry_after = intake_gate.admit(0)
+    if retry_after is not None:
+        INTAKE_REJECTED.inc()
+        return queue_full_response(retry_after)
+
+    stream = request.stream
+
+    def commit(jobs, results, traces, keys):
+        """Queue a chunk of jobs, or turn them into errors if the queue filled up during the stream."""
+        retry_after = intake_gate.admit(len(jobs))
+        if retry_after is None:
+            with tracer.span("enqueue", traces):
+                held = email_queue.enqueue_many(jobs, keys)
+            # A line whose key another send took meanwhile gets that send's ID instead
+            for result in results:
+                request_id = result.get("request_id")
+                if request_id in held:
+                    del result["request_id"]
+                    result.update(replay_result(keys[request_id], held[request_id]))
+            for request_id, key in keys.items():
+                if request_id not in held:
+                    recent_keys.add(key, request_id)
+        elif jobs:
+            INTAKE_REJECTED.inc(amount=len(jobs))
+            for result in results:
+                if "request_id" in result:
+                    del result["request_id"]
+                    result["error"] = "Too many emails waiting to be sent, retry later"
+                    result["retry_after"] = retry_after
+        return "".join(json.dumps(result) + "\n" for result in results)
+
+    def generate():
+        # Valid lines are committed in chunks; results are released once their chunk is durable
+        jobs, results, traces, keys = [], [], [], {}
+        for line_number, data, error in iter_ndjson_lines(stream):
+            accepted = time.time()
+            try:
+                error = error or get_validation_error(data) or get_key_error(data.get("idempotency_key"))
+                if not error:
+                    payload = build_job_payload(data)
+                    key = request_key(data.get("idempotency_key"), payload)
+            except Exception as e:
+                # One malformed line must not end the stream: earlier lines may already be queued
+                error = f"Invalid email: {e}"
+            if error:
+                results.append({"line": line_number, "error": error})
+            else:
+                holder = recent_keys.get(key) if key else None
+                if holder is not None:
+                    results.append({"line": line_number, **replay_result(key, holder)})
+                else:
+                    request_id = str(uuid.uuid4())
+                    traces.append(tracer.start(request_id, payload, accepted))
+                    jobs.append((request_id, payload))
+                    if key:
+                        keys[request_id] = key
+                    results.append({"line": line_number, "request_id": request_id})
+
+            if len(results) >= BULK_COMMIT_SIZE:
+                yield commit(jobs, results, traces, keys)
+                jobs, results, traces, keys = [], [], [], {}
+
+        yield commit(jobs, results, traces, keys)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@app.route("/templates", methods=["POST"])
+def handle_register_template():
+    """Register (or replace) a template; merge fields are written as {{ name }}."""
+    data = request.json
+    error = get_template_error(data)
+    if error:
+        abort(400, description=error)
+
+    template = email_templates.register(data["name"], data["subject"], data["body"], bool(data.get("is_html", False)))
+    return jsonify({"message": "Template registered", "name": template.name, "variables": template.variables}), 200
+
+@app.route("/templates", methods=["GET"])
+def list_templates():
+    return jsonify([template.to_dict() for template in email_templates.list()])
+
+@app.route("/templates/<name>", methods=["GET"])
+def get_template(name):
+    template = email_templates.get(name)
+    if template is None:
+        return jsonify({"error": "Template not found"}), 404
+    return jsonify(template.to_dict())
+
+@app.route("/templates/<name>", methods=["DELETE"])
+def delete_template(name):
+    if not email_templates.delete(name):
+        return jsonify({"error": "Template not found"}), 404
+    return jsonify({"message": "Template deleted", "name": name})
+
+@app.route("/attachments", methods=["POST"])
+def handle_upload_attachment():
+    """Store the raw request body as an attachment, streaming it to disk; identical files get the same ID."""
+    attachment_id, size = attachment_store.add_stream(request.stream)
+    if attachment_id is None:
+        return jsonify({"error": "Attachment exceeds size limit"}), 413
+    return jsonify({"message": "Attachment stored", "attachment_id": attachment_id, "size": size}), 200
+
+@app.route("/attachments/<attachment_id>", methods=["DELETE"])
+def delete_attachment(attachment_id):
+    if not attachment_store.delete(attachment_id):
+        return jsonify({"error": "Attachment not found"}), 404
+    return jsonify({"message": "Attachment deleted", "attachment_id": attachment_id})
+
+@app.route("/email-logs/export", methods=["GET"])
+def export_email_log():
+    """Stream the delivery log as ?format=csv or ndjson, gzipped with ?gzip=true.
+
+    Filters: ?start= and ?end= (YYYY-MM-DD, optionally with HH:MM:SS), ?status= (comma-separated, e.g.
+    sent,failed), ?domain= (of the recipient) and ?sender=. Every recipient and subject is in it, so it is
+    an admin route.
+    """
+    require_admin()
+    output_format = request.args.get("format", "csv").lower()
+    if output_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"Format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    try:
+        start, end = (parse_date_bound(request.args[name]) if request.args.get(name) else None for name in ("start", "end"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    statuses = [status for status in request.args.get("status", "").split(",") if status]
+    compress = request.args.get("gzip", "false").lower() == "true"
+
+    # Include the rows this process has logged but not yet written
+    csv_log.flush(timeout=5)
+    chunks = export_log(CSV_FILE_PATH, output_format, compress, start, end, statuses,
+                        request.args.get("domain") or None, request.args.get("sender") or None)
+    mimetype = "application/gzip" if compress else "text/csv" if output_format == "csv" else "application/x-ndjson"
+    response = Response(chunks, mimetype=mimetype)
+    response.headers["Content-Disposition"] = f'attachment; filename="{export_filename(output_format, compress)}"'
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Delivery latency, outcome and queue metrics in the Prometheus text format."""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+def require_admin():
+    """Abort unless the request carries the admin token; without ADMIN_TOKEN the admin routes don't exist."""
+    if not ADMIN_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", "").encode(), ADMIN_TOKEN.encode()):
+        abort(403)
+
+@app.route("/admin/profile", methods=["POST"])
+def run_profile():
+    """Sample the stacks of every thread for `seconds` and answer with them collapsed, for a flame graph."""
+    require_admin()
+    seconds = request.args.get("seconds", 10, type=float)
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return jsonify({"error": f"seconds must be more than 0 and at most {PROFILE_MAX_SECONDS:g}"}), 400
+    stacks = profiler.profile(seconds)
+    if stacks is None:
+        return jsonify({"error": "A profile is already running"}), 409
+    return Response(stacks, mimetype="text/plain")
+
+@app.route("/admin/traces", methods=["GET"])
+def get_traces():
+    """The newest finished request traces, with the tracer's sample rate."""
+    require_admin()
+    limit = request.args.get("limit", 100, type=int)
+    return jsonify({**tracer.get_stats(), "traces": recent_traces(limit)})
+
+@app.route("/admin/traces", methods=["POST"])
+def set_trace_sample_rate():
+    """Set the share of accepted emails to trace, e.g. {"sample_rate": 0.01}; 0 turns tracing off."""
+    require_admin()
+    data = request.get_json(silent=True)
+    rate = data.get("sample_rate") if isinstance(data, dict) else None
+    if isinstance(rate, bool) or not isinstance(rate, (int, float)) or not 0 <= rate <= 1:
+        return jsonify({"error": "sample_rate must be a number from 0 to 1"}), 400
+    tracer.set_rate(rate)
+    return jsonify(tracer.get_stats())
+
+def delivery_state():
+    paused_since = email_queue.delivery_paused()
+    return {"paused": paused_since is not None, "paused_since": paused_since,
+            "sending": email_queue.count_leased(), "pending": email_queue.depth()}
+
+@app.route("/admin/delivery", methods=["GET"])
+def get_delivery_state():
+    """Whether delivery is paused, how many emails are being sent and how many are pending in all."""
+    require_admin()
+    return jsonify(delivery_state())
+
+@app.route("/admin/delivery", methods=["POST"])
+def control_delivery():
+    """Pause, resume or drain delivery in every process: {"action": "pause" | "resume" | "drain"}.
+
+    New emails are still accepted and queued while delivery is paused. A drain pauses, then waits up to
+    "timeout" seconds (default DRAIN_TIMEOUT) for the emails being sent, e.g. before maintenance.
+    """
+    require_admin()
+    data = request.get_json(silent=True)
+    action = data.get("action") if isinstance(data, dict) else None
+    if action == "pause":
+        email_queue.pause_delivery()
+    elif action == "resume":
+        email_queue.resume_delivery()
+    elif action == "drain":
+        timeout = data.get("timeout", DRAIN_TIMEOUT)
+        if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or not 0 <= timeout <= DRAIN_MAX_TIMEOUT:
+            return jsonify({"error": f"timeout must be a number from 0 to {DRAIN_MAX_TIMEOUT:g}"}), 400
+        drain_delivery(email_queue, timeout)
+    else:
+        return jsonify({"error": 'action must be "pause", "resume" or "drain"'}), 400
+    return jsonify(delivery_state())
+
+@app.route("/admin/stats", methods=["GET"])
+def get_delivery_stats():
+    """Sent, deferred and failed emails over the last minute, 5 minutes and hour, in all and for the busiest
+    senders, recipient domains and error classes, with latency percentiles; ?window=1m for one window."""
+    require_admin()
+    top = request.args.get("top", STATS_TOP, type=int)
+    window = request.args.get("window")
+    if window is not None and window not in delivery_stats.windows:
+        return jsonify({"error": f"window must be one of {', '.join(delivery_stats.windows)}"}), 400
+    return jsonify({"delivery": delivery_state(), "windows": stats_summary(top, [window] if window else None)})
+
+def find_status_record(request_id):
+    # Evicted from memory, from before a restart or delivered by another process: ask the queue
+    return email_statuses.get(request_id) or email_queue.get_record(request_id)
 
 @app.route("/email-status/<request_id>", methods=["GET"])
 def get_email_status(request_id):
-    """Check the status of an email request."""
-    status = email_status.get(request_id, "Request ID not found")
-    return jsonify({"request_id": request_id, "status": status})
+    """Check the status of an email request.
 
-if __name__ == "__main__":
-    # Initialize CSV log
-    initialize_csv_log()
+    With ?wait=<seconds>, answer as soon as the state differs from ?state= (by default, from the current
+    state), or when the wait is over; requests that are already sent or failed are answered at once.
+    """
+    wait = request.args.get("wait", type=float)
+    if wait and wait > 0:
+        known_state = request.args.get("state")
+        # Watch before looking up, so that a change right after the lookup still ends the wait
+        deadline = time.monotonic() + min(wait, STATUS_WAIT_MAX)
+        with status_feed.watch(request_id) as changed:
+            record = find_status_record(request_id)
+            if record is not None:
+                known_state = known_state or record.to_dict()["state"]
+            # Events the feed had not yet handed out when the wait began can wake it early, so check again
+            while (record is not None and record.state not in FINAL_STATES and record.to_dict()["state"] == known_state
+                   and changed.wait(max(0, deadline - time.monotonic()))):
+                changed.clear()
+                # The queue, not the status store: the change may not have reached the store yet
+                record = email_queue.get_record(request_id)
+    else:
+        record = find_status_record(request_id)
+    if record is not None:
+        return jsonify({"request_id": request_id, **record.to_dict()})
+
+    status = None
+    if STATUS_LOG_FALLBACK:
+        row = log_reader.find_latest(request_id)
+        status = row[5] if row and len(row) > 5 else None
+    return jsonify({"request_id": request_id, "status": status or "Request ID not found"})
+
+@app.route("/email-status", methods=["POST"])
+def get_email_statuses():
+    """Check the status of up to STATUS_BATCH_MAX email requests at once: {"request_ids": [...]}."""
+    data = request.json
+    request_ids = data.get("request_ids") if isinstance(data, dict) else None
+    if not isinstance(request_ids, list) or not all(isinstance(request_id, str) for request_id in request_ids):
+        return jsonify({"error": "request_ids must be a list of strings"}), 400
+    if len(request_ids) > STATUS_BATCH_MAX:
+        return jsonify({"error": f"At most {STATUS_BATCH_MAX} request IDs per lookup"}), 400
+
+    records = {request_id: email_statuses.get(request_id) for request_id in request_ids}
+    # Everything the status store doesn't have is fetched from the queue in a few queries
+    records.update(email_queue.get_records([request_id for request_id, record in records.items() if record is None]))
+    return jsonify({"statuses": [
+        {"request_id": request_id, **records[request_id].to_dict()} if records[request_id] is not None
+        else {"request_id": request_id, "status": "Request ID not found"}
+        for request_id in request_ids
+    ]})
+
+@app.route("/email-status", methods=["GET"])
+def list_email_statuses():
+    """Count and list requests by ?state= (comma-separated), ?tag= and ?since= (Unix time of the last update).
+
+    It lists every client's requests, so it is an admin route; a client looks up its own by request ID.
+    """
+    require_admin()
+    states = [state for state in request.args.get("state", "").split(",") if state]
+    if any(state.upper() not in EmailState.__members__ for state in states):
+        return jsonify({"error": "Unknown state"}), 400
+    states = [job_state(state.lower()) for state in states]
+    tag = request.args.get("tag") or None
+    since = request.args.get("since", type=float)
+    limit = min(request.args.get("limit", 100, type=int), STATUS_LIST_MAX)
 
+    count = email_queue.count_jobs(states, tag, since)
+    emails = [{"request_id": request_id, "status": status}
+              for request_id, status in email_queue.list_jobs(states, tag, since, limit=max(0, limit))]
+    return jsonify({"count": count, "emails": emails})
+
+def format_status_event(event):
+    return f"id: {event['id']}\nevent: status\ndata: {json.dumps(event)}\n\n"
+
+@app.route("/email-events", methods=["GET"])
+def stream_email_events():
+    """Server-Sent Events stream of status changes, optionally only of emails sent with ?tag=.
+
+    Reconnecting clients (Last-Event-ID, or ?since=<event id>) first get the changes they missed. It shows
+    the status of every email, so it is an admin route.
+    """
+    require_admin()
+    tag = request.args.get("tag") or None
+    since = request.headers.get("Last-Event-ID") or request.args.get("since")
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        return jsonify({"error": "Invalid event ID"}), 400
+
+    # Subscribe before replaying, so nothing falls between the replay and the live events
+    subscription = status_feed.subscribe(tag)
+
+    def generate():
+        try:
+            last_id = since
+            if last_id is not None:
+                while True:
+                    missed = email_queue.status_events(last_id, tag=tag, limit=FEED_BATCH)
+                    for event, _ in missed:
+                        yield format_status_event(event)
+                    if missed:
+                        last_id = missed[-1][0]["id"]
+                    if len(missed) < FEED_BATCH:
+                        break
+            yield ": connected\n\n"
+            next_heartbeat = time.monotonic() + STATUS_STREAM_HEARTBEAT
+            while not subscription.overflowed:
+                timeout = next_heartbeat - time.monotonic()
+                try:
+                    event = subscription.events.get(timeout=max(0, timeout))
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    next_heartbeat = time.monotonic() + STATUS_STREAM_HEARTBEAT
+                    continue
+                if last_id is None or event["id"] > last_id:
+                    last_id = event["id"]
+                    yield format_status_event(event)
+        finally:
+            status_feed.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+if __name__ == "__main__":
     # Get the port from the environment variable, defaulting to 10000 if not set
     port = int(os.getenv("PORT", 10000))
 
-    # Run the Flask server on the specified port, bound to 0.0.0.0 to allow external access
-    app.run(host="0.0.0.0", port=port, debug=False, use_reloader=False)
+    if SERVER_ROLE == "intake":
+        # Started by the supervisor: accept requests on the shared socket, leave delivery to the delivery processes
+        serve_intake(app, "0.0.0.0", port)
+    elif SERVER_ROLE == "delivery":
+        run_delivery(lambda: start_delivery(recover=False))
+    else:
+        # Initialize CSV log
+        initialize_csv_log()
+
+        if SERVER_MODE == "multiprocess":
+            run_supervisor(__file__, "0.0.0.0", port, email_queue)
+        else:
+            # Requeue anything left unacknowledged by the previous run and start delivering
+            start_delivery()
+
+            # SIGTERM drains and exits, SIGHUP drains and restarts
+            delivery_lifecycle.handle_signals()
+
+            # Run the Flask server on the specified port, bound to 0.0.0.0 to allow external access
+            serve_app(app, "0.0.0.0", port)
 
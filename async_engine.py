@@ -0,0 +1,377 @@
+import asyncio
+import base64
+import os
+import smtplib
+import socket
+import ssl
+import threading
+import time
+
+from attachments import StreamedMessage
+from delivery_scheduler import DeliveryScheduler, Envelope, job_outcomes
+from delivery_stats import delivery_stats
+from email_templates import serialize_message
+from flow_control import PoolSizer
+from lifecycle import delivery_lifecycle
+from metrics import DELIVERIES_IN_PROGRESS, EMAIL_DELIVERIES, SMTP_PHASE_SECONDS
+from retry_scheduler import RetryScheduler
+from circuit_breaker import circuit_breakers
+from tracing import tracer
+from smtp_pool import (LEADING_DOT, SMTP_COMMAND_TIMEOUT, SMTP_CONNECT_TIMEOUT, SMTP_POOL_MAX_IDLE_SECONDS,
+                       SMTP_POOL_MAX_MESSAGES, SMTP_STARTTLS)
+
+# Async engine settings; concurrency adapts between the minimum and maximum as the backlog changes
+ASYNC_MIN_CONCURRENCY = int(os.getenv("ASYNC_MIN_CONCURRENCY", 20))
+ASYNC_MAX_CONCURRENCY = int(os.getenv("ASYNC_MAX_CONCURRENCY", 200))
+ASYNC_SMTP_TIMEOUT = float(os.getenv("ASYNC_SMTP_TIMEOUT", SMTP_COMMAND_TIMEOUT))
+
+_local_hostname = None
+_tls_context = None
+
+
+def local_hostname():
+    """The name sent in EHLO, looked up once like smtplib does per connection."""
+    global _local_hostname
+    if _local_hostname is None:
+        _local_hostname = socket.getfqdn()
+    return _local_hostname
+
+
+def tls_context():
+    """Shared client TLS context; building one per connection costs more than the handshake itself."""
+    global _tls_context
+    if _tls_context is None:
+        # Same (unverified) settings smtplib.starttls() uses when no context is given
+        _tls_context = ssl.create_default_context()
+        _tls_context.check_hostname = False
+        _tls_context.verify_mode = ssl.CERT_NONE
+    return _tls_context
+
+
+def flatten_message(message):
+    """Return (from_addr, to_addrs, data) for a message; data is bytes, or an iterable of chunks for a streamed message."""
+    if isinstance(message, StreamedMessage):
+        return message.from_addr, message.to_addrs, message.iter_chunks()
+    return serialize_message(message)
+
+
+class AsyncSMTPSession:
+    """One SMTP conversation over asyncio streams: EHLO, STARTTLS, AUTH, then any number of transactions."""
+
+    def __init__(self, reader, writer, timeout):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.features = {}
+        self.messages_sent = 0
+        self.last_used = time.monotonic()
+
+    async def read_reply(self):
+        """Read a (possibly multi-line) reply and return (code, text)."""
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            lines.append(line[4:].strip().decode("utf-8", "replace"))
+            if line[3:4] != b"-":
+                return int(line[:3]), "\n".join(lines)
+
+    async def flush(self):
+        """Wait for the written data to go out; a server that stops reading times out like one that stops answering."""
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    async def command(self, line):
+        self.writer.write(line.encode("ascii") + b"\r\n")
+        await self.flush()
+        return await self.read_reply()
+
+    async def ehlo(self):
+        code, text = await self.command(f"EHLO {local_hostname()}")
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, text)
+        self.features = {}
+        for feature in text.split("\n")[1:]:
+            name, _, params = feature.partition(" ")
+            self.features[name.lower()] = params
+
+    async def starttls(self, host):
+        if "starttls" not in self.features:
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        code, text = await self.command("STARTTLS")
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, text)
+        await asyncio.wait_for(self.writer.start_tls(tls_context(), server_hostname=host), self.timeout)
+        await self.ehlo()
+
+    async def login(self, username, password):
+        mechanisms = self.features.get("auth", "").upper().split()
+        if "PLAIN" in mechanisms or not mechanisms:
+            token = base64.b64encode(f"\0{username}\0{password}".encode()).decode("ascii")
+            code, text = await self.command(f"AUTH PLAIN {token}")
+        else:
+            code, text = await self.command("AUTH LOGIN")
+            if code == 334:
+                code, text = await self.command(base64.b64encode(username.encode()).decode("ascii"))
+            if code == 334:
+                code, text = await self.command(base64.b64encode(password.encode()).decode("ascii"))
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, text)
+
+    @classmethod
+    async def open(cls, host, port, username, password, timeout=ASYNC_SMTP_TIMEOUT):
+        started = time.perf_counter()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), SMTP_CONNECT_TIMEOUT)
+        session = cls(reader, writer, timeout)
+        try:
+            code, text = await asyncio.wait_for(session.read_reply(), SMTP_CONNECT_TIMEOUT)
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, text)
+            connected = time.perf_counter()
+            await session.ehlo()
+            if SMTP_STARTTLS:
+                await session.starttls(host)
+            secured = time.perf_counter()
+            await session.login(username, password)
+        except BaseException:
+            session.close()
+            raise
+        SMTP_PHASE_SECONDS.observe("connect", connected - started)
+        SMTP_PHASE_SECONDS.observe("starttls", secured - connected)
+        SMTP_PHASE_SECONDS.observe("auth", time.perf_counter() - secured)
+        return session
+
+    async def sendmail(self, from_addr, to_addrs, data):
+        """Run one MAIL/RCPT/DATA transaction; returns the refused recipients like smtplib.sendmail.
+
+        `data` is the message bytes, or an iterable of ready-to-send chunks (see smtp_pool.stream_mail).
+        """
+        started = time.perf_counter()
+        code, text = await self.command(f"MAIL FROM:<{from_addr}>")
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, text, from_addr)
+        mailed = time.perf_counter()
+        SMTP_PHASE_SECONDS.observe("mail", mailed - started)
+        refused = {}
+        if len(to_addrs) > 1 and "pipelining" in self.features:
+            # An envelope's RCPTs go out together and their replies are read afterwards (RFC 2920)
+            self.writer.write(b"".join(f"RCPT TO:<{address}>\r\n".encode("ascii") for address in to_addrs))
+            await self.flush()
+            replies = [await self.read_reply() for _ in to_addrs]
+        else:
+            replies = [await self.command(f"RCPT TO:<{address}>") for address in to_addrs]
+        for address, (code, text) in zip(to_addrs, replies):
+            if code not in (250, 251):
+                refused[address] = (code, text.encode())
+        if len(refused) == len(to_addrs):
+            await self.command("RSET")
+            raise smtplib.SMTPRecipientsRefused(refused)
+        addressed = time.perf_counter()
+        SMTP_PHASE_SECONDS.observe("rcpt", addressed - mailed)
+        code, text = await self.command("DATA")
+        if code != 354:
+            raise smtplib.SMTPDataError(code, text)
+        if isinstance(data, bytes):
+            data = LEADING_DOT.sub(b"..", data)
+            if not data.endswith(b"\r\n"):
+                data += b"\r\n"
+            self.writer.write(data + b".\r\n")
+        else:
+            # Streamed message: chunks arrive dot-stuffed, and flush() keeps only a socket buffer's worth in memory
+            pending = b""
+            for chunk in data:
+                if pending:
+                    self.writer.write(pending)
+                    await self.flush()
+                pending = chunk
+            self.writer.write(pending + b".\r\n")
+        await self.flush()
+        code, text = await self.read_reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, text)
+        SMTP_PHASE_SECONDS.observe("data", time.perf_counter() - addressed)
+        self.messages_sent += 1
+        return refused
+
+    async def is_healthy(self):
+        try:
+            code, _ = await self.command("RSET")
+            return code == 250
+        except Exception:
+            return False
+
+    async def quit(self):
+        try:
+            await asyncio.wait_for(self.command("QUIT"), 5)
+        except Exception:
+            pass
+        self.close()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncDeliveryEngine:
+    """Deliver queued jobs with hundreds of concurrent SMTP conversations on one event loop thread.
+
+    `prepare(job)` returns (username, password, message) for a job and `record(job, status)` logs the
+    outcome; both run in the loop's default executor since they may block. Failures are handed to the
+    retry scheduler. The number of concurrent deliveries is resized by a PoolSizer.
+    """
+
+    def __init__(self, scheduler, retries, prepare, record, concurrency=ASYNC_MAX_CONCURRENCY,
+                 min_concurrency=ASYNC_MIN_CONCURRENCY):
+        self.scheduler = scheduler
+        self.retries = retries
+        self.queue = scheduler.queue
+        self.prepare = prepare
+        self.record = record
+        self.sizer = PoolSizer(self.queue, min(min_concurrency, concurrency), concurrency, self.resize)
+        self.concurrency = self.sizer.minimum
+        self.smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+        self.smtp_port = int(os.getenv("SMTP_PORT", 587))
+        self._idle = {}
+        self._tasks = set()
+        self._slot_free = None
+        self._loop = None
+
+    def resize(self, concurrency):
+        """Allow `concurrency` deliveries at once; called from the pool sizer's thread."""
+        self.concurrency = concurrency
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._slot_free.set)
+
+    async def _checkout(self, username, password, breakers):
+        """Reuse a warm session for the account if there is a healthy one, else open a new one; returns
+        (session, whether it was reused)."""
+        sessions = self._idle.get(username, [])
+        now = time.monotonic()
+        while sessions:
+            session = sessions.pop()
+            if now - session.last_used <= SMTP_POOL_MAX_IDLE_SECONDS and await session.is_healthy():
+                circuit_breakers.record_connect(breakers)
+                return session, True
+            await session.quit()
+        started = time.perf_counter()
+        try:
+            session = await AsyncSMTPSession.open(self.smtp_server, self.smtp_port, username, password)
+        except Exception as e:
+            circuit_breakers.record_connect(breakers, e)
+            raise
+        circuit_breakers.record_connect(breakers, seconds=time.perf_counter() - started)
+        return session, False
+
+    async def _checkin(self, username, session):
+        session.last_used = time.monotonic()
+        sessions = self._idle.setdefault(username, [])
+        # Idle sessions are cheap here, so keep as many as there can be concurrent deliveries
+        if session.messages_sent < SMTP_POOL_MAX_MESSAGES and len(sessions) < self.concurrency:
+            sessions.append(session)
+        else:
+            await session.quit()
+
+    def _prepare(self, job):
+        username, password, message = self.prepare(job)
+        from_addr, to_addrs, data = flatten_message(message)
+        if isinstance(job, Envelope):
+            to_addrs = job.recipients
+        return username, password, from_addr, to_addrs, data
+
+    async def _send(self, job):
+        """Deliver a job or Envelope; returns the refused recipients."""
+        loop = asyncio.get_running_loop()
+        with tracer.span("build"):
+            username, password, from_addr, to_addrs, data = await loop.run_in_executor(None, self._prepare, job)
+        with tracer.span("connect") as span:
+            # Fails fast, without connecting, while the server's or the account's breaker is open
+            breakers = circuit_breakers.check(self.smtp_server, self.smtp_port, username)
+            session, span["reused"] = await self._checkout(username, password, breakers)
+        try:
+            with tracer.span("send"):
+                refused = await session.sendmail(from_addr, to_addrs, data)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+            await self._checkin(username, session)
+            raise
+        except BaseException as e:
+            circuit_breakers.record_failure(breakers, e)
+            session.close()
+            raise
+        await self._checkin(username, session)
+        return refused
+
+    async def _deliver(self, job):
+        loop = asyncio.get_running_loop()
+        DELIVERIES_IN_PROGRESS.inc()
+        started = time.perf_counter()
+        refused = error = None
+        # Each delivery runs in its own task, so the active traces are this job's alone
+        tracer.activate(tracer.resume(job))
+        try:
+            refused = await self._send(job)
+        except Exception as e:
+            error = e
+        finally:
+            DELIVERIES_IN_PROGRESS.dec()
+            # Before the outcomes are recorded: a deferred job may be due again, and leased anew, at once
+            self.scheduler.done(job, error)
+        elapsed = time.perf_counter() - started
+        SMTP_PHASE_SECONDS.observe("total", elapsed)
+        self.sizer.observe(elapsed)
+        for member, member_error in job_outcomes(job, refused, error):
+            try:
+                if member_error is not None:
+                    status = await loop.run_in_executor(None, self.retries.handle_failure, member, member_error)
+                else:
+                    status = "sent"
+                    EMAIL_DELIVERIES.inc("sent", "2xx")
+                    await loop.run_in_executor(None, self.record, member, status)
+                    await loop.run_in_executor(None, self.queue.complete, member.request_id, status)
+                tracer.finish(member, status)
+                delivery_stats.record(member, status, member_error, elapsed)
+            except Exception as e:
+                # The job stays leased until its lease expires, and is then delivered again
+                print(f"Failed to record the delivery of {member.request_id}: {e}")
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        self._slot_free.set()
+        # Nothing else awaits a delivery task, so an error that escaped it would otherwise go unseen
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Delivery task failed: {task.exception()}")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._slot_free = asyncio.Event()
+        self._loop = loop
+        self.sizer.start()
+        while True:
+            free = self.concurrency - len(self._tasks)
+            if free <= 0:
+                self._slot_free.clear()
+                await self._slot_free.wait()
+                continue
+            job, wait = self.scheduler.poll()
+            if job is None:
+                # Nothing deliverable right now; check again shortly or when a delivery finishes
+                self._slot_free.clear()
+                try:
+                    await asyncio.wait_for(self._slot_free.wait(), min(wait, 0.1))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = loop.create_task(self._deliver(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+
+
+def start_async_engine(queue, prepare, record, concurrency=ASYNC_MAX_CONCURRENCY, recover=True):
+    """Requeue unacknowledged jobs (unless recover=False) and run the async engine on its own event loop thread."""
+    recovered = queue.recover() if recover else 0
+    scheduler = DeliveryScheduler(queue)
+    scheduler.start()
+    delivery_lifecycle.register(scheduler)
+    retries = RetryScheduler(queue, record)
+    retries.start()
+    engine = AsyncDeliveryEngine(scheduler, retries, prepare, record, concurrency)
+    threading.Thread(target=asyncio.run, args=(engine.run(),), name="async-delivery", daemon=True).start()
+    return recovered
@@ -0,0 +1,225 @@
+import os
+import re
+import base64
+import hashlib
+import mimetypes
+import threading
+import uuid
+from collections import OrderedDict
+from email.utils import encode_rfc2231
+
+from email_templates import RenderedMessage, serialize_message
+from smtp_pool import LEADING_DOT
+
+# Uploaded attachments and their cached base64 encodings live here
+ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", "attachments")
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", 25 * 1024 * 1024))
+ATTACHMENT_CACHE_BYTES = int(os.getenv("ATTACHMENT_CACHE_BYTES", 512 * 1024 * 1024))
+
+# 57 input bytes make one 76-character base64 line, so whole lines are encoded and read at a time
+ENCODE_CHUNK_SIZE = 57 * 1024
+READ_CHUNK_SIZE = 78 * 840
+
+# Encodings run under one of this many locks, picked by attachment ID, so the locks don't grow with the store
+ENCODE_LOCK_STRIPES = 64
+
+# Attachment IDs are the SHA-256 of the content
+ATTACHMENT_ID_REGEX = re.compile(r"[0-9a-f]{64}")
+
+
+class AttachmentStore:
+    """Attachments stored by content hash, plus a size-bounded cache of their base64 encodings.
+
+    Each distinct file is encoded once, to disk, and streamed from there into every message that
+    carries it; the least recently used encodings are removed once the cache grows past its limit.
+    """
+
+    def __init__(self, directory=ATTACHMENT_DIR, cache_bytes=ATTACHMENT_CACHE_BYTES):
+        self.directory = directory
+        self.cache_directory = os.path.join(directory, "encoded")
+        self.cache_bytes = cache_bytes
+        self._encoded = None
+        self._encoded_bytes = 0
+        self._encode_locks = [threading.Lock() for _ in range(ENCODE_LOCK_STRIPES)]
+        self._lock = threading.Lock()
+
+    def path(self, attachment_id):
+        return os.path.join(self.directory, attachment_id)
+
+    def exists(self, attachment_id):
+        return (isinstance(attachment_id, str) and ATTACHMENT_ID_REGEX.fullmatch(attachment_id) is not None
+                and os.path.exists(self.path(attachment_id)))
+
+    def add_stream(self, stream, max_bytes=ATTACHMENT_MAX_BYTES):
+        """Store a file read chunk by chunk from `stream`; returns (attachment ID, size), or (None, size) if it is too large."""
+        os.makedirs(self.directory, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        temp_path = os.path.join(self.directory, f".upload-{uuid.uuid4().hex}")
+        try:
+            with open(temp_path, "wb") as file:
+                while True:
+                    chunk = stream.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        return None, size
+                    digest.update(chunk)
+                    file.write(chunk)
+            attachment_id = digest.hexdigest()
+            os.replace(temp_path, self.path(attachment_id))
+            return attachment_id, size
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def add_file(self, path):
+        """Store a local file and return its attachment ID."""
+        with open(path, "rb") as file:
+            return self.add_stream(file, max_bytes=None)[0]
+
+    def delete(self, attachment_id):
+        if not self.exists(attachment_id):
+            return False
+        os.remove(self.path(attachment_id))
+        with self._lock:
+            self._discard_encoded_locked(attachment_id)
+        return True
+
+    def _load_cache_locked(self):
+        if self._encoded is None:
+            os.makedirs(self.cache_directory, exist_ok=True)
+            entries = []
+            for name in os.listdir(self.cache_directory):
+                if ATTACHMENT_ID_REGEX.fullmatch(name):
+                    stat = os.stat(os.path.join(self.cache_directory, name))
+                    entries.append((stat.st_mtime, name, stat.st_size))
+            # Least recently written first, as if they had been used in that order
+            self._encoded = OrderedDict((name, size) for _, name, size in sorted(entries))
+            self._encoded_bytes = sum(self._encoded.values())
+        return self._encoded
+
+    def _discard_encoded_locked(self, attachment_id):
+        size = self._load_cache_locked().pop(attachment_id, None)
+        if size is not None:
+            self._encoded_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_directory, attachment_id))
+            except FileNotFoundError:
+                pass
+
+    def _encode(self, attachment_id):
+        """Base64-encode a stored file into the cache a chunk at a time, with CRLF line endings."""
+        temp_path = os.path.join(self.cache_directory, f".encode-{uuid.uuid4().hex}")
+        with open(self.path(attachment_id), "rb") as source, open(temp_path, "wb") as target:
+            while True:
+                chunk = source.read(ENCODE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                target.write(base64.encodebytes(chunk).replace(b"\n", b"\r\n"))
+        encoded_path = os.path.join(self.cache_directory, attachment_id)
+        os.replace(temp_path, encoded_path)
+        return os.path.getsize(encoded_path)
+
+    def open_encoded(self, attachment_id):
+        """Open the cached base64 encoding of an attachment, encoding it first if it is not cached."""
+        encoded_path = os.path.join(self.cache_directory, attachment_id)
+        with self._lock:
+            cache = self._load_cache_locked()
+        encode_lock = self._encode_locks[hash(attachment_id) % len(self._encode_locks)]
+        # Concurrent sends of a new attachment wait for one encoding instead of each doing their own
+        with encode_lock:
+            with self._lock:
+                if attachment_id in cache:
+                    cache.move_to_end(attachment_id)
+                    try:
+                        return open(encoded_path, "rb")
+                    except FileNotFoundError:
+                        self._discard_encoded_locked(attachment_id)
+            size = self._encode(attachment_id)
+            with self._lock:
+                cache[attachment_id] = size
+                self._encoded_bytes += size
+                # Open before evicting; on POSIX an open file stays readable after it is removed
+                file = open(encoded_path, "rb")
+                while self._encoded_bytes > self.cache_bytes and len(cache) > 1:
+                    self._discard_encoded_locked(next(iter(cache)))
+                return file
+
+    def iter_encoded(self, attachment_id):
+        """Yield the base64 encoding of an attachment in chunks of whole lines."""
+        with self.open_encoded(attachment_id) as file:
+            while True:
+                chunk = file.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def get_stats(self):
+        with self._lock:
+            cache = self._load_cache_locked()
+            return {"encoded_cached": len(cache), "encoded_bytes": self._encoded_bytes, "cache_limit_bytes": self.cache_bytes}
+
+
+# Shared attachment store for this process
+attachment_store = AttachmentStore()
+
+
+class StreamedMessage:
+    """A message whose attachments are streamed from the encoding cache while it is being sent.
+
+    `segments` are ready-to-send bytes (already dot-stuffed, with CRLF line endings) or the IDs of
+    attachments to stream in their place.
+    """
+
+    __slots__ = ("from_addr", "to_addrs", "subject", "segments", "store")
+
+    def __init__(self, from_addr, to_addrs, subject, segments, store):
+        self.from_addr = from_addr
+        self.to_addrs = to_addrs
+        self.subject = subject
+        self.segments = segments
+        self.store = store
+
+    def iter_chunks(self):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+            else:
+                yield from self.store.iter_encoded(segment)
+
+
+def attachment_part_header(boundary, filename):
+    """Encode the MIME headers that open one base64 attachment part."""
+    filename = re.sub(r'[\r\n"\\]', "", os.path.basename(filename)) or "attachment"
+    content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    if filename.isascii():
+        disposition = f'attachment; filename="{filename}"'
+    else:
+        disposition = f"attachment; filename*={encode_rfc2231(filename, 'utf-8')}"
+    return (f"--{boundary}\r\nContent-Type: {content_type}\r\nMIME-Version: 1.0\r\n"
+            f"Content-Transfer-Encoding: base64\r\nContent-Disposition: {disposition}\r\n\r\n").encode()
+
+
+def attach_files(message, attachments, store=attachment_store):
+    """Add attachments to a multipart MIME or rendered template message.
+
+    `attachments` is a list of {"id": attachment ID, "filename": name}. Every attachment is encoded
+    into the cache now, so that sending only has to copy the encoded bytes to the socket.
+    """
+    from_addr, to_addrs, data = serialize_message(message)
+    if isinstance(message, RenderedMessage):
+        subject, boundary = message.subject, message.boundary
+    else:
+        subject, boundary = message["Subject"], message.get_boundary()
+    # Reopen the multipart body: cut the closing delimiter and add the attachment parts before it
+    data = data[:data.rindex(f"--{boundary}--".encode())]
+    if not data.endswith(b"\r\n"):
+        data += b"\r\n"
+    segments = [LEADING_DOT.sub(b"..", data)]
+    for attachment in attachments:
+        store.open_encoded(attachment["id"]).close()
+        segments += (attachment_part_header(boundary, attachment["filename"]), attachment["id"])
+    segments.append(f"--{boundary}--\r\n".encode())
+    return StreamedMessage(from_addr, to_addrs, subject, segments, store)
@@ -0,0 +1,163 @@
+"""Stand-in SMTP server for benchmarks and local testing.
+
+Accepts any login and any mail, optionally slowly and optionally failing. For every recipient of a
+delivered message, the arrival time, Subject, recipient and transaction number are appended to a log
+file so the benchmark can measure delivery latency and count SMTP transactions.
+
+    python bench/fake_smtp.py --port 2525 --latency 0.02 --tempfail-rate 0.05
+"""
+import argparse
+import random
+import socketserver
+import threading
+import time
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, latency=0.0, data_latency=0.0, tempfail_rate=0.0, permfail_rate=0.0,
+                 disconnect_rate=0.0, log_path=None, seed=None):
+        super().__init__(address, SMTPHandler)
+        self.latency = latency
+        self.data_latency = data_latency
+        self.tempfail_rate = tempfail_rate
+        self.permfail_rate = permfail_rate
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.log = open(log_path, "a", buffering=1) if log_path else None
+        self.stats = {"connections": 0, "messages": 0, "recipients": 0, "tempfail": 0, "permfail": 0, "disconnects": 0}
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def roll(self, rate):
+        if rate <= 0:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def delivered(self, subject, recipients):
+        with self.lock:
+            self.stats["messages"] += 1
+            self.stats["recipients"] += len(recipients)
+            if self.log:
+                now = time.time()
+                transaction = self.stats["messages"]
+                self.log.write("".join(f"{now:.6f}\t{subject}\t{recipient}\t{transaction}\n" for recipient in recipients))
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line, latency=None):
+        delay = self.server.latency if latency is None else latency
+        if delay:
+            time.sleep(delay)
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def read_data(self):
+        """Read a message up to the lone dot; return its Subject, or None if the client went away."""
+        subject = ""
+        in_headers = True
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            if line == b".\r\n":
+                return subject
+            if in_headers:
+                if line in (b"\r\n", b"\n"):
+                    in_headers = False
+                elif line[:8].lower() == b"subject:":
+                    subject = line[8:].strip().decode("utf-8", "replace")
+
+    def handle(self):
+        try:
+            self.converse()
+        except (ConnectionResetError, BrokenPipeError):
+            # Clients killed mid-transaction are part of what the benchmark exercises
+            pass
+
+    def converse(self):
+        server = self.server
+        server.count("connections")
+        self.reply("220 fake-smtp ready", latency=0)
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip()
+            verb = command[:4].upper()
+            if verb == "EHLO":
+                self.reply("250-fake-smtp\r\n250-PIPELINING\r\n250-8BITMIME\r\n250 AUTH PLAIN LOGIN")
+            elif verb == "HELO":
+                self.reply("250 fake-smtp")
+            elif verb == "AUTH":
+                if command.upper() == "AUTH LOGIN":
+                    self.reply("334 VXNlcm5hbWU6")
+                    self.rfile.readline()
+                    self.reply("334 UGFzc3dvcmQ6")
+                    self.rfile.readline()
+                self.reply("235 2.7.0 Authentication successful")
+            elif verb == "MAIL":
+                if server.roll(server.disconnect_rate):
+                    server.count("disconnects")
+                    return
+                recipients = []
+                self.reply("250 2.1.0 OK")
+            elif verb == "RCPT":
+                if server.roll(server.permfail_rate):
+                    server.count("permfail")
+                    self.reply("550 5.1.1 No such user")
+                elif server.roll(server.tempfail_rate):
+                    server.count("tempfail")
+                    self.reply("451 4.3.0 Try again later")
+                else:
+                    recipients.append(command[8:].strip().strip("<>"))
+                    self.reply("250 2.1.5 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                subject = self.read_data()
+                if subject is None:
+                    return
+                server.delivered(subject, recipients)
+                self.reply("250 2.0.0 Queued", latency=server.latency + server.data_latency)
+            elif verb in ("RSET", "NOOP"):
+                if verb == "RSET":
+                    recipients = []
+                self.reply("250 2.0.0 OK")
+            elif verb == "QUIT":
+                self.reply("221 2.0.0 Bye", latency=0)
+                return
+            else:
+                self.reply("502 5.5.2 Command not recognized")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake SMTP server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every reply")
+    parser.add_argument("--data-latency", type=float, default=0.0, help="extra seconds before accepting DATA")
+    parser.add_argument("--tempfail-rate", type=float, default=0.0, help="share of RCPTs answered 451")
+    parser.add_argument("--permfail-rate", type=float, default=0.0, help="share of RCPTs answered 550")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="share of transactions dropped at MAIL")
+    parser.add_argument("--log", help="append '<time>\\t<subject>\\t<recipient>\\t<transaction>' for every delivered copy")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    server = FakeSMTPServer((args.host, args.port), args.latency, args.data_latency, args.tempfail_rate,
+                            args.permfail_rate, args.disconnect_rate, args.log, args.seed)
+    print(f"Fake SMTP server listening on {args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
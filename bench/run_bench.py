@@ -0,0 +1,417 @@
+"""Load benchmark: run app.py against the fake SMTP server and measure throughput, latency and memory.
+
+Starts bench/fake_smtp.py and app.py on free local ports, in a scratch directory, submits messages
+with a number of concurrent HTTP clients, waits for the queue to drain and saves the results as JSON.
+
+    python bench/run_bench.py --messages 2000 --concurrency 20 --engine async --latency 0.01
+    python bench/run_bench.py --mode bulk --tempfail-rate 0.05 --compare bench/results/<earlier run>.json
+    python bench/run_bench.py --mode bulk --newsletter --envelope-batch 50
+    python bench/run_bench.py --mode bulk --accounts 4 --account-rate 50
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+# Headline numbers shown by --compare
+COMPARED = (
+    ("accept_rate", "accepted/s", True),
+    ("throughput", "delivered/s", True),
+    ("accept_latency_ms.p95", "accept p95 ms", False),
+    ("delivery_latency_ms.p50", "delivery p50 ms", False),
+    ("delivery_latency_ms.p95", "delivery p95 ms", False),
+    ("delivery_latency_ms.p99", "delivery p99 ms", False),
+    ("peak_rss_mb", "peak RSS MB", False),
+    ("smtp_transactions", "SMTP transactions", False),
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values):
+    """p50/p95/p99/max of a list of seconds, in milliseconds (nearest rank)."""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))] * 1000, 2)
+
+    return {"p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99), "max": round(values[-1] * 1000, 2)}
+
+
+def read_memory(pid):
+    """(current RSS, peak RSS) of a process in bytes, or (None, None) where /proc is not available."""
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            fields = dict(line.split(":", 1) for line in file if ":" in line)
+        return int(fields["VmRSS"].split()[0]) * 1024, int(fields["VmHWM"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import psutil
+        rss = psutil.Process(pid).memory_info().rss
+        return rss, rss
+    except Exception:
+        return None, None
+
+
+class MemorySampler(threading.Thread):
+    """Track the peak RSS of a process, from the kernel's high-water mark where possible."""
+
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def sample(self):
+        rss, peak = read_memory(self.pid)
+        self.peak = max(self.peak, rss or 0, peak or 0)
+
+    def stop(self):
+        self.sample()
+        self.stopped.set()
+
+
+def http_request(port, method, path, body=None, timeout=60):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def scrape_metrics(port):
+    """Return {metric name with labels: value} from the app's /metrics endpoint."""
+    _, body = http_request(port, "GET", "/metrics")
+    samples = {}
+    for line in body.decode().splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            samples[name] = float(value)
+    return samples
+
+
+def wait_until(condition, timeout, interval=0.1):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if condition():
+                return True
+        except OSError:
+            pass
+        time.sleep(interval)
+    return False
+
+
+def make_body(size):
+    """Plain text of `size` characters in 76-character lines."""
+    line = ("The quick brown fox jumps over the lazy dog. " * 2)[:75] + "\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+def make_payload(number, body, attachment, newsletter=False):
+    # A newsletter sends the same message to everyone; otherwise every message is different
+    subject = "bench newsletter" if newsletter else f"bench {number}"
+    payload = {"subject": subject, "recipient": f"user{number}@example.com", "body": body}
+    if attachment:
+        payload["attachments"] = [{"id": attachment, "filename": "bench.bin"}]
+    return payload
+
+
+class Client(threading.Thread):
+    """One HTTP client submitting messages until the shared counter runs out."""
+
+    def __init__(self, bench):
+        super().__init__(daemon=True)
+        self.bench = bench
+
+    def run(self):
+        bench = self.bench
+        while True:
+            numbers = bench.take()
+            if not numbers:
+                return
+            if bench.args.mode == "bulk":
+                self.send_bulk(numbers)
+            else:
+                self.send_single(numbers[0])
+
+    def send_single(self, number):
+        bench = self.bench
+        body = json.dumps(make_payload(number, bench.body, bench.attachment, bench.args.newsletter))
+        started = time.time()
+        try:
+            status, _ = http_request(bench.http_port, "POST", "/send-email", body)
+        except OSError:
+            status = None
+        bench.accepted(number, started, time.time(), status == 200)
+
+    def send_bulk(self, numbers):
+        """Stream one NDJSON request; a line counts as accepted when its result line comes back."""
+        bench = self.bench
+        body = "".join(json.dumps(make_payload(number, bench.body, bench.attachment, bench.args.newsletter)) + "\n"
+                       for number in numbers)
+        started = time.time()
+        connection = http.client.HTTPConnection("127.0.0.1", bench.http_port, timeout=300)
+        try:
+            connection.request("POST", "/send-emails", body=body.encode(), headers={"Content-Type": "application/x-ndjson"})
+            response = connection.getresponse()
+            for line in response:
+                result = json.loads(line)
+                bench.accepted(numbers[result["line"] - 1], started, time.time(), "request_id" in result)
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.body = make_body(args.size)
+        self.attachment = None
+        self.workdir = tempfile.mkdtemp(prefix="email-bench-")
+        self.smtp_port = free_port()
+        self.http_port = free_port()
+        self.delivery_log = os.path.join(self.workdir, "deliveries.log")
+        self.processes = []
+        self._next = 0
+        self._lock = threading.Lock()
+        # number -> (request started, accepted at, ok)
+        self.accepts = {}
+
+    def take(self):
+        """Hand out the next message number (or a bulk batch of them)."""
+        with self._lock:
+            count = self.args.batch_size if self.args.mode == "bulk" else 1
+            numbers = list(range(self._next, min(self._next + count, self.args.messages)))
+            self._next += len(numbers)
+            return numbers
+
+    def accepted(self, number, started, accepted_at, ok):
+        with self._lock:
+            self.accepts[number] = (started, accepted_at, ok)
+
+    def start_processes(self):
+        args = self.args
+        fake_command = [
+            sys.executable, os.path.join(BENCH_DIR, "fake_smtp.py"), "--port", str(self.smtp_port),
+            "--latency", str(args.latency), "--data-latency", str(args.data_latency),
+            "--tempfail-rate", str(args.tempfail_rate), "--permfail-rate", str(args.permfail_rate),
+            "--disconnect-rate", str(args.disconnect_rate), "--log", self.delivery_log, "--seed", str(args.seed),
+        ]
+        self.processes.append(subprocess.Popen(fake_command, stdout=subprocess.DEVNULL))
+
+        if args.accounts > 1:
+            # Sending accounts for the app's pool; with one, the app uses USER_EMAIL from the environment
+            with open(os.path.join(self.workdir, "data.csv"), "w") as file:
+                file.write("key,email,app_password\n")
+                file.writelines(f"bench{number},bench{number}@example.com,bench\n" for number in range(args.accounts))
+
+        env = dict(
+            os.environ,
+            SMTP_SERVER="127.0.0.1", SMTP_PORT=str(self.smtp_port), SMTP_STARTTLS="false",
+            USER_EMAIL="bench@example.com", USER_APP_PASSWORD="bench", EMAIL_FROM_NAME="Bench",
+            PORT=str(self.http_port), DELIVERY_ENGINE=args.engine, RETRY_BASE_DELAY=str(args.retry_delay),
+            QUEUE_DB_PATH=os.path.join(self.workdir, "email_queue.db"),
+            TEMPLATES_PATH=os.path.join(self.workdir, "email_templates.json"),
+            ATTACHMENT_DIR=os.path.join(self.workdir, "attachments"),
+            ENVELOPE_BATCH_MAX=str(args.envelope_batch), ACCOUNT_RATE_PER_SECOND=str(args.account_rate),
+        )
+        self.app_log = open(os.path.join(self.workdir, "app.log"), "w")
+        app = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, args.app)], cwd=self.workdir, env=env,
+                               stdout=self.app_log, stderr=subprocess.STDOUT)
+        self.processes.append(app)
+        self.app = app
+        if not wait_until(lambda: http_request(self.http_port, "GET", "/metrics", timeout=2)[0] == 200, 30):
+            raise RuntimeError(f"app did not start; see {self.app_log.name}")
+
+    def stop_processes(self):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.app_log.close()
+
+    def read_deliveries(self):
+        """(number -> time its first copy reached the fake SMTP server, number of SMTP transactions)."""
+        deliveries = {}
+        transactions = set()
+        if os.path.exists(self.delivery_log):
+            with open(self.delivery_log) as file:
+                for line in file:
+                    stamp, _, recipient, transaction = line.rstrip("\n").split("\t")
+                    match = re.fullmatch(r"user(\d+)@example\.com", recipient)
+                    if match:
+                        deliveries.setdefault(int(match.group(1)), float(stamp))
+                    transactions.add(transaction)
+        return deliveries, len(transactions)
+
+    def run(self):
+        args = self.args
+        self.start_processes()
+        memory = MemorySampler(self.app.pid)
+        memory.start()
+        try:
+            if args.attachment_size:
+                status, body = http_request(self.http_port, "POST", "/attachments", os.urandom(args.attachment_size))
+                if status != 200:
+                    raise RuntimeError(f"attachment upload failed: {body.decode()}")
+                self.attachment = json.loads(body)["attachment_id"]
+
+            started = time.time()
+            clients = [Client(self) for _ in range(args.concurrency)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            accept_finished = time.time()
+
+            # Deferred messages keep the queue non-empty until their last retry
+            drained = wait_until(lambda: scrape_metrics(self.http_port).get("email_queue_depth") == 0, args.timeout, 0.2)
+            metrics = scrape_metrics(self.http_port)
+        finally:
+            memory.stop()
+            self.stop_processes()
+
+        deliveries, transactions = self.read_deliveries()
+        accepted = {number: accept for number, accept in self.accepts.items() if accept[2]}
+        delivered = {number: stamp for number, stamp in deliveries.items() if number in accepted}
+        last_delivery = max(delivered.values(), default=accept_finished)
+        results = {
+            "messages": args.messages,
+            "accepted": len(accepted),
+            "rejected": args.messages - len(accepted),
+            "delivered": len(delivered),
+            "undelivered": len(accepted) - len(delivered),
+            "drained": drained,
+            "accept_seconds": round(accept_finished - started, 3),
+            "total_seconds": round(last_delivery - started, 3),
+            "accept_rate": round(len(accepted) / max(accept_finished - started, 1e-9), 1),
+            "throughput": round(len(delivered) / max(last_delivery - started, 1e-9), 1),
+            "accept_latency_ms": percentiles([accepted_at - request_started for request_started, accepted_at, _ in accepted.values()]),
+            "delivery_latency_ms": percentiles([stamp - accepted[number][1] for number, stamp in delivered.items()]),
+            "peak_rss_mb": round(memory.peak / 1024 / 1024, 1) if memory.peak else None,
+            "smtp_transactions": transactions,
+            "outcomes": {name: value for name, value in metrics.items() if name.startswith("email_deliveries_total")},
+        }
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def lookup(results, dotted):
+    for key in dotted.split("."):
+        results = (results or {}).get(key)
+    return results
+
+
+def print_results(results, previous=None):
+    print(f"Accepted {results['accepted']}/{results['messages']}, delivered {results['delivered']} "
+          f"in {results['total_seconds']}s")
+    for key, label, higher_is_better in COMPARED:
+        value = lookup(results, key)
+        line = f"  {label:<18} {value}"
+        old = lookup(previous, key) if previous else None
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            change = (value - old) / old * 100
+            better = change > 0 if higher_is_better else change < 0
+            line += f"   (was {old}, {change:+.1f}%{'' if abs(change) < 1 else ', better' if better else ', worse'})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the email server against a local fake SMTP server")
+    parser.add_argument("--app", default="app.py", help="server script to run, relative to the repository")
+    parser.add_argument("--engine", choices=("thread", "async"), default="thread")
+    parser.add_argument("--mode", choices=("single", "bulk"), default="single",
+                        help="one /send-email request per message, or NDJSON streams to /send-emails")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=10, help="concurrent HTTP clients")
+    parser.add_argument("--batch-size", type=int, default=500, help="messages per /send-emails request in bulk mode")
+    parser.add_argument("--size", type=int, default=1000, help="body size in characters (at most 10000)")
+    parser.add_argument("--attachment-size", type=int, default=0, help="attach one shared file of this many bytes")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake SMTP delay before every reply, in seconds")
+    parser.add_argument("--data-latency", type=float, default=0.0, help="extra fake SMTP delay after DATA")
+    parser.add_argument("--tempfail-rate", type=float, default=0.0, help="share of RCPTs answered 451")
+    parser.add_argument("--permfail-rate", type=float, default=0.0, help="share of RCPTs answered 550")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="share of transactions dropped")
+    parser.add_argument("--newsletter", action="store_true", help="send the same subject and body to every recipient")
+    parser.add_argument("--envelope-batch", type=int, default=1,
+                        help="ENVELOPE_BATCH_MAX for the app: recipients per SMTP transaction for identical messages")
+    parser.add_argument("--accounts", type=int, default=1, help="sending accounts in the app's pool")
+    parser.add_argument("--account-rate", type=float, default=0.0,
+                        help="ACCOUNT_RATE_PER_SECOND for the app: sends per second allowed to each account (0 for no limit)")
+    parser.add_argument("--retry-delay", type=float, default=0.5, help="RETRY_BASE_DELAY for the app")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for the queue to drain")
+    parser.add_argument("--output", help="where to save the JSON results (default bench/results/<time>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+    if args.size > 10000:
+        parser.error("--size is limited to 10000 characters by the API; use --attachment-size for larger messages")
+
+    results = Benchmark(args).run()
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": results,
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{args.engine}-{args.mode}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)["results"]
+    print_results(results, previous)
+    print(f"Saved {output}")
+
+
+if __name__ == "__main__":
+    main()
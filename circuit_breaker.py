@@ -0,0 +1,198 @@
+import os
+import smtplib
+import threading
+import time
+
+# A breaker opens after BREAKER_FAILURE_THRESHOLD failures in a row: failed or timed-out connects, TLS
+# handshakes and logins, or connections that took longer than BREAKER_SLOW_SECONDS to set up. It stays
+# open for BREAKER_OPEN_SECONDS, then lets one probe through; each failed probe doubles the open time,
+# up to BREAKER_MAX_OPEN_SECONDS
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_SLOW_SECONDS = float(os.getenv("BREAKER_SLOW_SECONDS", 10))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", 30))
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv("BREAKER_MAX_OPEN_SECONDS", 600))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of connecting while a breaker is open; the email is deferred until it may close."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"circuit open for {name}, retrying in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed, open (failing fast) or half-open (one probe in flight) for one SMTP host or sending account."""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0
+        self.open_seconds = BREAKER_OPEN_SECONDS
+        self.open_until = 0.0
+        self.trips = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def wait_time(self, now):
+        """Seconds until a call may go through (0 if one may now); a probe in flight counts as open."""
+        if self.state == OPEN:
+            return max(0.0, self.open_until - now)
+        return self.open_seconds if self.state == HALF_OPEN else 0.0
+
+    def check(self):
+        """Raise CircuitOpenError unless a call may go through; once the open time is over, the first
+        caller becomes the probe."""
+        now = time.monotonic()
+        with self._lock:
+            wait = self.wait_time(now)
+            if wait > 0:
+                raise CircuitOpenError(self.name, wait)
+            if self.state == OPEN:
+                self.state = HALF_OPEN
+
+    def cancel_probe(self):
+        """The probe never got as far as this breaker, so the next caller probes instead."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+                self.open_until = 0.0
+
+    def success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                print(f"Circuit for {self.name} closed")
+            self.state = CLOSED
+            self.failures = 0
+            self.open_seconds = BREAKER_OPEN_SECONDS
+
+    def failure(self, error):
+        with self._lock:
+            # Timeouts have no message of their own
+            self.last_error = str(error) or type(error).__name__
+            if self.state == HALF_OPEN:
+                self.open_seconds = min(BREAKER_MAX_OPEN_SECONDS, self.open_seconds * 2)
+            else:
+                self.failures += 1
+                if self.state == OPEN or self.failures < BREAKER_FAILURE_THRESHOLD:
+                    return
+            self.state = OPEN
+            self.open_until = time.monotonic() + self.open_seconds
+            self.trips += 1
+        print(f"Circuit for {self.name} open for {self.open_seconds:g}s: {self.last_error}")
+
+
+class CircuitBreakers:
+    """The breakers of every SMTP host and sending account this process connects to."""
+
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name)
+            return breaker
+
+    def host(self, host, port):
+        return self.get(f"host {host}:{port}")
+
+    def account(self, username):
+        return self.get(f"account {username.lower()}")
+
+    def account_wait_time(self, username, now):
+        """Seconds until the account's breaker lets a call through, without creating or probing it."""
+        breaker = self._breakers.get(f"account {username.lower()}")
+        return breaker.wait_time(now) if breaker else 0.0
+
+    def check(self, host, port, username):
+        """Check the host's and the account's breakers before using a session; raises CircuitOpenError.
+
+        Returns the two breakers, for record_connect() and record_failure().
+        """
+        host_breaker, account_breaker = self.host(host, port), self.account(username)
+        account_breaker.check()
+        try:
+            host_breaker.check()
+        except CircuitOpenError:
+            account_breaker.cancel_probe()
+            raise
+        return host_breaker, account_breaker
+
+    @staticmethod
+    def record_connect(breakers, error=None, seconds=0.0):
+        """Report how checking out a session went: a login failure counts against the account, any other
+        failure, or a session that was slow to set up, against the host."""
+        host_breaker, account_breaker = breakers
+        if isinstance(error, smtplib.SMTPAuthenticationError):
+            host_breaker.success()
+            account_breaker.failure(error)
+        elif error is not None:
+            host_breaker.failure(error)
+            account_breaker.cancel_probe()
+        else:
+            if seconds > BREAKER_SLOW_SECONDS:
+                host_breaker.failure(f"connection took {seconds:.1f}s")
+            else:
+                host_breaker.success()
+            account_breaker.success()
+
+    @staticmethod
+    def record_failure(breakers, error):
+        """Report a transaction error; network errors and timeouts count against the host."""
+        if isinstance(error, OSError):
+            breakers[0].failure(error)
+
+    def export_state(self):
+        """The state of every breaker, for the process that takes over after a restart."""
+        now = time.monotonic()
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {
+            breaker.name: {
+                "state": breaker.state,
+                "failures": breaker.failures,
+                "open_seconds": breaker.open_seconds,
+                "retry_in": breaker.wait_time(now) if breaker.state == OPEN else 0.0,
+                "trips": breaker.trips,
+                "last_error": breaker.last_error,
+            }
+            for breaker in breakers
+        }
+
+    def import_state(self, state, elapsed=0.0):
+        """Take over what export_state() returned `elapsed` seconds ago; a probe that was in flight is sent again."""
+        now = time.monotonic()
+        for name, saved in state.items():
+            breaker = self.get(name)
+            with breaker._lock:
+                breaker.state = OPEN if saved["state"] == HALF_OPEN else saved["state"]
+                breaker.failures = saved["failures"]
+                breaker.open_seconds = saved["open_seconds"]
+                breaker.open_until = now + max(0.0, saved["retry_in"] - elapsed)
+                breaker.trips = saved["trips"]
+                breaker.last_error = saved["last_error"]
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return [{
+            "name": breaker.name,
+            "state": breaker.state,
+            "failures": breaker.failures,
+            "trips": breaker.trips,
+            "retry_in": breaker.wait_time(now) if breaker.state == OPEN else 0.0,
+            "last_error": breaker.last_error,
+        } for breaker in breakers]
+
+
+# Shared breakers used by both delivery engines and the admin terminal
+circuit_breakers = CircuitBreakers()
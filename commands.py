@@ -1,20 +1,34 @@
-import threading
 import os
-import sys
-import signal
+import time
 import psutil
-import csv
-from datetime import datetime
 from dotenv import load_dotenv, set_key
+from smtp_pool import smtp_pool
+from sender_pool import sender_pool
+from circuit_breaker import circuit_breakers
+from profiler import profiler, PROFILE_MAX_SECONDS
+from tracing import tracer, recent_traces
+from delivery_stats import stats_summary
+from delivery_queue import email_queue, PENDING_STATES
+from lifecycle import DRAIN_MAX_TIMEOUT, DRAIN_TIMEOUT, delivery_lifecycle, drain_delivery
+from log_reader import LogReader
+from log_export import EXPORT_FORMATS, export_log, export_filename, parse_date_bound
 
 # Load the .env file
 load_dotenv()
 
 # Path to the CSV file containing email logs
 CSV_FILE_PATH = "email_log.csv"
+log_reader = LogReader(CSV_FILE_PATH)
 
-email_status = {}
-email_sending_paused = False
+# Rows shown per page by "View all logs"
+LOGS_PAGE_SIZE = 50
+
+# The live dashboard is redrawn this often (seconds), listing this many senders, domains and errors
+DASHBOARD_REFRESH_SECONDS = 2
+DASHBOARD_TOP = 5
+
+# Jobs listed by "Check pending emails" and "View email queue", newest first; the rest are only counted
+QUEUE_LIST_LIMIT = 50
 
 def print_separator():
     print("══════════════════════════════════════════════════════════════════")
@@ -24,59 +38,134 @@ def print_section(title):
     print(f"                      🚀 {title} 🚀")
     print_separator()
 
-def get_latest_logs():
-    """Retrieve the latest 5 logs, showing only Recipient, Date, and Status."""
-    try:
-        with open(CSV_FILE_PATH, "r") as csv_file:
-            reader = list(csv.reader(csv_file))
-            logs = reader[-5:]  # Get the last 5 logs
-            
-            # Display only Recipient, Date, and Status columns
-            latest_logs = [
-                {"Recipient": log[2], "Date": log[4], "Status": log[5]}
-                for log in logs[1:]  # Skip header row
-            ]
-            return latest_logs
-    except FileNotFoundError:
-        return "Log file not found."
-
-def view_all_logs():
-    """Retrieve all logs, showing only Recipient, Date, and Status."""
-    try:
-        with open(CSV_FILE_PATH, "r") as csv_file:
-            reader = csv.reader(csv_file)
-            next(reader)  # Skip header row
-            all_logs = [
-                {"Recipient": row[2], "Date": row[4], "Status": row[5]}
-                for row in reader
-            ]
-            return all_logs
-    except FileNotFoundError:
-        return "Log file not found."
+def get_latest_logs(count=5):
+    """Retrieve the latest logs by reading from the end of the file, showing only Recipient, Date, and Status."""
+    # Display only Recipient, Date, and Status columns
+    return ({"Recipient": log[2], "Date": log[4], "Status": log[5]} for log in log_reader.tail(count))
+
+def view_all_logs(page=0, page_size=LOGS_PAGE_SIZE):
+    """Retrieve one page of logs, showing only Recipient, Date, and Status."""
+    return ({"Recipient": row[2], "Date": row[4], "Status": row[5]} for row in log_reader.page(page, page_size))
+
+def print_logs(logs):
+    for log in logs:
+        print(f"Recipient: {log['Recipient']}, Date: {log['Date']}, Status: {log['Status']}")
+
+def page_through_logs():
+    """Print all logs a page at a time, reading only the rows on each page."""
+    total = log_reader.count()
+    pages = max(1, -(-total // LOGS_PAGE_SIZE))
+    page = 0
+    while True:
+        print_section(f"All Email Logs (page {page + 1} of {pages})")
+        print_logs(view_all_logs(page))
+        choice = input("n = next, p = previous, q = back: ").strip().lower()
+        if choice == "n" and page + 1 < pages:
+            page += 1
+        elif choice == "p" and page > 0:
+            page -= 1
+        elif choice == "q":
+            break
 
 def change_ip_port():
     pass  # Keep as-is for this example
 
 def shutdown_server():
+    """Exit once the emails being sent are done; the queued ones are sent after the next start."""
     print("Shutting down the server...")
-    os.kill(os.getpid(), signal.SIGINT)
+    delivery_lifecycle.shutdown()
 
 def restart_server():
-    print("Restarting the server...")
-    os.execl(sys.executable, sys.executable, *sys.argv)
+    """Restart with the settings in .env, picking up the queue, quotas and circuit breakers where this run left off."""
+    delivery_lifecycle.restart()
+
+def print_jobs(states, empty_message, limit=QUEUE_LIST_LIMIT):
+    """Print the newest `limit` jobs in the given states, and how many more there are."""
+    shown = 0
+    for req_id, status in email_queue.list_jobs(states, limit=limit, newest=True):
+        print(f"Request ID: {req_id}, Status: {status}")
+        shown += 1
+    if not shown:
+        print(empty_message)
+    elif shown == limit:
+        more = email_queue.count_jobs(states) - shown
+        if more > 0:
+            print(f"... and {more} older")
 
 def check_pending_emails():
-    pending_emails = {req_id: status for req_id, status in email_status.items() if "failed" in status or status == "pending"}
-    if pending_emails:
-        for req_id, status in pending_emails.items():
-            print(f"Request ID: {req_id}, Status: {status}")
-    else:
-        print("No pending emails.")
+    # Both counts come from the queue's state index, whatever the size of the queue
+    pending = email_queue.count_jobs(PENDING_STATES)
+    failed_recently = email_queue.count_jobs(("failed",), updated_since=time.time() - 3600)
+    print(f"Pending: {pending}, failed in the last hour: {failed_recently}")
+    print_jobs(PENDING_STATES + ("failed",), "No pending emails.")
 
 def toggle_email_sending():
-    global email_sending_paused
-    email_sending_paused = not email_sending_paused
-    print("Email sending is now", "paused." if email_sending_paused else "resumed.")
+    # The pause is kept in the queue, so it holds for every delivery process and across restarts
+    if email_queue.delivery_paused() is None:
+        email_queue.pause_delivery()
+        print("Email sending is now paused. New emails are still accepted and queued.")
+    else:
+        email_queue.resume_delivery()
+        print("Email sending is now resumed.")
+
+def drain_email_sending():
+    """Pause sending and wait for the emails being sent, e.g. before maintenance."""
+    try:
+        timeout = float(input(f"Seconds to wait at most [{DRAIN_TIMEOUT:g}]: ").strip() or DRAIN_TIMEOUT)
+    except ValueError:
+        print("Invalid number of seconds.")
+        return
+    if not 0 <= timeout <= DRAIN_MAX_TIMEOUT:
+        print(f"Wait for at most {DRAIN_MAX_TIMEOUT:g} seconds.")
+        return
+    print("Pausing email sending and waiting for the emails being sent...")
+    left = drain_delivery(email_queue, timeout)
+    if left:
+        print(f"{left} emails are still being sent.")
+    else:
+        print("No emails are being sent.")
+    print(f"Email sending stays paused; {email_queue.depth()} emails are waiting. Toggle email sending to resume.")
+
+def format_latency(seconds):
+    if seconds is None:
+        return "-"
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.2f}s"
+
+def print_delivery_stats():
+    """Print the rolling delivery statistics, kept up to date by the delivery engines rather than read from the log."""
+    paused_since = email_queue.delivery_paused()
+    print(f"Pending: {email_queue.depth()}, sending: {email_queue.count_leased()}"
+          + (f", paused for {time.time() - paused_since:.0f}s" if paused_since is not None else ""))
+    windows = stats_summary(DASHBOARD_TOP)
+    print(f"{'Window':<8}{'Sent':>9}{'Deferred':>10}{'Failed':>9}{'Sent/s':>9}{'Failed %':>10}"
+          f"{'p50':>9}{'p90':>9}{'p99':>9}{'Accept→sent p50':>17}{'p99':>9}")
+    for window in windows:
+        delivery, queued = window["delivery_seconds"], window["queued_seconds"]
+        print(f"{window['window']:<8}{window['sent']:>9}{window['deferred']:>10}{window['failed']:>9}"
+              f"{window['per_second']['sent']:>9.2f}{window['failure_rate']:>10.1%}"
+              f"{format_latency(delivery['p50']):>9}{format_latency(delivery['p90']):>9}"
+              f"{format_latency(delivery['p99']):>9}{format_latency(queued['p50']):>17}{format_latency(queued['p99']):>9}")
+    # The busiest senders, domains and errors of the middle window
+    window = windows[len(windows) // 2]
+    for title, key in (("Senders", "senders"), ("Recipient domains", "domains"), ("Errors", "errors")):
+        print(f"{title} (last {window['window']}):")
+        if not window[key]:
+            print("  none")
+        for row in window[key]:
+            print(f"  {row['name'] or '(none)'}: sent {row['sent']}, deferred {row['deferred']}, failed {row['failed']}")
+
+def live_delivery_stats():
+    """Redraw the delivery statistics every few seconds until Ctrl-C."""
+    try:
+        while True:
+            # Clear the screen and start at the top
+            print("\033[H\033[J", end="")
+            print_section("Live Delivery Statistics")
+            print_delivery_stats()
+            print(f"Refreshing every {DASHBOARD_REFRESH_SECONDS}s; press Ctrl-C to go back.")
+            time.sleep(DASHBOARD_REFRESH_SECONDS)
+    except KeyboardInterrupt:
+        print()
 
 def view_active_connections():
     connections = psutil.net_connections(kind='inet')
@@ -84,30 +173,43 @@ def view_active_connections():
         print(f"{conn.laddr} -> {conn.raddr} | Status: {conn.status}")
 
 def email_queue_length():
-    print(f"Current email queue length: {len(email_status)}")
+    print(f"Current email queue length: {email_queue.depth()}")
 
 def clear_pending_emails():
-    for req_id in list(email_status.keys()):
-        if "failed" in email_status[req_id] or email_status[req_id] == "pending":
-            del email_status[req_id]
+    email_queue.delete(("queued", "deferred", "failed"))
     print("All pending emails cleared.")
 
 def view_email_queue():
-    if not email_status:
-        print("No emails in the queue.")
-    else:
-        for req_id, status in email_status.items():
-            print(f"Request ID: {req_id}, Status: {status}")
+    print_jobs(None, "No emails in the queue.")
 
 def export_email_logs():
-    try:
-        with open(CSV_FILE_PATH, "r") as csv_file:
-            logs = csv_file.read()
-        with open(f"exported_email_logs_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv", "w") as export_file:
-            export_file.write(logs)
-        print("Logs exported successfully.")
-    except FileNotFoundError:
+    """Stream the log, or the part of it matching the filters asked for, to a new file."""
+    if not os.path.exists(CSV_FILE_PATH):
         print("Log file not found.")
+        return
+    print("Leave a filter empty to export everything.")
+    try:
+        start = input("From date (YYYY-MM-DD [HH:MM:SS]): ").strip()
+        start = parse_date_bound(start) if start else None
+        end = input("To date (YYYY-MM-DD [HH:MM:SS]): ").strip()
+        end = parse_date_bound(end) if end else None
+    except ValueError as e:
+        print(e)
+        return
+    statuses = [status.strip() for status in input("Statuses (e.g. sent,failed): ").split(",") if status.strip()]
+    domain = input("Recipient domain: ").strip() or None
+    sender = input("Sender email: ").strip() or None
+    output_format = input(f"Format ({'/'.join(EXPORT_FORMATS)}) [csv]: ").strip().lower() or "csv"
+    if output_format not in EXPORT_FORMATS:
+        print("Unknown format.")
+        return
+    compress = input("Compress with gzip? (y/n) [n]: ").strip().lower() == "y"
+
+    filename = export_filename(output_format, compress)
+    with open(filename, "wb") as export_file:
+        for chunk in export_log(CSV_FILE_PATH, output_format, compress, start, end, statuses, domain, sender):
+            export_file.write(chunk)
+    print(f"Logs exported to {filename}.")
 
 def server_health_check():
     cpu = psutil.cpu_percent()
@@ -115,9 +217,81 @@ def server_health_check():
     print(f"CPU Usage: {cpu}%")
     print(f"Memory Usage: {memory.percent}%")
 
+def view_smtp_pool_stats():
+    stats = smtp_pool.get_stats()
+    print(f"Sessions opened: {stats['sessions_opened']}, reused: {stats['sessions_reused']}, idle: {stats['idle_sessions']}")
+    print(f"Reuse rate: {stats['reuse_rate']:.1%}")
+    print(f"Handshake time spent: {stats['handshake_seconds_total']:.2f}s, saved: {stats['handshake_seconds_saved']:.2f}s")
+    print(f"Evicted idle: {stats['sessions_evicted_idle']}, retired: {stats['sessions_retired']}, "
+          f"failed health checks: {stats['health_check_failures']}, reconnects: {stats['reconnects']}")
+
+def view_sender_accounts():
+    accounts = sender_pool.get_stats()
+    if not accounts:
+        print("No sending accounts. Add them to data.csv or set the email credentials.")
+    for account in accounts:
+        per_minute = account["per_minute"] or "unlimited"
+        per_day = account["per_day"] or "unlimited"
+        print(f"{account['email']} (weight {account['weight']}): sent {account['sent']}, "
+              f"last minute {account['last_minute']}/{per_minute}, last day {account['last_day']}/{per_day}")
+        if account["cooling_off"]:
+            print(f"  Throttled {account['throttled']} times, back in rotation in {account['cooling_off']:.0f}s")
+
+def view_circuit_breakers():
+    breakers = circuit_breakers.get_stats()
+    if not breakers:
+        print("No SMTP connections made yet.")
+    for breaker in breakers:
+        line = f"{breaker['name']}: {breaker['state']}, failures in a row: {breaker['failures']}, tripped {breaker['trips']} times"
+        if breaker["retry_in"]:
+            line += f", probing in {breaker['retry_in']:.0f}s"
+        print(line)
+        if breaker["last_error"]:
+            print(f"  Last error: {breaker['last_error']}")
+
+def profile_server():
+    """Sample every thread for a while, save the stacks for a flame graph and show where the time went."""
+    try:
+        seconds = float(input("Seconds to profile [10]: ").strip() or 10)
+    except ValueError:
+        print("Invalid number of seconds.")
+        return
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        print(f"Profile for more than 0 and at most {PROFILE_MAX_SECONDS:g} seconds.")
+        return
+    print(f"Profiling for {seconds:g}s...")
+    stacks = profiler.profile(seconds)
+    if stacks is None:
+        print("A profile is already running.")
+        return
+    filename = f"profile_{time.strftime('%Y%m%d%H%M%S')}.folded"
+    with open(filename, "w") as profile_file:
+        profile_file.write(stacks)
+    print(f"{profiler.samples} samples; collapsed stacks saved to {filename}.")
+    print("Most often running:")
+    for function, share in profiler.top_functions():
+        print(f"  {share:6.1%}  {function}")
+
+def view_request_traces(count=10):
+    """Show the newest request traces, and change how many requests are traced."""
+    stats = tracer.get_stats()
+    print(f"Tracing {stats['sample_rate']:.2%} of accepted emails; {stats['open']} traces open, {stats['finished']} finished.")
+    rate = input("New sample rate from 0 to 1 (leave empty to keep): ").strip()
+    if rate:
+        try:
+            tracer.set_rate(float(rate))
+        except ValueError:
+            print("Invalid sample rate.")
+        print(f"Tracing {tracer.rate:.2%} of accepted emails.")
+    traces = recent_traces(count)
+    if not traces:
+        print("No finished traces yet.")
+    for trace in traces:
+        print(f"{trace['request_id']}: {trace['status']} in {trace['duration'] * 1000:.1f}ms")
+        print("  " + " | ".join(f"{span['name']} {span['duration'] * 1000:.1f}ms" for span in trace["spans"]))
+
 def reset_email_queue():
-    global email_status
-    email_status.clear()
+    email_queue.delete()
     print("Email queue has been reset.")
 
 def set_email_credentials():
@@ -166,15 +340,17 @@ def interactive_terminal():
                 print("3. View email queue 📧")
                 print("4. View active network connections 🌐")
                 print("5. Export email logs 📤")
-                print("6. Go back 🔙")
+                print("6. Live delivery statistics 📈")
+                print("7. Go back 🔙")
 
-                home_choice = input("Select an option (1-6): ").strip()
+                home_choice = input("Select an option (1-7): ").strip()
 
                 if home_choice == "1":
-                    logs = get_latest_logs()
+                    if not os.path.exists(CSV_FILE_PATH):
+                        print("Log file not found.")
+                        continue
                     print_section("Recent Email Logs")
-                    for log in logs:
-                        print(f"Recipient: {log['Recipient']}, Date: {log['Date']}, Status: {log['Status']}")
+                    print_logs(get_latest_logs())
                 elif home_choice == "2":
                     check_pending_emails()
                 elif home_choice == "3":
@@ -184,6 +360,8 @@ def interactive_terminal():
                 elif home_choice == "5":
                     export_email_logs()
                 elif home_choice == "6":
+                    live_delivery_stats()
+                elif home_choice == "7":
                     break
                 else:
                     print("Invalid choice, please try again.")
@@ -201,9 +379,15 @@ def interactive_terminal():
                 print("8. Show email credentials")
                 print("9. View all logs")
                 print("10. Restart server")
-                print("11. Go back")
+                print("11. SMTP connection pool stats")
+                print("12. Sending accounts")
+                print("13. Circuit breakers")
+                print("14. Profile the server")
+                print("15. Request traces")
+                print("16. Drain email sending")
+                print("17. Go back")
 
-                settings_choice = input("Select an option (1-11): ").strip()
+                settings_choice = input("Select an option (1-17): ").strip()
 
                 if settings_choice == "1":
                     change_ip_port()
@@ -222,13 +406,25 @@ def interactive_terminal():
                 elif settings_choice == "8":
                     show_email_credentials()
                 elif settings_choice == "9":
-                    logs = view_all_logs()
-                    print_section("All Email Logs")
-                    for log in logs:
-                        print(f"Recipient: {log['Recipient']}, Date: {log['Date']}, Status: {log['Status']}")
+                    if not os.path.exists(CSV_FILE_PATH):
+                        print("Log file not found.")
+                        continue
+                    page_through_logs()
                 elif settings_choice == "10":
                     restart_server()
                 elif settings_choice == "11":
+                    view_smtp_pool_stats()
+                elif settings_choice == "12":
+                    view_sender_accounts()
+                elif settings_choice == "13":
+                    view_circuit_breakers()
+                elif settings_choice == "14":
+                    profile_server()
+                elif settings_choice == "15":
+                    view_request_traces()
+                elif settings_choice == "16":
+                    drain_email_sending()
+                elif settings_choice == "17":
                     break
                 else:
                     print("Invalid choice, please try again.")
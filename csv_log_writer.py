@@ -0,0 +1,157 @@
+import os
+import csv
+import io
+import queue
+import threading
+import time
+import atexit
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: only one process writes the log there
+    fcntl = None
+
+# Log writer settings
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", 0.5))
+LOG_FSYNC = os.getenv("LOG_FSYNC", "never")  # "never", "batch" (after every write) or "interval"
+LOG_FSYNC_INTERVAL = float(os.getenv("LOG_FSYNC_INTERVAL", 5))
+LOG_ROTATE_BYTES = int(os.getenv("LOG_ROTATE_BYTES", 0))  # 0 disables size-based rotation
+LOG_ROTATE_SECONDS = float(os.getenv("LOG_ROTATE_SECONDS", 0))  # 0 disables time-based rotation
+LOG_BATCH_SIZE = 1000
+
+_STOP = object()
+
+
+class CSVLogWriter:
+    """Background writer that batches CSV rows from every worker into buffered, group-committed writes.
+
+    Several processes may append to the same log: each batch is written under an exclusive lock on the
+    file, and a writer that finds the log rotated by another process reopens it before writing.
+    """
+
+    def __init__(self, path, header, flush_interval=LOG_FLUSH_INTERVAL, fsync=LOG_FSYNC,
+                 rotate_bytes=LOG_ROTATE_BYTES, rotate_seconds=LOG_ROTATE_SECONDS):
+        self.path = path
+        self.header = header
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._file = None
+        self._opened_at = 0.0
+        self._last_fsync = 0.0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="csv-log-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def write(self, row):
+        """Queue a row; it reaches the file on the next flush."""
+        if self._thread is None:
+            self.start()
+        self._queue.put(row)
+
+    def flush(self, timeout=None):
+        """Block until every row queued before this call has been written."""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=10):
+        """Write out everything still queued and stop the writer thread."""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def _open(self):
+        self._file = open(self.path, mode="a", newline='')
+        self._opened_at = time.time()
+
+    def _lock(self):
+        """Lock the log against other processes, following it to its new file if one of them rotated it."""
+        while True:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                replaced = os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+            except FileNotFoundError:
+                replaced = True
+            if not replaced:
+                return
+            # Closing the old file releases its lock
+            self._file.close()
+            self._open()
+
+    def _rotate_if_needed(self):
+        too_big = self.rotate_bytes and self._file.tell() >= self.rotate_bytes
+        too_old = self.rotate_seconds and time.time() - self._opened_at >= self.rotate_seconds
+        if not (too_big or too_old):
+            return
+        self._file.close()
+        os.replace(self.path, f"{self.path}.{datetime.now().strftime('%Y%m%d%H%M%S%f')}")
+        self._open()
+
+    def _write_batch(self, rows):
+        # Keep every row on one physical line so the log can be read backwards and indexed by offset
+        rows = [[str(value).replace("\r", " ").replace("\n", " ") for value in row] for row in rows]
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        if fcntl:
+            self._lock()
+        try:
+            if os.fstat(self._file.fileno()).st_size == 0:
+                csv.writer(self._file).writerow(self.header)
+            self._file.write(buffer.getvalue())
+            self._file.flush()
+            now = time.monotonic()
+            if self.fsync == "batch" or (self.fsync == "interval" and now - self._last_fsync >= LOG_FSYNC_INTERVAL):
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+            self._rotate_if_needed()
+        finally:
+            if fcntl:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _run(self):
+        self._open()
+        while True:
+            rows, waiters, stop = [], [], False
+            # Wait for the first item, then gather whatever else arrives within the flush interval
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    rows.append(item)
+                if stop or waiters or len(rows) >= LOG_BATCH_SIZE:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if rows:
+                try:
+                    self._write_batch(rows)
+                except Exception as e:
+                    print(f"Failed to write {len(rows)} log rows to {self.path}: {e}")
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                self._file.close()
+                return
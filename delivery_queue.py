@@ -0,0 +1,708 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+
+from delivery_scheduler import DISPATCH_RETRY_SECONDS, DeliveryScheduler, Envelope, job_outcomes
+from delivery_stats import delivery_stats
+from flow_control import PoolSizer
+from lifecycle import delivery_lifecycle
+from metrics import DELIVERIES_IN_PROGRESS, EMAIL_DELIVERIES, SMTP_PHASE_SECONDS
+from retry_scheduler import RetryScheduler
+from status_store import EmailState, StatusRecord, email_statuses, parse_status
+from tracing import tracer
+
+# Durable queue settings
+QUEUE_DB_PATH = os.getenv("QUEUE_DB_PATH", "email_queue.db")
+QUEUE_LEASE_SECONDS = float(os.getenv("QUEUE_LEASE_SECONDS", 300))
+QUEUE_COMMIT_BATCH = int(os.getenv("QUEUE_COMMIT_BATCH", 500))
+QUEUE_COMMIT_INTERVAL = float(os.getenv("QUEUE_COMMIT_INTERVAL", 0.005))
+QUEUE_RETENTION_SECONDS = float(os.getenv("QUEUE_RETENTION_SECONDS", 7 * 24 * 3600))
+# Delivery threads: DELIVERY_WORKERS to start with and at least, up to DELIVERY_WORKERS_MAX as the backlog grows
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", 5))
+DELIVERY_WORKERS_MAX = int(os.getenv("DELIVERY_WORKERS_MAX", 50))
+
+# How often an idle dispatcher checks for jobs committed by other processes
+QUEUE_POLL_INTERVAL = float(os.getenv("QUEUE_POLL_INTERVAL", 0.05))
+
+# Status transitions are kept this long for SSE replays and webhook retries
+STATUS_EVENT_RETENTION_SECONDS = float(os.getenv("STATUS_EVENT_RETENTION_SECONDS", 24 * 3600))
+
+# Job states; "queued", "leased" and "deferred" (waiting for a retry) are pending, the rest are final
+PENDING_STATES = ("queued", "leased", "deferred")
+
+
+def job_state(state):
+    """The queue state for a state name of the status API, which calls leased jobs "sending"."""
+    return "leased" if state == "sending" else state
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    request_id TEXT PRIMARY KEY,
+    payload TEXT,
+    domain TEXT,
+    account TEXT,
+    tag TEXT,
+    webhook TEXT,
+    state TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, available_at);
+"""
+
+# Idempotency keys of accepted sends (see idempotency.py), claimed in the same transaction as the job,
+# so a key is only ever used once per window whichever process accepts the send
+IDEMPOTENCY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key BLOB PRIMARY KEY,
+    request_id TEXT NOT NULL,
+    fingerprint BLOB NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idempotency_keys_by_expiry ON idempotency_keys (expires_at);
+"""
+
+# Settings shared by every process using the queue, such as whether delivery is paused
+SETTINGS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Columns added after the first release, for databases created before them
+MIGRATIONS = {
+    "domain": "ALTER TABLE jobs ADD COLUMN domain TEXT",
+    "account": "ALTER TABLE jobs ADD COLUMN account TEXT",
+    "tag": "ALTER TABLE jobs ADD COLUMN tag TEXT",
+    "webhook": "ALTER TABLE jobs ADD COLUMN webhook TEXT",
+}
+
+# Every status change of a job is appended to status_events by a trigger, in the same transaction, so
+# the event IDs are a cursor any process can follow (see status_feed.py and webhooks.py)
+EVENTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS status_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    request_id TEXT NOT NULL,
+    tag TEXT,
+    webhook TEXT,
+    state TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS status_events_with_webhook ON status_events (id) WHERE webhook IS NOT NULL;
+CREATE TABLE IF NOT EXISTS cursors (
+    name TEXT PRIMARY KEY,
+    event_id INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS jobs_inserted AFTER INSERT ON jobs BEGIN
+    INSERT INTO status_events (request_id, tag, webhook, state, status, attempts, at)
+    VALUES (NEW.request_id, NEW.tag, NEW.webhook, NEW.state, NEW.status, NEW.attempts, NEW.updated_at);
+END;
+CREATE TRIGGER IF NOT EXISTS jobs_status_changed AFTER UPDATE OF state, status ON jobs
+WHEN NEW.state IS NOT OLD.state OR NEW.status IS NOT OLD.status BEGIN
+    INSERT INTO status_events (request_id, tag, webhook, state, status, attempts, at)
+    VALUES (NEW.request_id, NEW.tag, NEW.webhook, NEW.state, NEW.status, NEW.attempts, NEW.updated_at);
+END;
+"""
+
+# Indexes for status queries: by state (e.g. failed in the last hour) and by campaign tag. They are
+# created after the migrations, since older databases only get the tag column from those
+QUERY_INDEXES = """
+CREATE INDEX IF NOT EXISTS jobs_by_state_updated ON jobs (state, updated_at);
+CREATE INDEX IF NOT EXISTS jobs_by_tag ON jobs (tag, state, updated_at) WHERE tag IS NOT NULL;
+"""
+
+# Largest number of request IDs looked up in one query (SQLite limits the number of parameters)
+LOOKUP_CHUNK = 900
+
+EVENT_COLUMNS = "id, request_id, tag, state, status, attempts, at"
+RECORD_COLUMNS = "state, status, attempts, created_at, updated_at"
+
+
+def event_dict(row):
+    """A status_events row as the dict sent to SSE clients and webhooks; leased jobs are "sending"."""
+    event_id, request_id, tag, state, status, attempts, at = row
+    return {"id": event_id, "request_id": request_id, "tag": tag, "state": "sending" if state == "leased" else state,
+            "status": status, "attempts": attempts, "at": at}
+
+
+def _record_from_row(row):
+    state, status, attempts, created_at, updated_at = row
+    record = StatusRecord(EmailState.SENDING if state == "leased" else EmailState[state.upper()], created_at)
+    record.attempts = attempts
+    record.updated_at = updated_at
+    # "failed (reason)" and "deferred (reason)" carry the last error
+    record.last_error = status.partition(" (")[2][:-1] or None
+    return record
+
+
+def recipient_domain(recipient):
+    """Lower-cased domain part of an email address."""
+    return recipient.rsplit("@", 1)[-1].strip().lower()
+
+
+class Job:
+    """A leased delivery job."""
+
+    __slots__ = ("request_id", "payload", "attempts", "domain", "account", "created_at", "sender", "envelope_key",
+                 "buffered_at", "trace")
+
+    def __init__(self, request_id, payload, attempts, domain=None, account=None, created_at=None):
+        self.request_id = request_id
+        self.payload = payload
+        self.attempts = attempts
+        self.created_at = created_at
+        self.domain = domain or recipient_domain(payload["recipient"])
+        self.account = account or payload.get("sender_email")
+        # Set by the scheduler; `account` too, unless the job was queued with a fixed sender
+        self.sender = None
+        self.envelope_key = None
+        self.buffered_at = None
+        # Set by the tracer if the email is traced
+        self.trace = None
+
+
+class DeliveryQueue:
+    """SQLite-backed (WAL) delivery queue with group-committed enqueues and leased dequeues.
+
+    Every state change is mirrored into `statuses` so status lookups rarely need the database.
+    """
+
+    def __init__(self, path=QUEUE_DB_PATH, statuses=email_statuses):
+        self.path = path
+        self.statuses = statuses
+        self.lease_seconds = QUEUE_LEASE_SECONDS
+        self._local = threading.local()
+        self._work_available = threading.Condition()
+        self._pending = []
+        self._pending_lock = threading.Condition()
+        self._committer = None
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def _connection(self):
+        """Return this thread's connection, creating the schema on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(SCHEMA)
+                    columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+                    for column, statement in MIGRATIONS.items():
+                        if column not in columns:
+                            conn.execute(statement)
+                    conn.executescript(EVENTS_SCHEMA)
+                    conn.executescript(IDEMPOTENCY_SCHEMA)
+                    conn.executescript(SETTINGS_SCHEMA)
+                    conn.executescript(QUERY_INDEXES)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def _notify_workers(self):
+        with self._work_available:
+            self._work_available.notify_all()
+
+    def _claim_keys_locked(self, conn, jobs, keys, now):
+        """Claim the idempotency keys of the jobs that have one; returns {request_id: (request ID, fingerprint)}
+        of the send that already holds the key, for the jobs whose key was taken."""
+        claims, repeats = {}, []
+        for request_id, _ in jobs:
+            key = keys.get(request_id)
+            if key is None:
+                continue
+            if key.key in claims:
+                repeats.append((request_id, key.key))
+            else:
+                claims[key.key] = (key.key, request_id, key.fingerprint, now + key.window, now)
+        # A key that is held and hasn't expired is left alone. Nearly all keys are new, so the holders only
+        # need looking up when fewer rows than keys were written
+        cursor = conn.executemany(
+            "INSERT INTO idempotency_keys (key, request_id, fingerprint, expires_at) VALUES (?1, ?2, ?3, ?4) "
+            "ON CONFLICT (key) DO UPDATE SET request_id = ?2, fingerprint = ?3, expires_at = ?4 WHERE expires_at <= ?5",
+            list(claims.values()),
+        )
+        holders = {key: (claim[1], claim[2]) for key, claim in claims.items()}
+        duplicates = {}
+        if cursor.rowcount < len(claims):
+            claimed = list(claims)
+            for start in range(0, len(claimed), LOOKUP_CHUNK):
+                chunk = claimed[start:start + LOOKUP_CHUNK]
+                rows = conn.execute(
+                    f"SELECT key, request_id, fingerprint FROM idempotency_keys WHERE key IN ({', '.join('?' for _ in chunk)})",
+                    chunk,
+                )
+                for key, request_id, fingerprint in rows:
+                    if request_id != claims[key][1]:
+                        holders[key] = duplicates[claims[key][1]] = (request_id, fingerprint)
+        # Later jobs of this batch with the same key as an earlier one
+        for request_id, key in repeats:
+            duplicates[request_id] = holders[key]
+        return duplicates
+
+    def _insert(self, jobs, keys=None):
+        """Insert (request_id, payload) pairs in a single transaction.
+
+        `keys` maps request IDs to their IdempotencyKey; a job whose key is already held isn't inserted.
+        Returns {request_id: (request ID, fingerprint) of the key's holder} for those.
+        """
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            duplicates = self._claim_keys_locked(conn, jobs, keys, now) if keys else {}
+            if duplicates:
+                jobs = [job for job in jobs if job[0] not in duplicates]
+            conn.executemany(
+                "INSERT INTO jobs (request_id, payload, domain, account, tag, webhook, state, status, available_at, "
+                "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, 'queued', 'queued', ?, ?, ?)",
+                [(request_id, json.dumps(payload), recipient_domain(payload["recipient"]), payload.get("sender_email"),
+                  payload.get("tag"), payload.get("webhook_url"), now, now, now) for request_id, payload in jobs],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        for request_id, _ in jobs:
+            self.statuses.set(request_id, EmailState.QUEUED)
+        self._notify_workers()
+        return duplicates
+
+    def _commit_loop(self):
+        """Commit concurrently enqueued jobs together, then wake every caller in the batch."""
+        while True:
+            with self._pending_lock:
+                while not self._pending:
+                    self._pending_lock.wait()
+            # Give concurrent requests a moment to join the batch
+            time.sleep(QUEUE_COMMIT_INTERVAL)
+            with self._pending_lock:
+                batch = self._pending[:QUEUE_COMMIT_BATCH]
+                del self._pending[:QUEUE_COMMIT_BATCH]
+            keys = {request_id: key for request_id, _, key, _ in batch if key is not None}
+            duplicates = {}
+            try:
+                duplicates = self._insert([(request_id, payload) for request_id, payload, _, _ in batch], keys)
+                error = None
+            except Exception as e:
+                error = e
+            for request_id, _, _, waiter in batch:
+                waiter["error"] = error
+                waiter["duplicate"] = duplicates.get(request_id)
+                waiter["done"].set()
+
+    def enqueue(self, request_id, payload, key=None):
+        """Durably queue one job; returns once the batch it joined has been committed.
+
+        With an IdempotencyKey that is already held the job isn't queued; returns (request ID, fingerprint)
+        of the holder then, else None.
+        """
+        waiter = {"done": threading.Event(), "error": None, "duplicate": None}
+        with self._pending_lock:
+            if self._committer is None:
+                self._committer = threading.Thread(target=self._commit_loop, name="queue-committer", daemon=True)
+                self._committer.start()
+            self._pending.append((request_id, payload, key, waiter))
+            self._pending_lock.notify()
+        waiter["done"].wait()
+        if waiter["error"] is not None:
+            raise waiter["error"]
+        return waiter["duplicate"]
+
+    def enqueue_many(self, jobs, keys=None):
+        """Durably queue a list of (request_id, payload) pairs in one commit.
+
+        `keys` maps request IDs to IdempotencyKeys; returns {request_id: (request ID, fingerprint) of the
+        holder} for the jobs not queued because their key is held.
+        """
+        return self._insert(jobs, keys) if jobs else {}
+
+    def lease(self, owner, limit=1, lease_seconds=None, exclude_domains=()):
+        """Claim up to `limit` ready jobs for `owner`; expired leases are claimable again.
+
+        Jobs for `exclude_domains` are skipped, so a caller can stop pulling work for saturated domains.
+        """
+        now = time.time()
+        lease_seconds = lease_seconds or self.lease_seconds
+        exclude = ""
+        if exclude_domains:
+            exclude = f" AND COALESCE(domain, '') NOT IN ({', '.join('?' for _ in exclude_domains)})"
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT request_id, payload, attempts, domain, account, created_at FROM jobs "
+                "WHERE ((state = 'queued' AND available_at <= ?) OR (state = 'leased' AND lease_expires < ?))"
+                f"{exclude} ORDER BY available_at LIMIT ?",
+                (now, now, *exclude_domains, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET state = 'leased', status = 'sending', lease_owner = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE request_id = ?",
+                [(owner, now + lease_seconds, now, row[0]) for row in rows],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        for request_id, _, attempts, _, _, _ in rows:
+            self.statuses.set(request_id, EmailState.SENDING, attempts=attempts + 1)
+        return [Job(request_id, json.loads(payload), attempts + 1, domain, account, created_at)
+                for request_id, payload, attempts, domain, account, created_at in rows]
+
+    def extend_leases(self, request_ids, lease_seconds=None):
+        """Push back the lease expiry of jobs a process is still holding."""
+        expires = time.time() + (lease_seconds or self.lease_seconds)
+        self._connection().executemany(
+            "UPDATE jobs SET lease_expires = ? WHERE request_id = ? AND state = 'leased'",
+            [(expires, request_id) for request_id in request_ids],
+        )
+
+    def complete(self, request_id, status):
+        """Acknowledge a leased job with its final status and drop its payload."""
+        state, error = parse_status(status)
+        self._connection().execute(
+            "UPDATE jobs SET state = ?, status = ?, payload = NULL, lease_owner = NULL, lease_expires = NULL, "
+            "updated_at = ? WHERE request_id = ?",
+            (state.name.lower(), status, time.time(), request_id),
+        )
+        self.statuses.set(request_id, state, error)
+
+    def release(self, request_id, delay=0):
+        """Give a leased or deferred job back to the queue, optionally not before `delay` seconds."""
+        now = time.time()
+        self._connection().execute(
+            "UPDATE jobs SET state = 'queued', status = 'queued', lease_owner = NULL, lease_expires = NULL, "
+            "available_at = ?, updated_at = ? WHERE request_id = ?",
+            (now + delay, now, request_id),
+        )
+        self.statuses.set(request_id, EmailState.DEFERRED if delay else EmailState.QUEUED)
+        self._notify_workers()
+
+    def unlease(self, request_ids):
+        """Give leased jobs that were never attempted back to the queue, without counting the lease as an attempt."""
+        now = time.time()
+        self._connection().executemany(
+            "UPDATE jobs SET state = 'queued', status = 'queued', lease_owner = NULL, lease_expires = NULL, "
+            "attempts = attempts - 1, updated_at = ? WHERE request_id = ? AND state = 'leased'",
+            [(now, request_id) for request_id in request_ids],
+        )
+        for request_id in request_ids:
+            self.statuses.set(request_id, EmailState.QUEUED)
+        self._notify_workers()
+
+    def defer(self, request_id, delay, error, attempted=True):
+        """Park a leased job until a retry is due; it stays out of reach of lease() until released.
+
+        available_at is kept so that, after a restart, recover() still honours the backoff, and so is
+        lease_owner, so that the job can be recovered if the process holding its retry timer dies.
+        With attempted=False the lease doesn't count as a delivery attempt.
+        """
+        now = time.time()
+        self._connection().execute(
+            "UPDATE jobs SET state = 'deferred', status = ?, lease_expires = NULL, "
+            "available_at = ?, updated_at = ?, attempts = attempts - ? WHERE request_id = ?",
+            (f"deferred ({error})", now + delay, now, 0 if attempted else 1, request_id),
+        )
+        self.statuses.set(request_id, EmailState.DEFERRED, error)
+
+    def recover(self, owner_prefix=None):
+        """Requeue jobs left leased or deferred by a previous run; call once at startup.
+
+        With `owner_prefix`, only the jobs of the lease owners it names are requeued, e.g. those of a
+        delivery process that died while other processes keep delivering.
+        """
+        query = ("UPDATE jobs SET state = 'queued', status = 'queued', lease_owner = NULL, lease_expires = NULL, "
+                 "updated_at = ? WHERE state IN ('leased', 'deferred')")
+        params = (time.time(),)
+        if owner_prefix:
+            query += " AND substr(lease_owner, 1, ?) = ?"
+            params += (len(owner_prefix), owner_prefix)
+        cursor = self._connection().execute(query, params)
+        if cursor.rowcount:
+            self._notify_workers()
+        return cursor.rowcount
+
+    def purge(self, older_than=QUEUE_RETENTION_SECONDS, events_older_than=STATUS_EVENT_RETENTION_SECONDS):
+        """Delete finished jobs last updated more than `older_than` seconds ago, and old status events."""
+        conn = self._connection()
+        cursor = conn.execute(
+            "DELETE FROM jobs WHERE state IN ('sent', 'failed') AND updated_at < ?",
+            (time.time() - older_than,),
+        )
+        # Events are appended in time order, so the old ones are an ID range
+        first_kept = conn.execute(
+            "SELECT id FROM status_events WHERE at >= ? ORDER BY id LIMIT 1", (time.time() - events_older_than,)
+        ).fetchone()
+        conn.execute("DELETE FROM status_events WHERE id < ?", (first_kept[0] if first_kept else 2 ** 62,))
+        conn.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (time.time(),))
+        return cursor.rowcount
+
+    def status_events(self, after_id, tag=None, limit=1000, webhooks_only=False):
+        """Up to `limit` status events with IDs above `after_id`, oldest first, as (event dict, webhook URL) pairs."""
+        query = f"SELECT {EVENT_COLUMNS}, webhook FROM status_events WHERE id > ?"
+        params = [after_id]
+        if tag is not None:
+            query += " AND tag = ?"
+            params.append(tag)
+        if webhooks_only:
+            query += " AND webhook IS NOT NULL"
+        rows = self._connection().execute(query + " ORDER BY id LIMIT ?", (*params, limit)).fetchall()
+        return [(event_dict(row[:-1]), row[-1]) for row in rows]
+
+    def last_event_id(self):
+        return self._connection().execute("SELECT COALESCE(MAX(id), 0) FROM status_events").fetchone()[0]
+
+    def get_cursor(self, name):
+        """The saved position of a status event consumer, or None."""
+        row = self._connection().execute("SELECT event_id FROM cursors WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, name, event_id):
+        self._connection().execute(
+            "INSERT INTO cursors (name, event_id) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET event_id = excluded.event_id",
+            (name, event_id),
+        )
+
+    def pause_delivery(self):
+        """Stop every delivery process from starting new emails; sends are still accepted and queued."""
+        self._connection().execute(
+            "INSERT INTO settings (name, value) VALUES ('delivery_paused', ?) ON CONFLICT (name) DO NOTHING",
+            (str(time.time()),),
+        )
+
+    def resume_delivery(self):
+        self._connection().execute("DELETE FROM settings WHERE name = 'delivery_paused'")
+
+    def delivery_paused(self):
+        """The time delivery was paused, or None if it isn't."""
+        row = self._connection().execute("SELECT value FROM settings WHERE name = 'delivery_paused'").fetchone()
+        return float(row[0]) if row else None
+
+    def count_leased(self, owner=None):
+        """Emails being delivered: leased by `owner`, or by anyone."""
+        query, params = "SELECT COUNT(*) FROM jobs WHERE state = 'leased'", ()
+        if owner:
+            query, params = query + " AND lease_owner = ?", (owner,)
+        return self._connection().execute(query, params).fetchone()[0]
+
+    def data_version(self):
+        """A number that changes whenever another connection commits to the database."""
+        return self._connection().execute("PRAGMA data_version").fetchone()[0]
+
+    def get_status(self, request_id):
+        """Return the status string for a request, or None if it is unknown."""
+        row = self._connection().execute("SELECT status FROM jobs WHERE request_id = ?", (request_id,)).fetchone()
+        return row[0] if row else None
+
+    def get_record(self, request_id):
+        """Return a StatusRecord rebuilt from the queue, or None if the request is unknown."""
+        row = self._connection().execute(
+            f"SELECT {RECORD_COLUMNS} FROM jobs WHERE request_id = ?", (request_id,)
+        ).fetchone()
+        return None if row is None else _record_from_row(row)
+
+    def get_records(self, request_ids):
+        """Return {request_id: StatusRecord} for those of `request_ids` that are in the queue."""
+        records = {}
+        conn = self._connection()
+        for start in range(0, len(request_ids), LOOKUP_CHUNK):
+            chunk = request_ids[start:start + LOOKUP_CHUNK]
+            rows = conn.execute(
+                f"SELECT request_id, {RECORD_COLUMNS} FROM jobs WHERE request_id IN ({', '.join('?' for _ in chunk)})",
+                chunk,
+            )
+            for row in rows:
+                records[row[0]] = _record_from_row(row[1:])
+        return records
+
+    def _filter(self, states=None, tag=None, updated_since=None):
+        """WHERE clause and parameters selecting jobs by state, tag and last update; each is served by an index."""
+        conditions, params = [], []
+        if states:
+            conditions.append(f"state IN ({', '.join('?' for _ in states)})")
+            params.extend(states)
+        if tag is not None:
+            conditions.append("tag = ?")
+            params.append(tag)
+        if updated_since is not None:
+            conditions.append("updated_at >= ?")
+            params.append(updated_since)
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+    def list_jobs(self, states=None, tag=None, updated_since=None, limit=None, newest=False):
+        """Yield (request_id, status) pairs, optionally only for the given states, tag and recent updates;
+        oldest first, or newest first if `newest`."""
+        where, params = self._filter(states, tag, updated_since)
+        query = f"SELECT request_id, status FROM jobs{where} ORDER BY created_at{' DESC' if newest else ''}"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self._connection().execute(query, params)
+
+    def count_jobs(self, states=None, tag=None, updated_since=None):
+        """Number of jobs in the given states, with the given tag and updated since the given time."""
+        where, params = self._filter(states, tag, updated_since)
+        return self._connection().execute(f"SELECT COUNT(*) FROM jobs{where}", params).fetchone()[0]
+
+    def ready_count(self):
+        """Number of jobs that are deliverable now or being delivered."""
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'leased' OR (state = 'queued' AND available_at <= ?)",
+            (time.time(),),
+        ).fetchone()[0]
+
+    def depth(self):
+        """Number of jobs waiting for or undergoing delivery."""
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'leased', 'deferred')"
+        ).fetchone()[0]
+
+    def delete(self, states=None):
+        """Delete jobs in the given states (all jobs if none are given)."""
+        if states:
+            placeholders = ", ".join("?" for _ in states)
+            conn = self._connection()
+            for request_id, _ in list(self.list_jobs(states)):
+                self.statuses.discard(request_id)
+            cursor = conn.execute(f"DELETE FROM jobs WHERE state IN ({placeholders})", tuple(states))
+        else:
+            self.statuses.clear()
+            cursor = self._connection().execute("DELETE FROM jobs")
+            # The requests the keys stood for are gone, so a retry should be queued again
+            self._connection().execute("DELETE FROM idempotency_keys")
+        return cursor.rowcount
+
+    def wait_for_work(self, timeout):
+        """Sleep until new work is queued or the timeout passes.
+
+        Enqueues in this process wake the caller at once; commits from other processes are noticed
+        through SQLite's data_version, which changes whenever another connection commits.
+        """
+        version = self.data_version()
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            with self._work_available:
+                if self._work_available.wait(min(remaining, QUEUE_POLL_INTERVAL)):
+                    return
+            if self.data_version() != version:
+                return
+
+
+def worker_loop(scheduler, retries, handler, pool):
+    """Take jobs from the scheduler and deliver them with `handler(job)` until the pool shrinks past this worker.
+
+    The handler returns the final status or raises; for an Envelope it returns the refused recipients
+    instead. Failures go to the retry scheduler, which either defers the job or fails it for good, so
+    the worker is free again immediately.
+    """
+    while not pool.retire_worker():
+        try:
+            job = scheduler.next_job(timeout=1.0)
+            if job is None:
+                continue
+            DELIVERIES_IN_PROGRESS.inc()
+            started = time.perf_counter()
+            result = error = None
+            trace_token = tracer.activate(tracer.resume(job))
+            try:
+                result = handler(job)
+            except Exception as e:
+                error = e
+            finally:
+                tracer.deactivate(trace_token)
+                DELIVERIES_IN_PROGRESS.dec()
+                # Before the outcomes are recorded: a deferred job may be due again, and leased anew, at once
+                scheduler.done(job, error)
+            elapsed = time.perf_counter() - started
+            for member, member_error in job_outcomes(job, result, error):
+                try:
+                    if member_error is not None:
+                        status = retries.handle_failure(member, member_error)
+                    else:
+                        EMAIL_DELIVERIES.inc("sent", "2xx")
+                        status = "sent" if isinstance(job, Envelope) else result
+                        scheduler.queue.complete(member.request_id, status)
+                    tracer.finish(member, status)
+                    delivery_stats.record(member, status, member_error, elapsed)
+                except Exception as e:
+                    # The job stays leased until its lease expires, and is then delivered again
+                    print(f"Failed to record the delivery of {member.request_id}: {e}")
+            SMTP_PHASE_SECONDS.observe("total", elapsed)
+            pool.sizer.observe(elapsed)
+        except Exception as e:
+            # A dead worker would never be replaced, so the pool would lose its place for good
+            print(f"Delivery worker failed, retrying in {DISPATCH_RETRY_SECONDS:g}s: {e}")
+            time.sleep(DISPATCH_RETRY_SECONDS)
+
+
+class WorkerPool:
+    """Delivery threads whose number follows the pool sizer: new threads start as it grows, and idle
+    ones exit as it shrinks."""
+
+    def __init__(self, scheduler, retries, handler, minimum, maximum):
+        self.scheduler = scheduler
+        self.retries = retries
+        self.handler = handler
+        self.sizer = PoolSizer(scheduler.queue, minimum, maximum, self.resize)
+        self.size = 0
+        self.workers = 0
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def resize(self, size):
+        with self._lock:
+            self.size = size
+            while self.workers < size:
+                self.workers += 1
+                self._started += 1
+                threading.Thread(target=worker_loop, args=(self.scheduler, self.retries, self.handler, self),
+                                 name=f"delivery-worker-{self._started}", daemon=True).start()
+
+    def retire_worker(self):
+        """True (and the caller must exit) if there are more workers than the pool should have."""
+        with self._lock:
+            if self.workers > self.size:
+                self.workers -= 1
+                return True
+            return False
+
+    def start(self):
+        self.resize(self.sizer.minimum)
+        self.sizer.start()
+
+
+def start_workers(queue, handler, record=None, count=DELIVERY_WORKERS, recover=True, max_count=DELIVERY_WORKERS_MAX):
+    """Requeue unacknowledged jobs from a previous run and start between `count` and `max_count` delivery threads.
+
+    `record(job, status)` is called for every deferred or failed attempt. Pass recover=False when other
+    processes may be delivering from the same queue; the supervisor recovers for them instead.
+    """
+    recovered = queue.recover() if recover else 0
+    scheduler = DeliveryScheduler(queue)
+    scheduler.start()
+    delivery_lifecycle.register(scheduler)
+    retries = RetryScheduler(queue, record)
+    retries.start()
+    WorkerPool(scheduler, retries, handler, count, max_count).start()
+    return recovered
+
+
+# Shared queue used by the intake endpoints, the workers and the admin terminal
+email_queue = DeliveryQueue()
@@ -0,0 +1,388 @@
+import json
+import math
+import os
+import smtplib
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from email.utils import getaddresses
+
+from sender_pool import sender_pool
+
+# Default limits for every recipient domain and sending account; a rate of 0 means unlimited
+DOMAIN_MAX_CONCURRENCY = int(os.getenv("DOMAIN_MAX_CONCURRENCY", 10))
+DOMAIN_RATE_PER_SECOND = float(os.getenv("DOMAIN_RATE_PER_SECOND", 0))
+ACCOUNT_MAX_CONCURRENCY = int(os.getenv("ACCOUNT_MAX_CONCURRENCY", 10))
+ACCOUNT_RATE_PER_SECOND = float(os.getenv("ACCOUNT_RATE_PER_SECOND", 0))
+
+# Per-domain and per-account overrides: "gmail.com:5:2,yahoo.com:2:0.5" (name:max concurrency:rate per second)
+DOMAIN_LIMITS = os.getenv("DOMAIN_LIMITS", "")
+ACCOUNT_LIMITS = os.getenv("ACCOUNT_LIMITS", "")
+
+# Delivery processes sharing the limits above (set by the supervisor); each one enforces its share
+DELIVERY_PROCESS_COUNT = int(os.getenv("DELIVERY_PROCESS_COUNT", 1))
+
+# Jobs held in memory ahead of the workers, in total and per domain
+SCHEDULER_PREFETCH = int(os.getenv("SCHEDULER_PREFETCH", 200))
+SCHEDULER_DOMAIN_BUFFER = int(os.getenv("SCHEDULER_DOMAIN_BUFFER", 50))
+
+# Envelope batching: identical emails (same sender and content, no Cc or Bcc) buffered for the same domain
+# are sent in one SMTP transaction with up to ENVELOPE_BATCH_MAX recipients; 1 turns it off. An email that
+# could be batched waits up to ENVELOPE_BATCH_WINDOW seconds for others to join it. Batched emails share
+# one message, so its To header is ENVELOPE_TO_HEADER rather than each recipient's address
+ENVELOPE_BATCH_MAX = int(os.getenv("ENVELOPE_BATCH_MAX", 1))
+ENVELOPE_BATCH_WINDOW = float(os.getenv("ENVELOPE_BATCH_WINDOW", 0.2))
+ENVELOPE_TO_HEADER = os.getenv("ENVELOPE_TO_HEADER", "undisclosed-recipients:;")
+
+# Payload fields that may differ between emails sent in one envelope ("trace" marks traced emails)
+ENVELOPE_FIELDS = ("recipient", "tag", "webhook_url", "trace")
+
+# SQLite allows a limited number of bound parameters
+MAX_EXCLUDED_DOMAINS = 500
+
+# Seconds the dispatcher waits before trying again after the queue failed it (e.g. "database is locked")
+DISPATCH_RETRY_SECONDS = 1.0
+
+
+def lease_owner_prefix(pid):
+    """Prefix of the lease owner name of every scheduler in process `pid`."""
+    return f"scheduler-{pid}-"
+
+
+def envelope_key(payload):
+    """What emails must share to go in one envelope, or None if this one must be sent on its own."""
+    if payload.get("cc") or payload.get("bcc") or len(getaddresses([payload["recipient"]])) != 1:
+        return None
+    return json.dumps({name: value for name, value in payload.items() if name not in ENVELOPE_FIELDS}, sort_keys=True)
+
+
+def envelope_address(recipient):
+    return getaddresses([recipient])[0][1]
+
+
+class Envelope:
+    """Jobs with identical content for one domain, delivered in one SMTP transaction with a RCPT TO each.
+
+    The delivery engines hand an Envelope to the same handlers as a job; `payload` is the shared
+    content and `recipients` the addresses to send it to.
+    """
+
+    __slots__ = ("jobs", "recipients", "domain", "account", "sender")
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.recipients = [envelope_address(job.payload["recipient"]) for job in jobs]
+        self.domain = jobs[0].domain
+        self.account = jobs[0].account
+        self.sender = None
+
+    @property
+    def payload(self):
+        return self.jobs[0].payload
+
+    def outcomes(self, refused=None, error=None):
+        """Return (job, error or None) for every job, given the refused recipients or the error of the transaction."""
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            # Every recipient was refused, each for its own reason
+            refused, error = error.recipients, None
+        if error is not None:
+            return [(job, error) for job in self.jobs]
+        refused = refused or {}
+        return [(job, smtplib.SMTPRecipientsRefused({address: refused[address]}) if address in refused else None)
+                for job, address in zip(self.jobs, self.recipients)]
+
+
+def job_outcomes(job, result=None, error=None):
+    """(job, error or None) pairs for a delivered job or Envelope, from the handler's result or error."""
+    if isinstance(job, Envelope):
+        return job.outcomes(result, error)
+    return [(job, error)]
+
+
+def parse_limits(spec):
+    """Parse "name:concurrency:rate,..." into {name: (concurrency, rate)}."""
+    limits = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        name, concurrency, rate = (entry.split(":") + ["", ""])[:3]
+        limits[name.lower()] = (int(concurrency or 0) or None, float(rate or 0))
+    return limits
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, count=1):
+        # An envelope takes a token per recipient, possibly going into debt
+        self.tokens -= count
+
+
+class Limit:
+    """Concurrency cap plus optional token bucket for one domain or account."""
+
+    __slots__ = ("max_concurrency", "bucket", "in_flight")
+
+    def __init__(self, max_concurrency, rate):
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate) if rate > 0 else None
+        self.in_flight = 0
+
+    def wait_time(self, now):
+        """None if blocked on concurrency, else seconds until the rate allows another send."""
+        if self.in_flight >= self.max_concurrency:
+            return None
+        return self.bucket.wait_time(now) if self.bucket else 0.0
+
+
+class DeliveryScheduler:
+    """Hands leased jobs to workers, grouped by recipient domain and served round-robin.
+
+    A dispatcher thread keeps a bounded buffer of leased jobs per domain. Workers only get a job whose
+    domain is under its concurrency cap and has a rate token, so a throttled destination never ties up
+    the pool while other domains have deliverable mail. The sending account is picked from `senders`
+    at the same moment, among the accounts under their own limits and quotas.
+    """
+
+    def __init__(self, queue, prefetch=SCHEDULER_PREFETCH, domain_buffer=SCHEDULER_DOMAIN_BUFFER, senders=sender_pool):
+        self.queue = queue
+        self.senders = senders
+        self.prefetch = prefetch
+        self.domain_buffer = domain_buffer
+        self.owner = f"{lease_owner_prefix(os.getpid())}{uuid.uuid4().hex[:8]}"
+        self._ready = OrderedDict()
+        self._buffered = 0
+        self._leased = set()
+        self._domains = {}
+        self._accounts = {}
+        self._domain_overrides = parse_limits(DOMAIN_LIMITS)
+        self._account_overrides = parse_limits(ACCOUNT_LIMITS)
+        self._cond = threading.Condition()
+        # Paused while an operator has paused delivery (see DeliveryQueue.pause_delivery) or while draining
+        self.paused = False
+        self.draining = False
+
+    def _limit(self, table, overrides, name, default_concurrency, default_rate):
+        limit = table.get(name)
+        if limit is None:
+            concurrency, rate = overrides.get(name, (None, default_rate))
+            concurrency = math.ceil((concurrency or default_concurrency) / DELIVERY_PROCESS_COUNT)
+            limit = table[name] = Limit(concurrency, rate / DELIVERY_PROCESS_COUNT)
+        return limit
+
+    def _domain_limit(self, domain):
+        return self._limit(self._domains, self._domain_overrides, domain, DOMAIN_MAX_CONCURRENCY, DOMAIN_RATE_PER_SECOND)
+
+    def _account_limit(self, account):
+        return self._limit(self._accounts, self._account_overrides, (account or "").lower(),
+                           ACCOUNT_MAX_CONCURRENCY, ACCOUNT_RATE_PER_SECOND)
+
+    def start(self):
+        threading.Thread(target=self._dispatch_loop, name="delivery-dispatcher", daemon=True).start()
+
+    def _dispatch_loop(self):
+        """Keep the per-domain buffers topped up from the queue and the held leases fresh."""
+        last_renewal = last_purge = time.monotonic()
+        renew_every = self.queue.lease_seconds / 3
+        while True:
+            try:
+                # Renewed first, so the leases of jobs being sent hold even while leasing more keeps failing
+                now = time.monotonic()
+                if now - last_renewal >= renew_every:
+                    with self._cond:
+                        held = list(self._leased)
+                    self.queue.extend_leases(held)
+                    last_renewal = now
+                if now - last_purge >= 3600:
+                    self.queue.purge()
+                    last_purge = now
+
+                paused = self.draining or self.queue.delivery_paused() is not None
+                if paused != self.paused:
+                    with self._cond:
+                        self.paused = paused
+                        self._cond.notify_all()
+                if paused:
+                    # Leave the buffered jobs to whichever process resumes first
+                    self._return_buffered()
+                with self._cond:
+                    space = 0 if paused else self.prefetch - self._buffered
+                    full = [domain for domain, jobs in self._ready.items() if len(jobs) >= self.domain_buffer]
+                jobs = self.queue.lease(self.owner, min(space, 100), exclude_domains=full[:MAX_EXCLUDED_DOMAINS]) if space > 0 else []
+                if jobs:
+                    now = time.monotonic()
+                    if ENVELOPE_BATCH_MAX > 1:
+                        for job in jobs:
+                            job.envelope_key = envelope_key(job.payload)
+                    with self._cond:
+                        for job in jobs:
+                            if job.request_id in self._leased:
+                                continue
+                            job.buffered_at = now
+                            self._leased.add(job.request_id)
+                            self._ready.setdefault(job.domain, deque()).append(job)
+                            self._buffered += 1
+                        self._cond.notify_all()
+
+                if not jobs:
+                    if paused or (space > 0 and not full):
+                        # Woken early by commits from other processes too, such as the one resuming delivery
+                        self.queue.wait_for_work(0.5)
+                    else:
+                        # Wait for workers to drain the buffers instead
+                        with self._cond:
+                            self._cond.wait(0.5)
+            except Exception as e:
+                # A locked or unreachable database must not stop delivery for good: try again shortly
+                print(f"Delivery dispatcher failed, retrying in {DISPATCH_RETRY_SECONDS:g}s: {e}")
+                time.sleep(DISPATCH_RETRY_SECONDS)
+
+    def _take_locked(self, jobs, now, most=ENVELOPE_BATCH_MAX):
+        """Pop the next job of a domain's buffer, together with identical ones behind it as an Envelope.
+
+        Returns (job or Envelope, None), or (None, seconds) while a lone job waits for others to join it.
+        """
+        job = jobs[0]
+        if job.envelope_key is None:
+            return jobs.popleft(), None
+        batch, addresses = [], set()
+        for candidate in jobs:
+            if candidate.envelope_key == job.envelope_key:
+                address = envelope_address(candidate.payload["recipient"]).lower()
+                # The same address twice in one transaction would get the message once
+                if address not in addresses:
+                    addresses.add(address)
+                    batch.append(candidate)
+                    if len(batch) >= most:
+                        break
+        waited = now - job.buffered_at
+        if len(batch) < most and waited < ENVELOPE_BATCH_WINDOW and len(jobs) < self.domain_buffer:
+            return None, ENVELOPE_BATCH_WINDOW - waited
+        if len(batch) == 1:
+            return jobs.popleft(), None
+        taken = {id(member) for member in batch}
+        remaining = [candidate for candidate in jobs if id(candidate) not in taken]
+        jobs.clear()
+        jobs.extend(remaining)
+        return Envelope(batch), None
+
+    def poll(self):
+        """Return (job, None) for the next deliverable job or Envelope, or (None, seconds worth waiting) if there is none."""
+        now = time.monotonic()
+        wait = 1.0
+        with self._cond:
+            if self.paused:
+                return None, wait
+            for _ in range(len(self._ready)):
+                # Rotate through domains so each gets a turn
+                domain, jobs = next(iter(self._ready.items()))
+                self._ready.move_to_end(domain)
+                domain_limit = self._domain_limit(domain)
+                domain_wait = domain_limit.wait_time(now)
+                sender, account_wait = None, None
+                if domain_wait == 0:
+                    # Jobs queued with a fixed sender keep it; the rest may go out from any account
+                    sender, account_wait = self.senders.choose(
+                        now, lambda account: self._account_limit(account.email).wait_time(now), jobs[0].account)
+                if sender is not None:
+                    job, hold = self._take_locked(jobs, now, min(ENVELOPE_BATCH_MAX, sender.remaining(now)))
+                    if job is None:
+                        wait = min(wait, hold)
+                        continue
+                    if not jobs:
+                        del self._ready[domain]
+                    members = job.jobs if isinstance(job, Envelope) else (job,)
+                    for member in (job, *members):
+                        member.sender = sender
+                        member.account = sender.email
+                    count = len(members)
+                    self._buffered -= count
+                    self.senders.charge(sender, count, now)
+                    for limit in (domain_limit, self._account_limit(sender.email)):
+                        limit.in_flight += 1
+                        if limit.bucket:
+                            limit.bucket.take(count)
+                    self._cond.notify_all()
+                    return job, None
+                # Blocked on concurrency: a finishing job will wake us; blocked on rate: wait for a token
+                for blocked in (domain_wait, account_wait):
+                    if blocked:
+                        wait = min(wait, blocked)
+        return None, wait
+
+    def next_job(self, timeout=None):
+        """Block until a deliverable job is available, or return None after `timeout` seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                job, wait = self.poll()
+                if job is not None:
+                    return job
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    wait = min(wait, remaining)
+                self._cond.wait(wait)
+
+    def done(self, job, error=None):
+        """Release the domain and account slots a job or Envelope held; `error` is its delivery error, if any."""
+        with self._cond:
+            self._domain_limit(job.domain).in_flight -= 1
+            self._account_limit(job.account).in_flight -= 1
+            for member in job.jobs if isinstance(job, Envelope) else (job,):
+                self._leased.discard(member.request_id)
+            self._cond.notify_all()
+        self.senders.report(job.sender, error)
+
+    def _return_buffered(self):
+        """Give the jobs waiting in the buffers back to the queue."""
+        with self._cond:
+            jobs = [job for buffered in self._ready.values() for job in buffered]
+            self._ready.clear()
+            self._buffered = 0
+            for job in jobs:
+                self._leased.discard(job.request_id)
+        if jobs:
+            self.queue.unlease([job.request_id for job in jobs])
+
+    def drain(self):
+        """Start no more deliveries and give the buffered jobs back, for a restart or shutdown; in_flight()
+        says when the deliveries already started are over."""
+        with self._cond:
+            self.draining = self.paused = True
+            self._cond.notify_all()
+        self._return_buffered()
+
+    def in_flight(self):
+        """Jobs this scheduler leased whose outcome isn't recorded yet, buffered ones included."""
+        return self.queue.count_leased(self.owner)
+
+    def get_stats(self):
+        """Buffered and in-flight jobs per domain."""
+        with self._cond:
+            return {
+                "paused": self.paused,
+                "buffered": self._buffered,
+                "domains": {
+                    domain: {"in_flight": limit.in_flight, "buffered": len(self._ready.get(domain, ()))}
+                    for domain, limit in self._domains.items()
+                    if limit.in_flight or domain in self._ready
+                },
+            }
@@ -0,0 +1,311 @@
+import json
+import math
+import os
+import smtplib
+import threading
+import time
+
+from circuit_breaker import CircuitOpenError
+from metrics import METRICS_DIR
+from retry_scheduler import reply_code
+
+# Delivery outcomes are counted over these sliding windows, each kept as STATS_SLOTS slots, so a window
+# moves on in steps of 1/STATS_SLOTS of its length (1s for the last minute, 1 minute for the last hour)
+STATS_WINDOWS = (("1m", 60), ("5m", 300), ("1h", 3600))
+STATS_SLOTS = 60
+
+# Latency percentiles are estimated within this relative error (0.01 = 1%)
+STATS_LATENCY_ACCURACY = float(os.getenv("STATS_LATENCY_ACCURACY", 0.01))
+STATS_LATENCY_PERCENTILES = (50, 90, 99)
+
+# Senders, recipient domains and error classes listed per window, busiest first
+STATS_TOP = int(os.getenv("STATS_TOP", 10))
+
+# In multi-process mode each delivery process publishes its windows to METRICS_DIR this often
+STATS_PUBLISH_INTERVAL = 1.0
+STATS_FILE_SUFFIX = ".stats"
+
+OUTCOMES = ("sent", "deferred", "failed")
+
+
+def error_class(error):
+    """Group a delivery failure for the statistics: its SMTP reply code, or what went wrong on the way."""
+    if isinstance(error, CircuitOpenError):
+        return "circuit open"
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return "login failed"
+    code = reply_code(error)
+    if code is not None:
+        return str(code)
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return "disconnected"
+    if isinstance(error, OSError):
+        return "connection failed"
+    return type(error).__name__
+
+
+class LatencySketch:
+    """Mergeable quantile sketch with logarithmic buckets (as in DDSketch).
+
+    A latency is counted in the bucket whose bounds are within `accuracy` of it, so any quantile read back
+    is within that relative error, however many latencies were counted. Bucket counts from different
+    windows or processes simply add up; only the buckets are stored, never the latencies.
+    """
+
+    # Latencies below this are counted as this (0.1ms)
+    MIN_SECONDS = 1e-4
+
+    def __init__(self, accuracy=STATS_LATENCY_ACCURACY):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+
+    def bucket(self, seconds):
+        return math.ceil(math.log(max(seconds, self.MIN_SECONDS)) / self._log_gamma)
+
+    def value(self, bucket):
+        # The point of the bucket within `accuracy` of both of its bounds
+        return 2 * self.gamma ** bucket / (self.gamma + 1)
+
+    def quantiles(self, counts, percentiles=STATS_LATENCY_PERCENTILES):
+        """{"p50": seconds, ...} from bucket counts ({bucket: count}); None for each if there are none."""
+        total = sum(counts.values())
+        if not total:
+            return {f"p{percentile:g}": None for percentile in percentiles}
+        ordered = sorted(counts.items())
+        results = {}
+        for percentile in percentiles:
+            rank = percentile / 100 * (total - 1)
+            seen = 0
+            for bucket, count in ordered:
+                seen += count
+                if seen > rank:
+                    break
+            results[f"p{percentile:g}"] = round(self.value(bucket), 6)
+        return results
+
+
+class SlidingCounts:
+    """Counts per key over the last `seconds`, updated in O(1) and read without adding anything up.
+
+    The window is a ring of slots, each holding the counts added during its share of the window, and a
+    running total per key. A slot's counts are taken off the totals when it falls out of the window, so
+    every count is added and removed once. Slots are numbered by wall-clock time, so windows exported
+    by another process, or before a restart, line up with this one's.
+    """
+
+    def __init__(self, seconds, slots=STATS_SLOTS):
+        self.seconds = seconds
+        self.slot_seconds = seconds / slots
+        self.totals = {}
+        self._slots = [{} for _ in range(slots)]
+        self._current = int(time.time() // self.slot_seconds)
+
+    def _advance(self, now):
+        slot = int(now // self.slot_seconds)
+        for number in range(max(self._current, slot - len(self._slots)) + 1, slot + 1):
+            expired = self._slots[number % len(self._slots)]
+            for key, count in expired.items():
+                left = self.totals[key] - count
+                if left:
+                    self.totals[key] = left
+                else:
+                    del self.totals[key]
+            expired.clear()
+        self._current = max(self._current, slot)
+
+    def add(self, keys, now):
+        """Count one of each of `keys` at `now`."""
+        self._advance(now)
+        counts = self._slots[self._current % len(self._slots)]
+        totals = self.totals
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+            totals[key] = totals.get(key, 0) + 1
+
+    def read(self, now):
+        """The totals of the window ending `now`; the dict is live, so copy it before letting go of the lock."""
+        self._advance(now)
+        return self.totals
+
+    def export(self, now):
+        """[[slot number, [[key, count], ...]], ...] for the slots still in the window."""
+        self._advance(now)
+        first = self._current - len(self._slots) + 1
+        return [[number, [[list(key), count] for key, count in self._slots[number % len(self._slots)].items()]]
+                for number in range(first, self._current + 1) if self._slots[number % len(self._slots)]]
+
+    def load(self, exported, now):
+        """Add exported slots that are still in the window ending `now`."""
+        self._advance(now)
+        for number, counts in exported:
+            if self._current - len(self._slots) < number <= self._current:
+                slot = self._slots[number % len(self._slots)]
+                for key, count in counts:
+                    key = tuple(key)
+                    slot[key] = slot.get(key, 0) + count
+                    self.totals[key] = self.totals.get(key, 0) + count
+
+
+def _in_window(exported, seconds, now, slots=STATS_SLOTS):
+    """Add up the slots of an exported window that are still in the window ending `now`."""
+    current = int(now // (seconds / slots))
+    totals = {}
+    for number, counts in exported:
+        if current - slots < number <= current:
+            for key, count in counts:
+                key = tuple(key)
+                totals[key] = totals.get(key, 0) + count
+    return totals
+
+
+class DeliveryStats:
+    """Rolling counts of delivery outcomes by sender, recipient domain and error class, and latency
+    sketches, over each of STATS_WINDOWS; updated by the delivery engines on every outcome.
+
+    Keys are (dimension, name, outcome) for counts and ("latency", kind, bucket) for latencies: "delivery"
+    is the time of each attempt, "queued" the time from accept to sent.
+    """
+
+    def __init__(self, windows=STATS_WINDOWS):
+        self.windows = {name: SlidingCounts(seconds) for name, seconds in windows}
+        self.sketch = LatencySketch()
+        self._lock = threading.Lock()
+
+    def record(self, job, status, error=None, seconds=None):
+        """Count the outcome of one email's delivery attempt; `seconds` is how long the attempt took."""
+        now = time.time()
+        outcome = status.partition(" ")[0]
+        keys = [("all", "", outcome), ("sender", job.account or "", outcome), ("domain", job.domain, outcome)]
+        if error is not None:
+            keys.append(("error", error_class(error), outcome))
+        if seconds is not None:
+            keys.append(("latency", "delivery", self.sketch.bucket(seconds)))
+        if outcome == "sent" and job.created_at is not None:
+            keys.append(("latency", "queued", self.sketch.bucket(now - job.created_at)))
+        with self._lock:
+            for window in self.windows.values():
+                window.add(keys, now)
+
+    def export_state(self):
+        now = time.time()
+        with self._lock:
+            return {name: window.export(now) for name, window in self.windows.items()}
+
+    def import_state(self, state):
+        """Carry on with windows exported by the previous process (or add up another's)."""
+        now = time.time()
+        with self._lock:
+            for name, window in self.windows.items():
+                window.load(state.get(name, ()), now)
+
+    def read(self, name, exported=()):
+        """The totals of window `name`, adding those of `exported` windows (from other processes)."""
+        window = self.windows[name]
+        now = time.time()
+        with self._lock:
+            totals = dict(window.read(now))
+        for other in exported:
+            for key, count in _in_window(other.get(name, ()), window.seconds, now).items():
+                totals[key] = totals.get(key, 0) + count
+        return totals
+
+    def summary(self, name, exported=(), top=STATS_TOP):
+        """Window `name` as a dict: totals and rates per outcome, the `top` busiest senders, domains and
+        error classes, and latency percentiles."""
+        totals = self.read(name, exported)
+        seconds = self.windows[name].seconds
+        groups = {"sender": {}, "domain": {}, "error": {}}
+        latencies = {"delivery": {}, "queued": {}}
+        outcomes = dict.fromkeys(OUTCOMES, 0)
+        for (dimension, group, item), count in totals.items():
+            if dimension == "all":
+                outcomes[item] = count
+            elif dimension == "latency":
+                latencies[group][item] = count
+            else:
+                groups[dimension].setdefault(group, dict.fromkeys(OUTCOMES, 0))[item] = count
+
+        def busiest(counts):
+            ranked = sorted(counts.items(), key=lambda item: sum(item[1].values()), reverse=True)
+            return [{"name": group, **outcome_counts} for group, outcome_counts in ranked[:top]]
+
+        attempts = sum(outcomes.values())
+        return {
+            "window": name,
+            "seconds": seconds,
+            **outcomes,
+            "per_second": {outcome: round(count / seconds, 3) for outcome, count in outcomes.items()},
+            "failure_rate": round(outcomes["failed"] / attempts, 4) if attempts else 0.0,
+            "senders": busiest(groups["sender"]),
+            "domains": busiest(groups["domain"]),
+            "errors": busiest(groups["error"]),
+            "delivery_seconds": self.sketch.quantiles(latencies["delivery"]),
+            "queued_seconds": self.sketch.quantiles(latencies["queued"]),
+        }
+
+
+def publish_stats(directory=METRICS_DIR, interval=STATS_PUBLISH_INTERVAL):
+    """Write this process's windows to `directory` every `interval` seconds, from a background thread."""
+
+    def publish():
+        path = os.path.join(directory, f"{os.getpid()}{STATS_FILE_SUFFIX}")
+        while True:
+            try:
+                with open(path + ".tmp", "w") as file:
+                    json.dump(delivery_stats.export_state(), file)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                # Keep publishing: a full disk or a removed directory may come right again
+                print(f"Failed to publish delivery statistics: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=publish, name="stats-publisher", daemon=True).start()
+
+
+def read_published_stats(directory=METRICS_DIR):
+    """The windows other processes published to `directory`."""
+    if not directory:
+        return []
+    own = f"{os.getpid()}{STATS_FILE_SUFFIX}"
+    published = []
+    for name in os.listdir(directory):
+        if name.endswith(STATS_FILE_SUFFIX) and name != own:
+            try:
+                with open(os.path.join(directory, name)) as file:
+                    published.append(json.load(file))
+            except (OSError, ValueError):
+                continue
+    return published
+
+
+def retire_published_stats(directory, pid):
+    """Fold the windows a dead process published into retired.stats, where they age out like the others'."""
+    path = os.path.join(directory, f"{pid}{STATS_FILE_SUFFIX}")
+    retired_path = os.path.join(directory, f"retired{STATS_FILE_SUFFIX}")
+    retired = DeliveryStats()
+    for source in (retired_path, path):
+        try:
+            with open(source) as file:
+                retired.import_state(json.load(file))
+        except (OSError, ValueError):
+            continue
+    with open(retired_path + ".tmp", "w") as file:
+        json.dump(retired.export_state(), file)
+    os.replace(retired_path + ".tmp", retired_path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def stats_summary(top=STATS_TOP, names=None, directory=METRICS_DIR):
+    """The windows `names` (all by default) of this process and those other processes published to
+    `directory`, as dicts."""
+    published = read_published_stats(directory)
+    return [delivery_stats.summary(name, published, top) for name in names or delivery_stats.windows]
+
+
+# Shared statistics updated by both delivery engines and read by the stats route and the admin terminal
+delivery_stats = DeliveryStats()
@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import html
+import base64
+import threading
+import uuid
+from email import generator
+from email.header import Header
+from email.utils import formataddr, getaddresses
+from functools import lru_cache
+from io import BytesIO
+
+# Where registered templates are kept between restarts
+TEMPLATES_PATH = os.getenv("TEMPLATES_PATH", "email_templates.json")
+
+# Merge fields look like {{ first_name }}
+PLACEHOLDER = re.compile(r"\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}")
+
+# Template names are used in URLs and job payloads
+TEMPLATE_NAME_REGEX = re.compile(r"[A-Za-z0-9_.-]{1,64}")
+
+# Longest line SMTP allows (RFC 5321 section 4.5.3.1.6), excluding CRLF
+MAX_LINE_LENGTH = 998
+
+
+def split_placeholders(text):
+    """Split text into its static pieces and the merge fields between them ("Hi {{name}}!" -> ["Hi ", "!"], ["name"])."""
+    parts = PLACEHOLDER.split(text)
+    return parts[0::2], parts[1::2]
+
+
+def normalize_newlines(text):
+    return text.replace("\r\n", "\n").replace("\r", "\n").replace("\n", "\r\n")
+
+
+def encode_header(name, value):
+    """Return one encoded header line; line breaks in merged values are flattened so they can't add headers."""
+    value = re.sub(r"[\r\n]+", " ", value)
+    if value.isascii() and len(name) + len(value) + 2 <= MAX_LINE_LENGTH:
+        return f"{name}: {value}\r\n".encode()
+    encoded = Header(value, "utf-8", header_name=name).encode(linesep="\r\n")
+    return f"{name}: {encoded}\r\n".encode()
+
+
+@lru_cache(maxsize=64)
+def encode_from_header(sender_name, sender_email):
+    # The same sender is used for a whole campaign, so its header is only encoded once
+    return encode_header("From", formataddr((sender_name, sender_email)) if sender_name else sender_email)
+
+
+class RenderedMessage:
+    """A message ready for the SMTP DATA command, with its envelope."""
+
+    __slots__ = ("from_addr", "to_addrs", "subject", "data", "boundary")
+
+    def __init__(self, from_addr, to_addrs, subject, data, boundary):
+        self.from_addr = from_addr
+        self.to_addrs = to_addrs
+        self.subject = subject
+        self.data = data
+        self.boundary = boundary
+
+
+def serialize_message(message):
+    """Return (from_addr, to_addrs, data) for a MIME or rendered message, the same way smtplib.send_message does."""
+    if isinstance(message, RenderedMessage):
+        return message.from_addr, message.to_addrs, message.data
+    from_addr = getaddresses([message["Sender"] or message["From"]])[0][1]
+    to_addrs = [address for _, address in getaddresses(
+        [value for field in ("To", "Cc", "Bcc") for value in message.get_all(field, [])]
+    )]
+    # Bcc must not be transmitted
+    del message["Bcc"]
+    buffer = BytesIO()
+    generator.BytesGenerator(buffer).flatten(message, linesep="\r\n")
+    return from_addr, to_addrs, buffer.getvalue()
+
+
+class EmailTemplate:
+    """A template compiled once into pre-encoded MIME parts with slots for the merge fields.
+
+    Rendering only substitutes the variables, encodes the per-recipient headers and joins bytes; the
+    message has the same layout build_email_message produces, without going through the email package.
+    """
+
+    def __init__(self, name, subject, body, is_html=False):
+        self.name = name
+        self.subject = subject
+        self.body = body
+        self.is_html = is_html
+        self._subject_pieces, self._subject_fields = split_placeholders(subject)
+        body_pieces, self._body_fields = split_placeholders(normalize_newlines(body))
+        self._body_pieces = [piece.encode() for piece in body_pieces]
+        self.variables = sorted(set(self._subject_fields) | set(self._body_fields))
+
+        self.boundary = boundary = f"==============={uuid.uuid4().int % 10 ** 19:019d}=="
+        self._boundary = boundary.encode()
+        subtype = "html" if is_html else "plain"
+        self._head = f'Content-Type: multipart/mixed; boundary="{boundary}"\r\nMIME-Version: 1.0\r\n'.encode()
+        self._part_7bit = (f'\r\n--{boundary}\r\nContent-Type: text/{subtype}; charset="us-ascii"\r\n'
+                           f'MIME-Version: 1.0\r\nContent-Transfer-Encoding: 7bit\r\n\r\n').encode()
+        self._part_base64 = (f'\r\n--{boundary}\r\nContent-Type: text/{subtype}; charset="utf-8"\r\n'
+                             f'MIME-Version: 1.0\r\nContent-Transfer-Encoding: base64\r\n\r\n').encode()
+        self._tail = f"\r\n--{boundary}--\r\n".encode()
+
+    def to_dict(self):
+        return {"name": self.name, "subject": self.subject, "body": self.body, "is_html": self.is_html,
+                "variables": self.variables}
+
+    def missing_variables(self, variables):
+        return [name for name in self.variables if name not in variables]
+
+    def render_subject(self, variables):
+        pieces, fields = self._subject_pieces, self._subject_fields
+        parts = [pieces[0]]
+        for field, piece in zip(fields, pieces[1:]):
+            parts += (str(variables[field]), piece)
+        return "".join(parts)
+
+    def render_body(self, variables):
+        """Return the body as (Content-Transfer-Encoding part header, encoded bytes)."""
+        pieces, fields = self._body_pieces, self._body_fields
+        parts = [pieces[0]]
+        for field, piece in zip(fields, pieces[1:]):
+            value = str(variables[field])
+            if self.is_html:
+                value = html.escape(value)
+            parts += (normalize_newlines(value).encode(), piece)
+        body = b"".join(parts)
+        # Plain 7bit unless that would be invalid or could be mistaken for the boundary
+        if (body.isascii() and self._boundary not in body
+                and (len(body) <= MAX_LINE_LENGTH or max(map(len, body.split(b"\r\n"))) <= MAX_LINE_LENGTH)):
+            return self._part_7bit, body
+        return self._part_base64, base64.encodebytes(body).replace(b"\n", b"\r\n").rstrip(b"\r\n")
+
+    def render(self, variables, recipient, sender_email, sender_name, cc=None, bcc=None):
+        """Render the message for one recipient; Bcc only goes into the envelope, as with smtplib.send_message."""
+        subject = self.render_subject(variables)
+        part_header, body = self.render_body(variables)
+        headers = [self._head, encode_from_header(sender_name, sender_email), encode_header("To", recipient)]
+        if cc:
+            headers.append(encode_header("Cc", cc))
+        headers.append(encode_header("Subject", subject))
+        data = b"".join(headers + [part_header, body, self._tail])
+        to_addrs = [address for _, address in getaddresses([value for value in (recipient, cc, bcc) if value])]
+        return RenderedMessage(sender_email, to_addrs, subject, data, self.boundary)
+
+
+class TemplateStore:
+    """Registered templates, compiled on registration and kept in memory.
+
+    Definitions are saved to a JSON file so queued template sends still render after a restart, and
+    reloaded when another process changes the file.
+    """
+
+    def __init__(self, path=TEMPLATES_PATH):
+        self.path = path
+        self._templates = None
+        self._file_version = None
+        self._lock = threading.Lock()
+
+    def _current_file_version(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load_locked(self):
+        version = self._current_file_version()
+        if self._templates is None or version != self._file_version:
+            self._file_version = version
+            self._templates = {}
+            try:
+                with open(self.path) as file:
+                    definitions = json.load(file)
+            except (OSError, ValueError):
+                definitions = {}
+            for name, definition in definitions.items():
+                self._templates[name] = EmailTemplate(name, definition["subject"], definition["body"],
+                                                      definition.get("is_html", False))
+        return self._templates
+
+    def _save_locked(self):
+        definitions = {name: {"subject": template.subject, "body": template.body, "is_html": template.is_html}
+                       for name, template in self._templates.items()}
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(definitions, file)
+        os.replace(temp_path, self.path)
+        self._file_version = self._current_file_version()
+
+    def register(self, name, subject, body, is_html=False):
+        """Compile and save a template, replacing any template of the same name."""
+        template = EmailTemplate(name, subject, body, is_html)
+        with self._lock:
+            self._load_locked()[name] = template
+            self._save_locked()
+        return template
+
+    def get(self, name):
+        with self._lock:
+            return self._load_locked().get(name)
+
+    def delete(self, name):
+        with self._lock:
+            if self._load_locked().pop(name, None) is None:
+                return False
+            self._save_locked()
+            return True
+
+    def list(self):
+        with self._lock:
+            return list(self._load_locked().values())
+
+
+# Shared template store for this process
+email_templates = TemplateStore()
@@ -0,0 +1,137 @@
+import os
+import math
+import threading
+import time
+
+from delivery_scheduler import DELIVERY_PROCESS_COUNT
+from metrics import Counter, Gauge
+
+# Adaptive delivery pool: every POOL_RESIZE_INTERVAL seconds the pool is sized to work through the ready
+# backlog within POOL_DRAIN_SECONDS at the observed delivery latency (Little's law), within its limits
+POOL_RESIZE_INTERVAL = float(os.getenv("POOL_RESIZE_INTERVAL", 2))
+POOL_DRAIN_SECONDS = float(os.getenv("POOL_DRAIN_SECONDS", 30))
+# Latency this many times its recent best means the SMTP servers are the bottleneck: shrink, don't grow
+POOL_LATENCY_FACTOR = float(os.getenv("POOL_LATENCY_FACTOR", 3))
+
+# Intake backpressure: once QUEUE_HIGH_WATER emails are pending, new sends get 429 until fewer than
+# QUEUE_LOW_WATER are; Retry-After falls back to QUEUE_RETRY_AFTER seconds until a drain rate is measured
+QUEUE_HIGH_WATER = int(os.getenv("QUEUE_HIGH_WATER", 50000))
+QUEUE_LOW_WATER = int(os.getenv("QUEUE_LOW_WATER", QUEUE_HIGH_WATER * 9 // 10))
+QUEUE_RETRY_AFTER = float(os.getenv("QUEUE_RETRY_AFTER", 5))
+QUEUE_DEPTH_CHECK_INTERVAL = 0.5
+MAX_RETRY_AFTER = 300
+
+DELIVERY_POOL_SIZE = Gauge("email_delivery_pool_size", "Delivery workers (or async delivery slots) currently allowed.")
+INTAKE_REJECTED = Counter("email_intake_rejected_total", "Emails refused because the queue was over its high-water mark.")
+
+
+class PoolSizer:
+    """Resize a delivery pool between `minimum` and `maximum` from the backlog and the delivery latency.
+
+    Deliveries report their duration with observe(); a background thread calls `on_resize(size)` whenever
+    the target size changes. The pool grows by at most doubling and shrinks by a quarter per step, so
+    a short burst or lull doesn't make it swing.
+    """
+
+    def __init__(self, queue, minimum, maximum, on_resize, interval=POOL_RESIZE_INTERVAL):
+        self.queue = queue
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.on_resize = on_resize
+        self.interval = interval
+        self.size = minimum
+        self._latency = None
+        self._best_latency = None
+        self._lock = threading.Lock()
+        DELIVERY_POOL_SIZE.inc(amount=minimum)
+
+    def observe(self, seconds):
+        """Record how long one delivery attempt took."""
+        with self._lock:
+            self._latency = seconds if self._latency is None else self._latency + 0.2 * (seconds - self._latency)
+
+    def start(self):
+        if self.maximum > self.minimum:
+            threading.Thread(target=self._run, name="pool-sizer", daemon=True).start()
+
+    def target(self, backlog):
+        """The pool size to aim for with `backlog` ready jobs."""
+        with self._lock:
+            latency = self._latency
+            if latency is None:
+                return self.size
+            # The best latency seen, slowly forgotten so a permanent change becomes the new normal
+            if self._best_latency is None or latency < self._best_latency:
+                self._best_latency = latency
+            else:
+                self._best_latency += (latency - self._best_latency) * 0.01
+            best = self._best_latency
+        if latency > best * POOL_LATENCY_FACTOR:
+            needed = self.size - max(1, self.size // 4)
+        else:
+            # Every delivery process works through its share of the shared backlog
+            needed = math.ceil(backlog * latency / POOL_DRAIN_SECONDS / DELIVERY_PROCESS_COUNT)
+        needed = max(self.size - max(1, self.size // 4), min(needed, self.size * 2))
+        return max(self.minimum, min(self.maximum, needed))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                size = self.target(self.queue.ready_count())
+            except Exception as e:
+                print(f"Failed to resize the delivery pool: {e}")
+                continue
+            if size != self.size:
+                DELIVERY_POOL_SIZE.inc(amount=size - self.size)
+                self.size = size
+                self.on_resize(size)
+
+
+class IntakeGate:
+    """Backpressure for the send endpoints, based on how many emails are waiting in the queue.
+
+    The depth is read from the queue at most every QUEUE_DEPTH_CHECK_INTERVAL seconds and counts the
+    emails admitted since. While the queue drains, its drain rate is measured so that Retry-After says
+    roughly when the queue will be under the low-water mark.
+    """
+
+    def __init__(self, queue, high_water=QUEUE_HIGH_WATER, low_water=QUEUE_LOW_WATER):
+        self.queue = queue
+        self.high_water = high_water
+        self.low_water = min(low_water, high_water)
+        self._depth = 0
+        self._checked_at = None
+        self._drain_rate = None
+        self._shedding = False
+        self._lock = threading.Lock()
+
+    def _refresh_locked(self, now):
+        depth = self.queue.depth()
+        if self._checked_at is not None and depth < self._depth:
+            rate = (self._depth - depth) / (now - self._checked_at)
+            self._drain_rate = rate if self._drain_rate is None else self._drain_rate + 0.3 * (rate - self._drain_rate)
+        self._depth = depth
+        self._checked_at = now
+        if self._shedding and depth < self.low_water:
+            self._shedding = False
+        elif not self._shedding and depth >= self.high_water:
+            self._shedding = True
+
+    def admit(self, count=1):
+        """Admit `count` emails and return None, or return the number of seconds the client should wait.
+
+        admit(0) only checks whether the queue is taking sends.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at is None or now - self._checked_at >= QUEUE_DEPTH_CHECK_INTERVAL:
+                self._refresh_locked(now)
+            if not self._shedding:
+                self._depth += count
+                if self._depth >= self.high_water:
+                    self._shedding = True
+                return None
+            excess = self._depth - self.low_water
+            seconds = excess / self._drain_rate if self._drain_rate else QUEUE_RETRY_AFTER
+        return int(min(MAX_RETRY_AFTER, max(1, math.ceil(seconds))))
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# A send carrying an Idempotency-Key header (or an "idempotency_key" field on a /send-emails line) that
+# was already used within IDEMPOTENCY_WINDOW seconds is not queued again: the first request's ID is returned
+IDEMPOTENCY_WINDOW = float(os.getenv("IDEMPOTENCY_WINDOW", 24 * 3600))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# Sends without a key are deduplicated by content when this is above 0: the same email (recipient,
+# content, tag, ...) accepted again within IDEMPOTENCY_CONTENT_WINDOW seconds is a duplicate
+IDEMPOTENCY_CONTENT_WINDOW = float(os.getenv("IDEMPOTENCY_CONTENT_WINDOW", 0))
+
+# Keys this process accepted recently are answered from memory, without a round trip to the queue
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 100000))
+
+# Payload fields that don't make two emails different; "trace" marks traced emails
+IGNORED_FIELDS = ("trace",)
+
+
+def _digest(text):
+    # 16 bytes are plenty to tell keys apart, and take far less memory and index space than the text
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def fingerprint(payload):
+    """Digest of what a queued email would send, to tell a retried request from a different one."""
+    return _digest(json.dumps({name: value for name, value in payload.items() if name not in IGNORED_FIELDS},
+                              sort_keys=True))
+
+
+class IdempotencyKey:
+    """The key a send is deduplicated by, the fingerprint of its email and how long the key holds."""
+
+    __slots__ = ("key", "fingerprint", "window")
+
+    def __init__(self, key, fingerprint, window):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.window = window
+
+
+def get_key_error(client_key):
+    """Return the reason a client's idempotency key is invalid, or None if it is valid (or absent)."""
+    if client_key is None:
+        return None
+    if not isinstance(client_key, str) or not client_key or len(client_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        return f"Idempotency key must be a string of 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters"
+    return None
+
+
+def request_key(client_key, payload):
+    """The IdempotencyKey of a send from the client's key, or from its content if content deduplication
+    is on; None if the send isn't deduplicated."""
+    email_fingerprint = fingerprint(payload)
+    if client_key:
+        return IdempotencyKey(_digest("key:" + client_key), email_fingerprint, IDEMPOTENCY_WINDOW)
+    if IDEMPOTENCY_CONTENT_WINDOW > 0:
+        return IdempotencyKey(_digest("content:" + email_fingerprint.hex()), email_fingerprint,
+                              IDEMPOTENCY_CONTENT_WINDOW)
+    return None
+
+
+class RecentKeys:
+    """Keys of recently accepted sends with their request IDs, bounded by both age and size.
+
+    Entries are kept in the order they were added, so excess and (nearly all) expired entries are at the
+    front and eviction is O(1) per entry. The queue database has the final say: a key missing here may
+    still have been used by another process, or before a restart.
+    """
+
+    def __init__(self, max_size=IDEMPOTENCY_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict_locked(self, now):
+        entries = self._entries
+        while entries and len(entries) > self.max_size:
+            entries.popitem(last=False)
+        while entries:
+            _, _, expires_at = next(iter(entries.values()))
+            if expires_at > now:
+                break
+            entries.popitem(last=False)
+
+    def add(self, key, request_id):
+        now = time.time()
+        with self._lock:
+            self._entries[key.key] = (request_id, key.fingerprint, now + key.window)
+            self._entries.move_to_end(key.key)
+            self._evict_locked(now)
+
+    def get(self, key):
+        """Return (request ID, fingerprint) of the send that used the key, or None if there is none in memory."""
+        with self._lock:
+            entry = self._entries.get(key.key)
+            if entry is None:
+                return None
+            request_id, email_fingerprint, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key.key]
+                return None
+            return request_id, email_fingerprint
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Shared cache of this process's recently accepted keys
+recent_keys = RecentKeys()
@@ -0,0 +1,181 @@
+import json
+import os
+import signal
+import stat
+import sys
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from circuit_breaker import circuit_breakers
+from delivery_stats import delivery_stats
+from metrics import METRICS_DIR
+from sender_pool import sender_pool
+from smtp_pool import smtp_pool
+
+# Before a restart or shutdown, delivery is drained: no new emails are started, and the ones being sent get
+# up to DRAIN_TIMEOUT seconds to finish. Emails still sending after that are requeued by the next start
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 30))
+DRAIN_MAX_TIMEOUT = 600
+
+# The sending accounts' quotas and cool-offs, the circuit breakers and the delivery statistics are handed
+# over to the next process through this file, so a restart neither resets the daily quotas nor retries
+# servers known to be down
+WARM_STATE_FILE = os.getenv("WARM_STATE_FILE", "warm_state.json")
+
+# How often a drain checks whether the emails being sent are done, and the least it waits for every
+# delivery process to notice delivery was paused
+DRAIN_POLL_INTERVAL = 0.1
+PAUSE_NOTICE_SECONDS = 1.0
+
+
+def save_warm_state(path=WARM_STATE_FILE):
+    state = {"saved_at": time.time(), "senders": sender_pool.export_state(), "breakers": circuit_breakers.export_state()}
+    # Published statistics outlive their process already (see retire_published_stats)
+    if not METRICS_DIR:
+        state["stats"] = delivery_stats.export_state()
+    with open(path + ".tmp", "w") as file:
+        json.dump(state, file)
+    os.replace(path + ".tmp", path)
+
+
+def load_warm_state(path=WARM_STATE_FILE):
+    """Take over the state the previous process saved on its way out; returns False if there was none."""
+    try:
+        with open(path) as file:
+            state = json.load(file)
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as e:
+        print(f"Failed to read the state saved by the previous run, starting without it: {e}")
+        return False
+    elapsed = max(0.0, time.time() - state["saved_at"])
+    sender_pool.import_state(state["senders"], elapsed)
+    circuit_breakers.import_state(state["breakers"], elapsed)
+    delivery_stats.import_state(state.get("stats", {}))
+    return True
+
+
+def drain_delivery(queue, timeout=DRAIN_TIMEOUT):
+    """Pause delivery in every process and wait up to `timeout` seconds for the emails being sent to finish.
+
+    Returns how many are still being sent; delivery stays paused until resumed.
+    """
+    queue.pause_delivery()
+    deadline = time.monotonic() + timeout
+    time.sleep(min(PAUSE_NOTICE_SECONDS, timeout))
+    while True:
+        left = queue.count_leased()
+        if not left or time.monotonic() >= deadline:
+            return left
+        time.sleep(DRAIN_POLL_INTERVAL)
+
+
+def _inherited_listener():
+    """The listening socket the process this one replaced left open across exec (RESTART_LISTEN_FD), or None."""
+    fd = os.environ.pop("RESTART_LISTEN_FD", None)
+    try:
+        if fd is not None and stat.S_ISSOCK(os.fstat(int(fd)).st_mode):
+            return int(fd)
+    except (OSError, ValueError):
+        # Closed already, e.g. by Ctrl-C before a restart from the terminal: the new process binds the port
+        pass
+    return None
+
+
+def serve_app(app, host, port, debug=False):
+    """Serve the Flask app until Ctrl-C, on a listening socket that is kept open across a restart, so
+    connections wait in its backlog instead of being refused while the new process starts."""
+    from werkzeug.serving import make_server
+
+    application = app
+    if debug:
+        from werkzeug.debug import DebuggedApplication
+
+        app.debug = True
+        application = DebuggedApplication(app, evalex=True)
+    fd = _inherited_listener()
+    server = make_server(host, port, application, threaded=True, fd=fd)
+    if fd is not None:
+        # The server listens on a duplicate of it
+        os.close(fd)
+    server.socket.set_inheritable(True)
+    os.environ["RESTART_LISTEN_FD"] = str(server.fileno())
+    server.log_startup()
+    server.serve_forever()
+
+
+class DeliveryLifecycle:
+    """The delivery schedulers of this process, and stopping them without losing mail for a restart or shutdown."""
+
+    def __init__(self):
+        self.schedulers = []
+        self.exit_hooks = []
+        self._stopping = threading.Lock()
+
+    def register(self, scheduler):
+        self.schedulers.append(scheduler)
+
+    def on_exit(self, hook):
+        """Have `hook()` run on the way out of a shutdown or restart, which neither run atexit handlers."""
+        self.exit_hooks.append(hook)
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Start no more deliveries in this process and wait up to `timeout` seconds for the ones in flight;
+        returns how many are still in flight."""
+        for scheduler in self.schedulers:
+            scheduler.drain()
+        deadline = time.monotonic() + timeout
+        while True:
+            left = sum(scheduler.in_flight() for scheduler in self.schedulers)
+            if not left or time.monotonic() >= deadline:
+                return left
+            time.sleep(DRAIN_POLL_INTERVAL)
+
+    def _stop(self, timeout):
+        if self.schedulers:
+            print("Draining deliveries...")
+            left = self.drain(timeout)
+            if left:
+                print(f"{left} emails still sending after {timeout:g}s; they are requeued by the next start")
+            save_warm_state()
+        smtp_pool.close_all()
+        for hook in self.exit_hooks:
+            try:
+                hook()
+            except Exception as e:
+                print(f"Failed to run an exit hook: {e}")
+
+    def shutdown(self, timeout=DRAIN_TIMEOUT):
+        """Drain, hand over the warm state and exit."""
+        if not self._stopping.acquire(blocking=False):
+            return
+        self._stop(timeout)
+        os._exit(0)
+
+    def restart(self, timeout=DRAIN_TIMEOUT):
+        """Drain, then replace this process with a fresh one that reads .env again and carries on with the
+        queue, the quotas and the circuit breakers where this one left off."""
+        if not self._stopping.acquire(blocking=False):
+            return
+        self._stop(timeout)
+        print("Restarting the server...")
+        load_dotenv(override=True)
+        os.execl(sys.executable, sys.executable, *sys.argv)
+
+    def handle_signals(self, restart=True):
+        """Drain and exit on SIGTERM, and with `restart`, drain and restart on SIGHUP. Both run in the
+        background, so requests are still accepted while the deliveries in flight finish."""
+
+        def handler(action):
+            return lambda *_: threading.Thread(target=action, name="lifecycle", daemon=True).start()
+
+        signal.signal(signal.SIGTERM, handler(self.shutdown))
+        if restart and hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, handler(self.restart))
+
+
+# Shared lifecycle of the delivery engine started by this process
+delivery_lifecycle = DeliveryLifecycle()
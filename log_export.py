@@ -0,0 +1,137 @@
+import csv
+import io
+import json
+import os
+import re
+import zlib
+from datetime import datetime
+
+from log_reader import LogReader, parse_line
+
+EXPORT_FORMATS = ("csv", "ndjson")
+
+# Output gathered before it is handed on (and compressed) as one chunk
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+SENDER_COLUMN = 1
+RECIPIENT_COLUMN = 2
+STATUS_COLUMN = 5
+
+# Rotated logs are renamed to "<log>.<%Y%m%d%H%M%S%f>" by the log writer
+ROTATED_SUFFIX = re.compile(r"\.(\d{20})")
+
+DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S")
+
+
+def parse_date_bound(value):
+    """Normalise a "%Y-%m-%d[ %H:%M:%S]" range bound to the log's date format; raises ValueError if it isn't one."""
+    for date_format in DATE_FORMATS:
+        try:
+            parsed = datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+        return parsed.strftime("%Y-%m-%d") if date_format == "%Y-%m-%d" else parsed.strftime("%Y-%m-%d %H:%M:%S")
+    raise ValueError(f"Invalid date {value!r}, expected YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+
+
+def log_files(path, start=None):
+    """The log and those of its rotated files that may hold rows from `start` on, oldest first."""
+    directory = os.path.dirname(path) or "."
+    base = os.path.basename(path)
+    rotated = []
+    for name in os.listdir(directory):
+        match = ROTATED_SUFFIX.fullmatch(name[len(base):]) if name.startswith(base) else None
+        if match is None:
+            continue
+        # Every row of a rotated file was written before the file was rotated
+        rotated_at = datetime.strptime(match.group(1), "%Y%m%d%H%M%S%f").strftime("%Y-%m-%d %H:%M:%S")
+        if start is None or rotated_at >= start:
+            rotated.append((match.group(1), os.path.join(directory, name)))
+    return [rotated_path for _, rotated_path in sorted(rotated)] + [path]
+
+
+def recipient_domain(recipient):
+    return recipient.rsplit("@", 1)[-1].strip(" >").lower()
+
+
+def iter_log_rows(path, start=None, end=None, statuses=None, domain=None, sender=None):
+    """Yield the logged rows in a date range, optionally only those with one of `statuses` (by the first
+    word, e.g. "failed"), a recipient at `domain` or sent from `sender`.
+
+    Only the log files that can hold the range are read, and each from the first day of the range on.
+    """
+    statuses = {status.lower() for status in statuses} if statuses else None
+    domain = domain.lower() if domain else None
+    sender = sender.lower() if sender else None
+    for log_path in log_files(path, start):
+        if not os.path.exists(log_path):
+            continue
+        for row in LogReader(log_path).iter_range(start, end):
+            if len(row) <= STATUS_COLUMN:
+                continue
+            if statuses and row[STATUS_COLUMN].split(" ", 1)[0].lower() not in statuses:
+                continue
+            if domain and recipient_domain(row[RECIPIENT_COLUMN]) != domain:
+                continue
+            if sender and row[SENDER_COLUMN].lower() != sender:
+                continue
+            yield row
+
+
+def read_header(path):
+    """Column names from the first line of the log (or of its newest rotated file), or [] if there is none."""
+    for log_path in reversed(log_files(path)):
+        try:
+            with open(log_path, "rb") as file:
+                header = parse_line(file.readline())
+        except OSError:
+            continue
+        if header:
+            return header
+    return []
+
+
+def format_rows(rows, header, output_format="csv"):
+    """Yield the rows as CSV (header first) or as NDJSON objects keyed by the header, in chunks of text."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if output_format == "csv":
+        writer.writerow(header)
+    for row in rows:
+        if output_format == "csv":
+            writer.writerow(row)
+        else:
+            record = dict(zip(header, row))
+            if len(row) > len(header):
+                record["Error Details"] = row[len(header)]
+            buffer.write(json.dumps(record) + "\n")
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_chunks(chunks):
+    """Gzip a stream of byte chunks as it goes."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_log(path, output_format="csv", compress=False, start=None, end=None, statuses=None, domain=None, sender=None):
+    """Yield the filtered log as bytes in `output_format`, gzipped if `compress`; see iter_log_rows for the filters.
+
+    Memory use stays at about one chunk whatever the size of the log.
+    """
+    rows = iter_log_rows(path, start, end, statuses, domain, sender)
+    chunks = (text.encode("utf-8") for text in format_rows(rows, read_header(path), output_format))
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def export_filename(output_format="csv", compress=False):
+    return f"exported_email_logs_{datetime.now().strftime('%Y%m%d%H%M%S')}.{output_format}{'.gz' if compress else ''}"
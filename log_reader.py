@@ -0,0 +1,178 @@
+import os
+import csv
+import json
+from bisect import bisect_left
+from itertools import islice
+
+# Column holding the "%Y-%m-%d %H:%M:%S" timestamp in email_log.csv
+DATE_COLUMN = 4
+
+# Remember the byte offset of every Nth row in the sidecar index
+INDEX_EVERY = 1000
+
+TAIL_BLOCK_SIZE = 64 * 1024
+
+
+def parse_line(line):
+    """Parse one physical log line into a row (the log writer keeps every row on a single line)."""
+    return next(csv.reader([line.decode("utf-8", "replace")]), [])
+
+
+class LogReader:
+    """Seekable reader for the CSV delivery log, backed by a sidecar offset index.
+
+    The index (`<log>.idx`) records the byte offset of every INDEX_EVERY-th row and of the first row
+    of each day. It is extended incrementally as the log grows and rebuilt if the log is rotated.
+    """
+
+    def __init__(self, path, index_every=INDEX_EVERY):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.index_every = index_every
+        self._index = None
+
+    def _empty_index(self):
+        return {"inode": None, "size": 0, "rows": 0, "header": "", "row_offsets": [], "days": [], "day_offsets": []}
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(self.index_path) as file:
+                    self._index = json.load(file)
+            except (OSError, ValueError):
+                self._index = self._empty_index()
+        return self._index
+
+    def refresh_index(self):
+        """Index whatever was appended since the last call; rebuild from scratch if the log was replaced."""
+        index = self._load_index()
+        stat = os.stat(self.path)
+        size = stat.st_size
+        with open(self.path, "rb") as file:
+            header = file.readline()
+            if stat.st_ino != index["inode"] or size < index["size"] or header.decode("utf-8", "replace") != index["header"]:
+                index = self._index = self._empty_index()
+                index["inode"] = stat.st_ino
+                index["header"] = header.decode("utf-8", "replace")
+                index["size"] = len(header)
+            if size == index["size"]:
+                return index
+
+            file.seek(index["size"])
+            offset, rows = index["size"], index["rows"]
+            last_day = index["days"][-1] if index["days"] else None
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break  # partially written row; index it next time
+                if rows % self.index_every == 0:
+                    index["row_offsets"].append(offset)
+                row = parse_line(line)
+                day = row[DATE_COLUMN][:10] if len(row) > DATE_COLUMN else None
+                if day and day != last_day and (last_day is None or day > last_day):
+                    index["days"].append(day)
+                    index["day_offsets"].append([offset, rows])
+                    last_day = day
+                offset += len(line)
+                rows += 1
+            index["size"], index["rows"] = offset, rows
+
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(index, file)
+        os.replace(temp_path, self.index_path)
+        return index
+
+    def count(self):
+        """Number of data rows in the log."""
+        if not os.path.exists(self.path):
+            return 0
+        return self.refresh_index()["rows"]
+
+    def iter_lines_reversed(self):
+        """Yield the raw data lines of the log newest first, reading blocks backwards from the end."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as file:
+            header_size = len(file.readline())
+            position = file.seek(0, os.SEEK_END)
+            partial = b""
+            while position > header_size:
+                step = min(TAIL_BLOCK_SIZE, position - header_size)
+                position -= step
+                file.seek(position)
+                lines = (file.read(step) + partial).split(b"\n")
+                # The first piece may continue in the previous block
+                partial = lines.pop(0)
+                for line in reversed(lines):
+                    if line.strip():
+                        yield line
+            if partial.strip():
+                yield partial
+
+    def tail(self, count):
+        """Yield the last `count` rows, oldest first, reading backwards from the end of the file."""
+        if count <= 0:
+            return
+        lines = list(islice(self.iter_lines_reversed(), count))
+        for line in reversed(lines):
+            yield parse_line(line)
+
+    def find_latest(self, request_id):
+        """Return the newest row logged for a request ID, searching backwards from the end, or None."""
+        needle = request_id.encode()
+        for line in self.iter_lines_reversed():
+            if line.startswith(needle):
+                row = parse_line(line)
+                if row and row[0] == request_id:
+                    return row
+        return None
+
+    def iter_rows(self, start_row=0):
+        """Yield rows from row number `start_row` (0-based) to the end of the log."""
+        if not os.path.exists(self.path):
+            return
+        index = self.refresh_index()
+        slot = min(start_row // self.index_every, len(index["row_offsets"]) - 1)
+        with open(self.path, "rb") as file:
+            if slot >= 0:
+                file.seek(index["row_offsets"][slot])
+                row_number = slot * self.index_every
+            else:
+                file.readline()
+                row_number = 0
+            for line in file:
+                if row_number >= start_row:
+                    yield parse_line(line)
+                row_number += 1
+
+    def page(self, page, page_size=50):
+        """Yield the rows of a 0-based page."""
+        for number, row in enumerate(self.iter_rows(page * page_size)):
+            if number >= page_size:
+                return
+            yield row
+
+    def iter_range(self, start=None, end=None):
+        """Yield rows whose date falls in [start, end]; dates are "%Y-%m-%d[ %H:%M:%S]" strings.
+
+        Seeks straight to the first day of the range, relying on the log being written in date order.
+        """
+        if not os.path.exists(self.path):
+            return
+        index = self.refresh_index()
+        with open(self.path, "rb") as file:
+            position = bisect_left(index["days"], start[:10]) if start else 0
+            if position < len(index["days"]):
+                file.seek(index["day_offsets"][position][0])
+            elif start:
+                return
+            else:
+                file.readline()
+            for line in file:
+                row = parse_line(line)
+                date = row[DATE_COLUMN] if len(row) > DATE_COLUMN else ""
+                if start and date < start:
+                    continue
+                if end and date[:len(end)] > end:
+                    return
+                yield row
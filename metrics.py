@@ -0,0 +1,287 @@
+import os
+import json
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Every metric defined in this process, in the order it is rendered
+REGISTRY = []
+
+# In multi-process mode every delivery process publishes its metrics to this directory (set by the
+# supervisor), and /metrics adds them to the serving process's own
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_PUBLISH_INTERVAL = 1.0
+
+
+def reply_class(code):
+    """Group an SMTP reply code as "2xx", "4xx", "5xx", or "none" if the server never answered."""
+    return f"{code // 100}xx" if code else "none"
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _ShardOwner:
+    """Held only by its thread's threading.local, so it is collected when the thread exits."""
+
+    __slots__ = ("__weakref__",)
+
+
+class _Shards:
+    """One dict per thread: each thread only ever writes its own, so updates take no lock.
+
+    Scrapes add the shards up; reading a value another thread is updating just gives the old value. When a
+    thread exits, `fold(retired, shard)` adds its shard into one shared dict, so request threads and retired
+    workers don't leave a shard each behind.
+    """
+
+    def __init__(self, fold):
+        self._local = threading.local()
+        self._shards = {}
+        self._retired = {}
+        self._fold = fold
+        self._lock = threading.Lock()
+
+    def mine(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            owner = self._local.owner = _ShardOwner()
+            with self._lock:
+                self._shards[id(shard)] = shard
+            weakref.finalize(owner, self._retire, shard)
+            return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            del self._shards[id(shard)]
+            self._fold(self._retired, shard)
+
+    def all(self):
+        with self._lock:
+            return [self._retired, *self._shards.values()]
+
+
+class Counter:
+    """Monotonic counter with labels, e.g. Counter("emails_total", "...", ("outcome",)).inc("sent")."""
+
+    kind = "counter"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._shards = _Shards(self._fold)
+        REGISTRY.append(self)
+
+    @staticmethod
+    def _fold(totals, shard):
+        for labels, value in shard.items():
+            totals[labels] = totals.get(labels, 0) + value
+
+    def inc(self, *labels, amount=1):
+        shard = self._shards.mine()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def values(self):
+        totals = {}
+        for shard in self._shards.all():
+            for labels, value in list(shard.items()):
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def snapshot(self, totals=None):
+        """This process's values (or `totals`) in the JSON form other processes read."""
+        return [[list(labels), value] for labels, value in (self.values() if totals is None else totals).items()]
+
+    def merge(self, snapshots, totals=None):
+        """Add published snapshots into `totals` (a new dict by default) and return it."""
+        totals = {} if totals is None else totals
+        for snapshot in snapshots:
+            for labels, value in snapshot:
+                labels = tuple(labels)
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def render(self, snapshots=()):
+        totals = self.merge(snapshots, self.values())
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+                for labels, value in sorted(totals.items())]
+
+
+class Gauge(Counter):
+    """A value that goes up and down; either tracked with inc()/dec() or read from `function` at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name, description, labelnames=(), function=None):
+        super().__init__(name, description, labelnames)
+        self.function = function
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def values(self):
+        if self.function is None:
+            return super().values()
+        try:
+            return {(): self.function()}
+        except Exception:
+            return {}
+
+    def snapshot(self, totals=None):
+        # A function gauge reads shared state (the queue, ...) that every process would report alike
+        return [] if self.function else super().snapshot(totals)
+
+
+class Histogram:
+    """Latency histogram with one label, using fixed buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labelname, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelname = labelname
+        self.buckets = buckets
+        self._shards = _Shards(self._fold)
+        REGISTRY.append(self)
+
+    @staticmethod
+    def _fold(totals, shard):
+        for label, counts in shard.items():
+            total = totals.setdefault(label, [0] * len(counts))
+            for slot, value in enumerate(counts):
+                total[slot] += value
+
+    def observe(self, label, seconds):
+        shard = self._shards.mine()
+        counts = shard.get(label)
+        if counts is None:
+            # One slot per bucket, one for +Inf, then the running sum
+            counts = shard[label] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, seconds)] += 1
+        counts[-1] += seconds
+
+    def values(self):
+        totals = {}
+        for shard in self._shards.all():
+            for label, counts in list(shard.items()):
+                total = totals.setdefault(label, [0] * len(counts))
+                for slot, value in enumerate(counts):
+                    total[slot] += value
+        return totals
+
+    def snapshot(self, totals=None):
+        return list((self.values() if totals is None else totals).items())
+
+    def merge(self, snapshots, totals=None):
+        totals = {} if totals is None else totals
+        for snapshot in snapshots:
+            for label, counts in snapshot:
+                total = totals.setdefault(label, [0] * len(counts))
+                for slot, value in enumerate(counts):
+                    total[slot] += value
+        return totals
+
+    def render(self, snapshots=()):
+        totals = self.merge(snapshots, self.values())
+        lines = []
+        for label, counts in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels((self.labelname,), (label,), le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels((self.labelname,), (label,))} {counts[-1]}")
+            lines.append(f"{self.name}_count{_format_labels((self.labelname,), (label,))} {cumulative}")
+        return lines
+
+
+def _write_snapshot(path, snapshot):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(snapshot, file)
+    os.replace(temp_path, path)
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_metrics(directory=METRICS_DIR):
+    """Write this process's metrics to `directory` once, e.g. just before it exits."""
+    _write_snapshot(os.path.join(directory, f"{os.getpid()}.json"), {metric.name: metric.snapshot() for metric in REGISTRY})
+
+
+def publish_metrics(directory=METRICS_DIR, interval=METRICS_PUBLISH_INTERVAL):
+    """Write this process's metrics to `directory` every `interval` seconds, from a background thread."""
+
+    def publish():
+        while True:
+            try:
+                write_metrics(directory)
+            except OSError as e:
+                # Keep publishing: a full disk or a removed directory may come right again
+                print(f"Failed to publish metrics: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=publish, name="metrics-publisher", daemon=True).start()
+
+
+def retire_published_metrics(directory, pid):
+    """Fold the counters and histograms a dead process published into retired.json, so totals never go
+    backwards; its gauges are dropped."""
+    path = os.path.join(directory, f"{pid}.json")
+    retired_path = os.path.join(directory, "retired.json")
+    dead, retired = _read_snapshot(path), _read_snapshot(retired_path)
+    merged = {}
+    for metric in REGISTRY:
+        if metric.kind != "gauge":
+            snapshots = [snapshot[metric.name] for snapshot in (dead, retired) if metric.name in snapshot]
+            merged[metric.name] = metric.snapshot(metric.merge(snapshots))
+    _write_snapshot(retired_path, merged)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def read_published_metrics(directory=METRICS_DIR):
+    """The snapshots other processes published to `directory`."""
+    if not directory:
+        return []
+    own = f"{os.getpid()}.json"
+    return [_read_snapshot(os.path.join(directory, name))
+            for name in os.listdir(directory) if name.endswith(".json") and name != own]
+
+
+def render_metrics():
+    """Every registered metric in the Prometheus text exposition format, including other processes' published metrics."""
+    published = read_published_metrics()
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render([snapshot[metric.name] for snapshot in published if metric.name in snapshot]))
+    return "\n".join(lines) + "\n"
+
+
+# Delivery metrics shared by the thread workers, the async engine and the retry scheduler
+SMTP_PHASE_SECONDS = Histogram("smtp_phase_seconds", "Time spent in each phase of an SMTP delivery.", "phase")
+EMAIL_DELIVERIES = Counter("email_deliveries_total", "Delivery attempts by outcome and SMTP reply class.",
+                           ("outcome", "reply_class"))
+DELIVERIES_IN_PROGRESS = Gauge("email_deliveries_in_progress", "Deliveries currently being attempted.")
@@ -0,0 +1,115 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+# While a profile runs, the stack of every thread is sampled every PROFILE_SAMPLE_INTERVAL seconds;
+# a profile runs for at most PROFILE_MAX_SECONDS
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", 0.005))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 300))
+
+# "delivery-worker-12" and "Thread-7 (process_request_thread)" are grouped by what they run
+THREAD_NUMBER = re.compile(r"-\d+")
+
+
+def thread_group(name):
+    return THREAD_NUMBER.sub("", name)
+
+
+class SamplingProfiler:
+    """Statistical profiler for every thread of the process, meant to be switched on for a few seconds
+    while the server is under load.
+
+    A background thread reads all threads' current frames at a fixed interval, so the profiled code runs
+    unchanged; the result is a count per distinct stack, in the collapsed format that flame graph tools
+    (flamegraph.pl, speedscope, ...) read: "thread;module:function;...;module:function count".
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.seconds = 0.0
+        self._labels = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds):
+        """Start sampling for `seconds` (capped at PROFILE_MAX_SECONDS), dropping the previous profile.
+
+        Returns False if a profile is already running.
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self.stacks = Counter()
+            self.samples = 0
+            self.started_at = time.time()
+            self.seconds = min(seconds, PROFILE_MAX_SECONDS)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(self.seconds,), name="profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+
+    def wait(self, timeout=None):
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def profile(self, seconds):
+        """Sample for `seconds` and return the collapsed stacks, or None if a profile is already running."""
+        if not self.start(seconds):
+            return None
+        self.wait()
+        return self.collapsed()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            label = self._labels[code] = f"{module}:{code.co_name}"
+        return label
+
+    def _run(self, seconds):
+        own = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(thread_group(names.get(ident, "unknown")))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            self._stop.wait(self.interval)
+
+    def collapsed(self):
+        """The last profile as collapsed stacks, one "stack count" line each, most frequent first."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, count=10):
+        """(function, share of samples) for the functions most often on top of a stack in the last profile."""
+        leaves = Counter()
+        for stack, samples in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += samples
+        total = sum(leaves.values()) or 1
+        return [(function, samples / total) for function, samples in leaves.most_common(count)]
+
+
+# Shared profiler used by the admin route and the admin terminal
+profiler = SamplingProfiler()
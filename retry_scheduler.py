@@ -0,0 +1,126 @@
+import os
+import errno
+import heapq
+import random
+import smtplib
+import socket
+import threading
+import time
+
+from circuit_breaker import CircuitOpenError
+from metrics import EMAIL_DELIVERIES, reply_class
+
+# Retry settings
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 3))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 5))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 600))
+
+PERMANENT = "permanent"
+TRANSIENT = "transient"
+
+# Failures to reach the server that may clear up by the next attempt; other OS errors, such as a deleted
+# attachment file, would fail the same way again
+TRANSIENT_ERRORS = (smtplib.SMTPServerDisconnected, TimeoutError, ConnectionError, socket.gaierror)
+NETWORK_ERRNOS = {errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ENETDOWN, errno.EHOSTDOWN}
+
+
+def reply_code(error):
+    """The SMTP reply code behind an exception, or None if the server never answered."""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and error.recipients:
+        codes = [code for code, _ in error.recipients.values()]
+        # Only retry if every recipient was refused temporarily
+        return max(codes)
+    return None
+
+
+def classify_error(error):
+    """Return PERMANENT or TRANSIENT for a delivery failure.
+
+    4xx replies and network errors (dropped connections, timeouts, refused connects, failed lookups) are
+    worth retrying; 5xx replies, other SMTP errors without a reply code and anything else, file errors
+    included, are not. A rejected login is the sending account's fault rather than the email's, so it is
+    retried too, possibly from another account.
+    """
+    if isinstance(error, (CircuitOpenError, smtplib.SMTPAuthenticationError)):
+        return TRANSIENT
+    code = reply_code(error)
+    if code is not None:
+        return TRANSIENT if 400 <= code < 500 else PERMANENT
+    # SMTPException is an OSError too, so the SMTP errors worth retrying are matched first
+    if isinstance(error, TRANSIENT_ERRORS):
+        return TRANSIENT
+    if isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException) and error.errno in NETWORK_ERRNOS:
+        return TRANSIENT
+    return PERMANENT
+
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """Exponential backoff with jitter: somewhere between half and all of base * 2^(attempt - 1)."""
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class RetryScheduler:
+    """Time-ordered delay queue for failed deliveries.
+
+    A failed job is parked in the queue as "deferred" and its due time goes on a heap; a timer thread
+    makes it leasable again when it is due, so no worker ever sleeps on a backoff.
+    """
+
+    def __init__(self, queue, record=None, max_attempts=RETRY_MAX_ATTEMPTS):
+        self.queue = queue
+        self.record = record
+        self.max_attempts = max_attempts
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="retry-scheduler", daemon=True)
+            self._thread.start()
+
+    def schedule(self, request_id, delay):
+        """Make a deferred job leasable again after `delay` seconds."""
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, request_id))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, request_id = heapq.heappop(self._heap)
+            try:
+                self.queue.release(request_id)
+            except Exception as e:
+                print(f"[{request_id}] Failed to requeue deferred email: {e}")
+
+    def handle_failure(self, job, error):
+        """Defer a failed job for a retry if the failure is transient and attempts remain; otherwise fail it.
+
+        Returns the status that was recorded.
+        """
+        if isinstance(error, CircuitOpenError):
+            # Nothing was sent, so wait for the breaker to let calls through again without using up an attempt
+            delay = random.uniform(error.retry_after, error.retry_after + RETRY_BASE_DELAY)
+            status = f"deferred ({error})"
+            self.queue.defer(job.request_id, delay, str(error), attempted=False)
+            self.schedule(job.request_id, delay)
+            EMAIL_DELIVERIES.inc("deferred", reply_class(None))
+        elif classify_error(error) == TRANSIENT and job.attempts < self.max_attempts:
+            delay = backoff_delay(job.attempts)
+            status = f"deferred ({error})"
+            self.queue.defer(job.request_id, delay, str(error))
+            self.schedule(job.request_id, delay)
+            EMAIL_DELIVERIES.inc("deferred", reply_class(reply_code(error)))
+        else:
+            status = f"failed ({error})"
+            self.queue.complete(job.request_id, status)
+            EMAIL_DELIVERIES.inc("failed", reply_class(reply_code(error)))
+        if self.record:
+            self.record(job, status)
+        return status
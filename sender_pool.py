@@ -0,0 +1,299 @@
+import csv
+import math
+import os
+import smtplib
+import threading
+import time
+from collections import deque
+
+from circuit_breaker import circuit_breakers
+from retry_scheduler import reply_code
+
+# Sending accounts, one per row of SENDER_ACCOUNTS_FILE: key,email,app_password and optionally name, weight,
+# per_minute and per_day. Without any there, the USER_EMAIL / USER_APP_PASSWORD account from .env is the only
+# one. The file is read again when it changes, which is checked at most every SENDER_ACCOUNTS_RELOAD_INTERVAL s
+SENDER_ACCOUNTS_FILE = os.getenv("SENDER_ACCOUNTS_FILE", "data.csv")
+SENDER_ACCOUNTS_RELOAD_INTERVAL = float(os.getenv("SENDER_ACCOUNTS_RELOAD_INTERVAL", 5))
+
+# Quotas of accounts whose row doesn't set them: most sends per sliding minute and day, 0 meaning unlimited
+SENDER_PER_MINUTE = int(os.getenv("SENDER_PER_MINUTE", 0))
+SENDER_PER_DAY = int(os.getenv("SENDER_PER_DAY", 0))
+
+# An account the server throttles (a 4xx reply to the account rather than to a recipient) is taken out of
+# rotation for this many seconds
+SENDER_COOLOFF_SECONDS = float(os.getenv("SENDER_COOLOFF_SECONDS", 300))
+
+# Delivery processes sharing the quotas (set by the supervisor); each one keeps to its share
+DELIVERY_PROCESS_COUNT = int(os.getenv("DELIVERY_PROCESS_COUNT", 1))
+
+
+def is_throttled(error):
+    """True if a delivery error says the sending account should back off.
+
+    That is a 4xx reply to the login, MAIL FROM or DATA, or a 421 (closing the connection) at any point.
+    Other 4xx replies to RCPT are about the recipient, e.g. a full mailbox or greylisting.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return any(code == 421 for code, _ in error.recipients.values())
+    code = reply_code(error)
+    return code is not None and 400 <= code < 500
+
+
+class SlidingWindow:
+    """Sends in the last `seconds`, counted per second, and a `limit` on them (0 for none)."""
+
+    __slots__ = ("limit", "seconds", "entries", "used")
+
+    def __init__(self, limit, seconds):
+        self.limit = limit
+        self.seconds = seconds
+        self.entries = deque()
+        self.used = 0
+
+    def _expire(self, now):
+        while self.entries and self.entries[0][0] <= now - self.seconds:
+            self.used -= self.entries.popleft()[1]
+
+    def count(self, now):
+        self._expire(now)
+        return self.used
+
+    def remaining(self, now):
+        return self.limit - self.count(now) if self.limit else math.inf
+
+    def wait_time(self, now):
+        """Seconds until the limit allows another send (0 if it does now)."""
+        if self.remaining(now) > 0:
+            return 0.0
+        used = self.used
+        for second, count in self.entries:
+            used -= count
+            if used < self.limit:
+                return second + self.seconds - now
+        return 0.0
+
+    def export_state(self, now):
+        """The sends in the window as [seconds ago, count] pairs."""
+        self._expire(now)
+        return [[now - second, count] for second, count in self.entries]
+
+    def import_state(self, entries, now):
+        self.entries = deque([math.floor(now - age), count] for age, count in entries)
+        self.used = sum(count for _, count in self.entries)
+        self._expire(now)
+
+    def add(self, now, count):
+        second = math.floor(now)
+        if self.entries and self.entries[-1][0] == second:
+            self.entries[-1][1] += count
+        else:
+            self.entries.append([second, count])
+        self.used += count
+
+
+class SenderAccount:
+    """A sending account with its credentials, share of the traffic, quotas and cool-off."""
+
+    __slots__ = ("email", "password", "name", "weight", "current_weight", "minute", "day", "cooling_until",
+                 "sent", "throttled")
+
+    def __init__(self, email, password, name=None, weight=1, per_minute=0, per_day=0):
+        self.email = email
+        self.password = password
+        self.name = name
+        self.weight = weight
+        # Smooth weighted round-robin state
+        self.current_weight = 0
+        self.minute = SlidingWindow(per_minute, 60)
+        self.day = SlidingWindow(per_day, 24 * 3600)
+        self.cooling_until = 0.0
+        self.sent = 0
+        self.throttled = 0
+
+    def configure(self, password, name, weight, per_minute, per_day):
+        self.password = password
+        self.name = name
+        self.weight = weight
+        self.minute.limit = per_minute
+        self.day.limit = per_day
+
+    def wait_time(self, now):
+        """Seconds until the account may send again: after its cool-off, and once both quotas allow it."""
+        return max(self.cooling_until - now, self.minute.wait_time(now), self.day.wait_time(now), 0.0)
+
+    def remaining(self, now):
+        return min(self.minute.remaining(now), self.day.remaining(now))
+
+
+def quota_share(value):
+    return math.ceil(value / DELIVERY_PROCESS_COUNT) if value else 0
+
+
+class SenderPool:
+    """The sending accounts, spread over by weight within their quotas, with throttled ones left to cool off.
+
+    Accounts keep their quota and cool-off state across reloads of the accounts file, as long as their
+    email address stays in it.
+    """
+
+    def __init__(self, path=SENDER_ACCOUNTS_FILE):
+        self.path = path
+        self._accounts = {}
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._checked = None
+
+    def _refresh_locked(self, now):
+        if self._checked is not None and now - self._checked < SENDER_ACCOUNTS_RELOAD_INTERVAL:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if self._loaded is not None and mtime == self._loaded:
+            return
+        source = self.path
+        try:
+            rows = list(self._read_rows()) if mtime is not None else []
+            if not rows:
+                rows, source = list(self._env_rows()), ".env"
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Failed to load sending accounts from {self.path}, keeping the current ones: {e}")
+            self._loaded = mtime
+            return
+        accounts = {}
+        for email, password, name, weight, per_minute, per_day in rows:
+            account = self._accounts.get(email.lower()) or SenderAccount(email, password)
+            account.configure(password, name, weight, quota_share(per_minute), quota_share(per_day))
+            accounts[email.lower()] = account
+        self._accounts = accounts
+        if self._loaded is not None or mtime is not None:
+            print(f"Loaded {len(accounts)} sending accounts from {source}")
+        self._loaded = mtime
+
+    def _read_rows(self):
+        default_name = os.getenv("EMAIL_FROM_NAME")
+        with open(self.path, newline="") as file:
+            for row in csv.DictReader(file):
+                if not row.get("email") or not row.get("app_password"):
+                    continue
+                yield (row["email"].strip(), row["app_password"].strip(), (row.get("name") or "").strip() or default_name,
+                       max(1, int(row.get("weight") or 1)), int(row.get("per_minute") or SENDER_PER_MINUTE),
+                       int(row.get("per_day") or SENDER_PER_DAY))
+
+    @staticmethod
+    def _env_rows():
+        email, password = os.getenv("USER_EMAIL"), os.getenv("USER_APP_PASSWORD")
+        if email and password:
+            yield email, password, os.getenv("EMAIL_FROM_NAME"), 1, SENDER_PER_MINUTE, SENDER_PER_DAY
+
+    def has_accounts(self):
+        with self._lock:
+            self._refresh_locked(time.monotonic())
+            return bool(self._accounts)
+
+    def _account_locked(self, email):
+        # Emails queued with a fixed sender before the pool existed keep it; if it has left the pool,
+        # it is sent with the .env password as before
+        return self._accounts.get(email.lower()) or SenderAccount(email, os.getenv("USER_APP_PASSWORD"),
+                                                                 os.getenv("EMAIL_FROM_NAME"))
+
+    def choose(self, now, usable, email=None):
+        """Pick the account for the next send: the account of `email` if given, else one of the pool by
+        smooth weighted round-robin among those under quota, not cooling off, without an open circuit breaker
+        and allowed by `usable`.
+
+        `usable(account)` returns None while the account can't send, or the seconds until it can.
+        Returns (account, 0), or (None, seconds until an account may be free, or None if none will be by then).
+        """
+        with self._lock:
+            self._refresh_locked(now)
+            accounts = [self._account_locked(email)] if email else self._accounts.values()
+            candidates, wait = [], None
+            for account in accounts:
+                account_wait = usable(account)
+                if account_wait is None:
+                    continue
+                account_wait = max(account_wait, account.wait_time(now), circuit_breakers.account_wait_time(account.email, now))
+                if account_wait == 0:
+                    candidates.append(account)
+                else:
+                    wait = account_wait if wait is None else min(wait, account_wait)
+            if not candidates:
+                return None, wait
+            total, best = 0, None
+            for account in candidates:
+                account.current_weight += account.weight
+                total += account.weight
+                if best is None or account.current_weight > best.current_weight:
+                    best = account
+            best.current_weight -= total
+            return best, 0
+
+    def charge(self, account, count, now):
+        """Count `count` sends against an account's quotas."""
+        with self._lock:
+            account.minute.add(now, count)
+            account.day.add(now, count)
+            account.sent += count
+
+    def report(self, account, error):
+        """Take an account out of rotation for a while if the server throttled it."""
+        if error is None or not is_throttled(error):
+            return
+        with self._lock:
+            account.cooling_until = time.monotonic() + SENDER_COOLOFF_SECONDS
+            account.throttled += 1
+        print(f"Sending account {account.email} is throttled, out of rotation for {SENDER_COOLOFF_SECONDS:g}s: {error}")
+
+    def export_state(self):
+        """Quota use and cool-off of every account, for the process that takes over after a restart."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                email: {
+                    "minute": account.minute.export_state(now),
+                    "day": account.day.export_state(now),
+                    "cooling_off": max(0.0, account.cooling_until - now),
+                    "sent": account.sent,
+                    "throttled": account.throttled,
+                }
+                for email, account in self._accounts.items()
+            }
+
+    def import_state(self, state, elapsed=0.0):
+        """Take over what export_state() returned `elapsed` seconds ago, for the accounts still in the pool."""
+        now = time.monotonic()
+        with self._lock:
+            self._refresh_locked(now)
+            for email, saved in state.items():
+                account = self._accounts.get(email)
+                if account is None:
+                    continue
+                account.minute.import_state([(age + elapsed, count) for age, count in saved["minute"]], now)
+                account.day.import_state([(age + elapsed, count) for age, count in saved["day"]], now)
+                account.cooling_until = now + saved["cooling_off"] - elapsed
+                account.sent = saved["sent"]
+                account.throttled = saved["throttled"]
+
+    def get_stats(self):
+        """Sends, quotas and cool-off of every account in the pool."""
+        now = time.monotonic()
+        with self._lock:
+            self._refresh_locked(now)
+            return [{
+                "email": account.email,
+                "weight": account.weight,
+                "sent": account.sent,
+                "last_minute": account.minute.count(now),
+                "per_minute": account.minute.limit,
+                "last_day": account.day.count(now),
+                "per_day": account.day.limit,
+                "cooling_off": max(0.0, account.cooling_until - now),
+                "throttled": account.throttled,
+            } for account in self._accounts.values()]
+
+
+# Shared pool used by the intake endpoints, the delivery scheduler and the admin terminal
+sender_pool = SenderPool()
@@ -0,0 +1,322 @@
+import os
+import re
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from circuit_breaker import circuit_breakers
+from email_templates import serialize_message
+from metrics import SMTP_PHASE_SECONDS
+from tracing import tracer
+
+# Pool settings, read once from the environment
+SMTP_POOL_MAX_IDLE_SECONDS = float(os.getenv("SMTP_POOL_MAX_IDLE_SECONDS", 30))
+SMTP_POOL_MAX_MESSAGES = int(os.getenv("SMTP_POOL_MAX_MESSAGES", 100))
+SMTP_POOL_MAX_SESSIONS = int(os.getenv("SMTP_POOL_MAX_SESSIONS", 5))
+
+# Seconds to wait for a connection (and the greeting), and for each reply after that
+SMTP_CONNECT_TIMEOUT = float(os.getenv("SMTP_CONNECT_TIMEOUT", 10))
+SMTP_COMMAND_TIMEOUT = float(os.getenv("SMTP_COMMAND_TIMEOUT", 60))
+
+# Set to false only for a relay on a trusted network, e.g. a local MTA or the benchmark's fake server
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
+
+# Lines starting with a dot must be doubled inside DATA (RFC 5321 section 4.5.2)
+LEADING_DOT = re.compile(rb"(?m)^\.")
+
+
+def _reset_or_close(server, code):
+    # As in smtplib.sendmail: 421 means the server is closing the connection, otherwise abort the transaction
+    if code == 421:
+        server.close()
+        return
+    try:
+        server.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+class StaleSessionError(smtplib.SMTPServerDisconnected):
+    """A reused session's connection dropped before the server accepted MAIL FROM, so nothing of the
+    message reached it and it is safe to send again over a new connection."""
+
+
+def stream_mail(server, from_addr, to_addrs, chunks):
+    """smtplib.SMTP.sendmail, except that DATA is written chunk by chunk from an iterable.
+
+    The chunks must already be dot-stuffed with CRLF line endings, and the last must end with CRLF.
+    Returns the refused recipients like sendmail does. MAIL, RCPT and DATA are timed separately.
+    """
+    started = time.perf_counter()
+    try:
+        server.ehlo_or_helo_if_needed()
+        code, response = server.mail(from_addr)
+    except smtplib.SMTPServerDisconnected as e:
+        raise StaleSessionError(*e.args) from e
+    if code != 250:
+        _reset_or_close(server, code)
+        raise smtplib.SMTPSenderRefused(code, response, from_addr)
+    mailed = time.perf_counter()
+    SMTP_PHASE_SECONDS.observe("mail", mailed - started)
+    refused = {}
+    if len(to_addrs) > 1 and server.has_extn("pipelining"):
+        # An envelope's RCPTs go out together and their replies are read afterwards (RFC 2920)
+        for address in to_addrs:
+            server.putcmd("rcpt", f"TO:{smtplib.quoteaddr(address)}")
+        replies = [server.getreply() for _ in to_addrs]
+    else:
+        replies = (server.rcpt(address) for address in to_addrs)
+    for address, (code, response) in zip(to_addrs, replies):
+        if code not in (250, 251):
+            refused[address] = (code, response)
+        if code == 421:
+            server.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(to_addrs):
+        _reset_or_close(server, 250)
+        raise smtplib.SMTPRecipientsRefused(refused)
+    addressed = time.perf_counter()
+    SMTP_PHASE_SECONDS.observe("rcpt", addressed - mailed)
+    code, response = server.docmd("DATA")
+    if code != 354:
+        _reset_or_close(server, code)
+        raise smtplib.SMTPDataError(code, response)
+    # Hold back the last chunk so the terminator goes out with it; a separate tiny write would wait on a delayed ACK
+    pending = b""
+    for chunk in chunks:
+        if pending:
+            server.send(pending)
+        pending = chunk
+    server.send(pending + b".\r\n")
+    code, response = server.getreply()
+    if code != 250:
+        _reset_or_close(server, code)
+        raise smtplib.SMTPDataError(code, response)
+    SMTP_PHASE_SECONDS.observe("data", time.perf_counter() - addressed)
+    return refused
+
+
+class PooledSession:
+    """An authenticated SMTP session plus the bookkeeping the pool needs."""
+
+    __slots__ = ("server", "created_at", "last_used", "messages_sent", "handshake_seconds")
+
+    def __init__(self, server, handshake_seconds):
+        self.server = server
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages_sent = 0
+        self.handshake_seconds = handshake_seconds
+
+
+class SMTPConnectionPool:
+    """Keep authenticated SMTP sessions warm, keyed by (server, port, sender account)."""
+
+    def __init__(self, max_idle_seconds=SMTP_POOL_MAX_IDLE_SECONDS, max_messages_per_session=SMTP_POOL_MAX_MESSAGES,
+                 max_sessions_per_key=SMTP_POOL_MAX_SESSIONS):
+        self.max_idle_seconds = max_idle_seconds
+        self.max_messages_per_session = max_messages_per_session
+        self.max_sessions_per_key = max_sessions_per_key
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._counters = {
+            "sessions_opened": 0,
+            "sessions_reused": 0,
+            "sessions_evicted_idle": 0,
+            "sessions_retired": 0,
+            "health_check_failures": 0,
+            "reconnects": 0,
+            "messages_sent": 0,
+            "handshake_seconds_total": 0.0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _open(self, host, port, username, password):
+        """Connect, upgrade to TLS and log in, timing the whole handshake."""
+        started = time.perf_counter()
+        server = smtplib.SMTP(host, port, timeout=SMTP_CONNECT_TIMEOUT)
+        try:
+            server.sock.settimeout(SMTP_COMMAND_TIMEOUT)
+            connected = time.perf_counter()
+            if SMTP_STARTTLS:
+                server.starttls()
+            secured = time.perf_counter()
+            server.login(username, password)
+        except Exception:
+            self._close(server)
+            raise
+        finished = time.perf_counter()
+        SMTP_PHASE_SECONDS.observe("connect", connected - started)
+        SMTP_PHASE_SECONDS.observe("starttls", secured - connected)
+        SMTP_PHASE_SECONDS.observe("auth", finished - secured)
+        elapsed = finished - started
+        self._count("sessions_opened")
+        self._count("handshake_seconds_total", elapsed)
+        return PooledSession(server, elapsed)
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _is_healthy(session):
+        """RSET clears any half-finished transaction and proves the server is still there."""
+        try:
+            code, _ = session.server.rset()
+            return code == 250
+        except Exception:
+            return False
+
+    def _evict_idle_locked(self, now):
+        """Drop sessions that sat idle past the limit. Caller holds the lock."""
+        expired = []
+        for key, sessions in list(self._idle.items()):
+            keep = []
+            for session in sessions:
+                if now - session.last_used > self.max_idle_seconds:
+                    expired.append(session)
+                else:
+                    keep.append(session)
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+        self._counters["sessions_evicted_idle"] += len(expired)
+        return expired
+
+    def _acquire(self, key):
+        """Return a healthy idle session for the key, or None if a new one is needed."""
+        while True:
+            with self._lock:
+                expired = self._evict_idle_locked(time.monotonic())
+                sessions = self._idle.get(key)
+                session = sessions.pop() if sessions else None
+            for stale in expired:
+                self._close(stale.server)
+            if session is None:
+                return None
+            if self._is_healthy(session):
+                self._count("sessions_reused")
+                return session
+            self._count("health_check_failures")
+            self._close(session.server)
+
+    def _release(self, key, session):
+        """Put a session back for reuse, or retire it once it has carried enough messages."""
+        session.last_used = time.monotonic()
+        if session.messages_sent >= self.max_messages_per_session:
+            self._count("sessions_retired")
+            self._close(session.server)
+            return
+        with self._lock:
+            sessions = self._idle.setdefault(key, [])
+            if len(sessions) < self.max_sessions_per_key:
+                sessions.append(session)
+                return
+        self._close(session.server)
+
+    @contextmanager
+    def session(self, host, port, username, password):
+        """Borrow an authenticated SMTP session; it goes back to the pool unless the connection broke.
+
+        Raises CircuitOpenError at once, without connecting, while the host's or the account's breaker is open.
+        """
+        key = (host, port, username)
+        with tracer.span("connect") as span:
+            breakers = circuit_breakers.check(host, port, username)
+            try:
+                session = self._acquire(key)
+                handshake_seconds = 0.0
+                if session is None:
+                    session = self._open(host, port, username, password)
+                    handshake_seconds = session.handshake_seconds
+            except Exception as e:
+                circuit_breakers.record_connect(breakers, e)
+                raise
+            circuit_breakers.record_connect(breakers, seconds=handshake_seconds)
+            span["reused"] = not handshake_seconds
+        try:
+            with tracer.span("send"):
+                yield session.server
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+            # The server answered, so the session is still usable; RSET on the next checkout confirms it
+            self._release(key, session)
+            raise
+        except Exception as e:
+            circuit_breakers.record_failure(breakers, e)
+            self._close(session.server)
+            if isinstance(e, StaleSessionError) and handshake_seconds:
+                # The connection was new, not stale: don't send again over another one
+                raise smtplib.SMTPServerDisconnected(*e.args) from e
+            raise
+        session.messages_sent += 1
+        self._count("messages_sent")
+        self._release(key, session)
+
+    def send_message(self, host, port, username, password, message, from_addr=None, to_addrs=None):
+        """Send a message over a pooled session, reconnecting once if a reused session turned out stale."""
+        message_from, message_to, data = serialize_message(message)
+        return self.sendmail(host, port, username, password, from_addr or message_from, to_addrs or message_to, data)
+
+    def sendmail(self, host, port, username, password, from_addr, to_addrs, data):
+        """Send already encoded message bytes over a pooled session, reconnecting once if a reused session turned out stale."""
+        data = LEADING_DOT.sub(b"..", data)
+        if not data.endswith(b"\r\n"):
+            data += b"\r\n"
+        return self.send_stream(host, port, username, password, from_addr, to_addrs, lambda: (data,))
+
+    def send_stream(self, host, port, username, password, from_addr, to_addrs, chunks):
+        """Send a message written from the iterable `chunks()` returns, reconnecting once if a reused session
+        turned out stale.
+
+        Only a drop before MAIL FROM was accepted is retried here. Once the transaction started the server may
+        have taken the message, so a later drop goes to the retry scheduler like any other failure.
+        """
+        try:
+            with self.session(host, port, username, password) as server:
+                return stream_mail(server, from_addr, to_addrs, chunks())
+        except StaleSessionError:
+            self._count("reconnects")
+            with self.session(host, port, username, password) as server:
+                return stream_mail(server, from_addr, to_addrs, chunks())
+
+    def evict_idle(self):
+        """Close every session that has been idle for longer than the limit."""
+        with self._lock:
+            expired = self._evict_idle_locked(time.monotonic())
+        for session in expired:
+            self._close(session.server)
+        return len(expired)
+
+    def close_all(self):
+        """Close every pooled session, e.g. on shutdown."""
+        with self._lock:
+            sessions = [session for group in self._idle.values() for session in group]
+            self._idle.clear()
+        for session in sessions:
+            self._close(session.server)
+
+    def get_stats(self):
+        """Return a snapshot of the pool counters, including reuse rate and handshake time saved."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["idle_sessions"] = sum(len(group) for group in self._idle.values())
+        checkouts = stats["sessions_opened"] + stats["sessions_reused"]
+        stats["reuse_rate"] = stats["sessions_reused"] / checkouts if checkouts else 0.0
+        average_handshake = stats["handshake_seconds_total"] / stats["sessions_opened"] if stats["sessions_opened"] else 0.0
+        stats["handshake_seconds_saved"] = average_handshake * stats["sessions_reused"]
+        return stats
+
+
+# Shared pool used by every sender in this process
+smtp_pool = SMTPConnectionPool()
@@ -0,0 +1,122 @@
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from delivery_queue import QUEUE_POLL_INTERVAL
+
+# Longest a long-poll status request may wait, and the SSE heartbeat interval (keeps proxies from closing idle streams)
+STATUS_WAIT_MAX = float(os.getenv("STATUS_WAIT_MAX", 60))
+STATUS_STREAM_HEARTBEAT = float(os.getenv("STATUS_STREAM_HEARTBEAT", 15))
+
+# Events buffered for one SSE client; a client that falls this far behind is disconnected and replays on reconnect
+STATUS_STREAM_BUFFER = int(os.getenv("STATUS_STREAM_BUFFER", 10000))
+
+FEED_BATCH = 1000
+
+
+class Subscription:
+    """Status events for one SSE client, optionally only those of one tag."""
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.events = queue.Queue(STATUS_STREAM_BUFFER)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+
+class StatusFeed:
+    """Follow the queue's status_events table and hand new events to long-poll waiters and SSE streams.
+
+    One thread per process reads the table, and only while someone is listening; it notices commits
+    from every process (and every thread) through SQLite's data_version.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._watchers = {}
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._listening = threading.Condition(self._lock)
+        self._last_id = None
+        self._thread = None
+
+    def _ensure_started_locked(self):
+        if self._last_id is None:
+            # Read before the caller looks up any status, so no change after that lookup can be missed
+            self._last_id = self.queue.last_event_id()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="status-feed", daemon=True)
+            self._thread.start()
+        self._listening.notify()
+
+    @contextmanager
+    def watch(self, request_id):
+        """Yield an Event that is set when the status of `request_id` next changes."""
+        changed = threading.Event()
+        with self._lock:
+            self._watchers.setdefault(request_id, set()).add(changed)
+            self._ensure_started_locked()
+        try:
+            yield changed
+        finally:
+            with self._lock:
+                waiters = self._watchers.get(request_id)
+                waiters.discard(changed)
+                if not waiters:
+                    del self._watchers[request_id]
+
+    def subscribe(self, tag=None):
+        """Start buffering events (of `tag`, or all) for a stream; call unsubscribe() when it ends."""
+        subscription = Subscription(tag)
+        with self._lock:
+            self._subscriptions.add(subscription)
+            self._ensure_started_locked()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def _run(self):
+        version = None
+        while True:
+            with self._lock:
+                while not self._watchers and not self._subscriptions:
+                    # Nobody is listening: start again from the newest event when someone does
+                    self._last_id = None
+                    version = None
+                    self._listening.wait()
+                last_id = self._last_id
+            try:
+                current = self.queue.data_version()
+                if current == version:
+                    time.sleep(QUEUE_POLL_INTERVAL)
+                    continue
+                version = current
+                while True:
+                    events = self.queue.status_events(last_id, limit=FEED_BATCH)
+                    if events:
+                        last_id = events[-1][0]["id"]
+                        self._dispatch([event for event, _ in events], last_id)
+                    if len(events) < FEED_BATCH:
+                        break
+            except Exception as e:
+                print(f"Failed to read status events: {e}")
+                time.sleep(1)
+
+    def _dispatch(self, events, last_id):
+        with self._lock:
+            self._last_id = last_id
+            for event in events:
+                for changed in self._watchers.get(event["request_id"], ()):
+                    changed.set()
+                for subscription in self._subscriptions:
+                    if subscription.tag is None or subscription.tag == event["tag"]:
+                        subscription.put(event)
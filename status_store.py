@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from enum import IntEnum
+
+# Status store settings
+STATUS_STORE_MAX_SIZE = int(os.getenv("STATUS_STORE_MAX_SIZE", 100000))
+STATUS_STORE_TTL = float(os.getenv("STATUS_STORE_TTL", 3600))
+
+
+class EmailState(IntEnum):
+    QUEUED = 0
+    SENDING = 1
+    SENT = 2
+    DEFERRED = 3
+    FAILED = 4
+
+
+# States after which a request will not change again
+FINAL_STATES = (EmailState.SENT, EmailState.FAILED)
+
+
+class StatusRecord:
+    """Compact status of one email request."""
+
+    __slots__ = ("state", "attempts", "created_at", "updated_at", "last_error")
+
+    def __init__(self, state, created_at):
+        self.state = state
+        self.attempts = 0
+        self.created_at = created_at
+        self.updated_at = created_at
+        self.last_error = None
+
+    @property
+    def status(self):
+        """The status string the API has always returned ("sent", "failed (reason)", ...)."""
+        if self.state == EmailState.FAILED:
+            return f"failed ({self.last_error})"
+        if self.state == EmailState.DEFERRED and self.last_error:
+            return f"deferred ({self.last_error})"
+        return self.state.name.lower()
+
+    def to_dict(self):
+        return {
+            "status": self.status,
+            "state": self.state.name.lower(),
+            "attempts": self.attempts,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "last_error": self.last_error,
+        }
+
+
+def parse_status(status):
+    """Split a status string from the delivery path into (state, error)."""
+    if status == "sent":
+        return EmailState.SENT, None
+    if status.startswith("failed (") and status.endswith(")"):
+        return EmailState.FAILED, status[len("failed ("):-1]
+    return EmailState.FAILED, status
+
+
+def _key(request_id):
+    # Request IDs are uuid4 strings; their 16 raw bytes take about half the memory
+    try:
+        return uuid.UUID(request_id).bytes
+    except (ValueError, AttributeError, TypeError):
+        return request_id
+
+
+class StatusStore:
+    """In-memory status of recent requests, bounded by both age (TTL) and size (LRU).
+
+    Records are kept in least-recently-updated order, so expired and excess entries are always at the
+    front and eviction is O(1) per record.
+    """
+
+    def __init__(self, max_size=STATUS_STORE_MAX_SIZE, ttl=STATUS_STORE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict_locked(self, now):
+        records = self._records
+        while records and len(records) > self.max_size:
+            records.popitem(last=False)
+        cutoff = now - self.ttl
+        while records:
+            record = next(iter(records.values()))
+            if record.updated_at >= cutoff:
+                break
+            records.popitem(last=False)
+
+    def set(self, request_id, state, error=None, attempts=None):
+        """Record a state transition for a request."""
+        now = time.time()
+        key = _key(request_id)
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                record = self._records[key] = StatusRecord(state, now)
+            else:
+                self._records.move_to_end(key)
+            record.state = state
+            record.updated_at = now
+            if attempts is not None:
+                record.attempts = attempts
+            if error is not None or state == EmailState.SENT:
+                record.last_error = error
+            self._evict_locked(now)
+
+    def get(self, request_id):
+        """Return the StatusRecord for a request, or None if it is unknown or has expired."""
+        key = _key(request_id)
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None and record.updated_at < time.time() - self.ttl:
+                del self._records[key]
+                return None
+            return record
+
+    def discard(self, request_id):
+        with self._lock:
+            self._records.pop(_key(request_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def __len__(self):
+        return len(self._records)
+
+
+# Shared status store for this process
+email_statuses = StatusStore()
@@ -0,0 +1,272 @@
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from delivery_scheduler import lease_owner_prefix
+from delivery_stats import publish_stats, retire_published_stats
+from lifecycle import DRAIN_TIMEOUT, delivery_lifecycle
+from metrics import METRICS_DIR, publish_metrics, retire_published_metrics, write_metrics
+from tracing import publish_traces
+
+# "single" runs HTTP intake and delivery in one process; "multiprocess" runs a supervisor that starts
+# INTAKE_PROCESSES HTTP processes sharing one listening socket and DELIVERY_PROCESSES delivery processes,
+# all connected through the SQLite delivery queue (POSIX only)
+SERVER_MODE = os.getenv("SERVER_MODE", "single")
+INTAKE_PROCESSES = int(os.getenv("INTAKE_PROCESSES", 2))
+DELIVERY_PROCESSES = int(os.getenv("DELIVERY_PROCESSES", 2))
+
+# Set by the supervisor in the environment of each process it starts: "intake" or "delivery"
+SERVER_ROLE = os.getenv("SERVER_ROLE", "")
+
+# Crashed processes are restarted after RESTART_DELAY seconds, doubling up to RESTART_MAX_DELAY while
+# they keep crashing within RESTART_STABLE_SECONDS of being started
+RESTART_DELAY = float(os.getenv("SUPERVISOR_RESTART_DELAY", 1))
+RESTART_MAX_DELAY = float(os.getenv("SUPERVISOR_RESTART_MAX_DELAY", 30))
+RESTART_STABLE_SECONDS = 30
+
+LISTEN_BACKLOG = 1024
+
+# An intake process told to stop accepts no more connections and gives the requests it is handling this
+# long to finish; event streams and long polls still open then are cut, and their clients reconnect
+INTAKE_STOP_SECONDS = 5
+
+
+class ChildProcess:
+    """One intake or delivery process and its restart bookkeeping."""
+
+    __slots__ = ("role", "number", "process", "started_at", "restart_delay", "restart_at")
+
+    def __init__(self, role, number):
+        self.role = role
+        self.number = number
+        self.process = None
+        self.started_at = 0.0
+        self.restart_delay = 0.0
+        self.restart_at = None
+
+    @property
+    def name(self):
+        return f"{self.role}-{self.number}"
+
+
+class Supervisor:
+    """Start the intake and delivery processes, restart any that die, and stop them all on SIGTERM/SIGINT.
+
+    When a delivery process dies its leased and deferred jobs are requeued straight away, so other
+    delivery processes pick them up without waiting for the leases to expire. SIGHUP replaces every
+    process with one that reads .env again, without dropping requests or mail (see restart_children()).
+    """
+
+    def __init__(self, script, host, port, queue, intake=INTAKE_PROCESSES, delivery=DELIVERY_PROCESSES):
+        self.script = script
+        self.host = host
+        self.port = port
+        self.queue = queue
+        self.children = [ChildProcess("intake", n) for n in range(intake)]
+        self.children += [ChildProcess("delivery", n) for n in range(delivery)]
+        self.intake_count = intake
+        self.delivery_count = delivery
+        self.listener = None
+        self.metrics_dir = None
+        self._stopping = threading.Event()
+        self._restarting = threading.Event()
+
+    def _environment(self, child):
+        env = dict(
+            os.environ,
+            SERVER_ROLE=child.role,
+            SUPERVISOR_PID=str(os.getpid()),
+            METRICS_DIR=self.metrics_dir,
+            DELIVERY_PROCESS_COUNT=str(self.delivery_count),
+            # Status lookups read the shared queue; a per-process status store would only go stale
+            STATUS_STORE_MAX_SIZE="0",
+            # A delivery process hands its quotas and circuit breakers over to its replacement
+            WARM_STATE_FILE=os.path.join(self.metrics_dir, f"{child.name}.warm.json"),
+        )
+        if child.role == "intake":
+            env["SERVER_LISTEN_FD"] = str(self.listener.fileno())
+        elif child.number > 0:
+            # Webhooks follow one cursor in the queue; a single dispatcher is enough
+            env["WEBHOOK_DISPATCH"] = "false"
+        return env
+
+    def _start(self, child):
+        pass_fds = (self.listener.fileno(),) if child.role == "intake" else ()
+        child.process = subprocess.Popen([sys.executable, self.script], env=self._environment(child), pass_fds=pass_fds)
+        child.started_at = time.monotonic()
+        child.restart_at = None
+
+    def _exited(self, child, code):
+        """Clean up after a process that died and schedule its restart."""
+        pid = child.process.pid
+        if child.role == "delivery":
+            recovered = self.queue.recover(lease_owner_prefix(pid))
+            if recovered:
+                print(f"Requeued {recovered} emails held by {child.name} (pid {pid})")
+        retire_published_metrics(self.metrics_dir, pid)
+        retire_published_stats(self.metrics_dir, pid)
+        if time.monotonic() - child.started_at >= RESTART_STABLE_SECONDS:
+            child.restart_delay = RESTART_DELAY
+        else:
+            child.restart_delay = min(RESTART_MAX_DELAY, max(RESTART_DELAY, child.restart_delay * 2))
+        child.restart_at = time.monotonic() + child.restart_delay
+        child.process = None
+        print(f"{child.name} (pid {pid}) exited with code {code}; restarting in {child.restart_delay:g}s")
+
+    def _stop(self, *_):
+        self._stopping.set()
+
+    def _restart(self, *_):
+        self._restarting.set()
+
+    @staticmethod
+    def _terminate(processes, timeout=DRAIN_TIMEOUT + 5):
+        """Ask processes to stop, which delivery processes do once drained, and kill those that don't in time."""
+        for process in processes:
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in processes:
+            try:
+                process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def restart_children(self):
+        """Replace every process with a fresh one, one at a time, after reading .env again.
+
+        A new intake process starts accepting on the shared socket before the old one stops. A delivery
+        process is drained, then replaced, while the others keep delivering.
+        """
+        self._restarting.clear()
+        load_dotenv(override=True)
+        print("Restarting every process with the settings in .env...")
+        for child in self.children:
+            old = child.process
+            if self._stopping.is_set():
+                return
+            if old is None:
+                # Already waiting to be restarted, which it will be with the new settings
+                continue
+            if child.role == "intake":
+                self._start(child)
+                self._terminate([old])
+            else:
+                self._terminate([old])
+                recovered = self.queue.recover(lease_owner_prefix(old.pid))
+                if recovered:
+                    print(f"Requeued {recovered} emails {child.name} (pid {old.pid}) was still sending")
+                self._start(child)
+            retire_published_metrics(self.metrics_dir, old.pid)
+            retire_published_stats(self.metrics_dir, old.pid)
+        print("Every process restarted")
+
+    def run(self):
+        if not hasattr(os, "fork"):
+            sys.exit("SERVER_MODE=multiprocess needs a POSIX system; use the default single-process mode.")
+
+        self.listener = socket.create_server((self.host, self.port), backlog=LISTEN_BACKLOG)
+        self.listener.set_inheritable(True)
+        self.metrics_dir = METRICS_DIR or tempfile.mkdtemp(prefix="email-metrics-")
+        os.makedirs(self.metrics_dir, exist_ok=True)
+
+        # Jobs left by a previous run; from here on only a dead process's own jobs are recovered
+        self.queue.recover()
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._restart)
+        for child in self.children:
+            self._start(child)
+        print(f"Serving on {self.host}:{self.port} with {self.intake_count} intake and {self.delivery_count} delivery processes")
+
+        try:
+            while not self._stopping.wait(0.5):
+                if self._restarting.is_set():
+                    self.restart_children()
+                now = time.monotonic()
+                for child in self.children:
+                    if child.process is not None:
+                        code = child.process.poll()
+                        if code is not None:
+                            self._exited(child, code)
+                    elif child.restart_at is not None and now >= child.restart_at:
+                        self._start(child)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self._terminate([child.process for child in self.children if child.process is not None])
+        self.listener.close()
+        if not METRICS_DIR:
+            shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+
+def run_supervisor(script, host, port, queue):
+    """Run `script` as intake and delivery processes until SIGTERM or Ctrl-C."""
+    Supervisor(script, host, port, queue).run()
+
+
+def _init_child():
+    """Exit cleanly on SIGTERM (so atexit handlers flush the log) and when the supervisor goes away."""
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # Ctrl-C and a closed terminal reach the whole process group; the supervisor decides how its children stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    supervisor_pid = int(os.getenv("SUPERVISOR_PID", 0))
+
+    def watch_supervisor():
+        while os.getppid() == supervisor_pid:
+            time.sleep(1)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=watch_supervisor, name="supervisor-watch", daemon=True).start()
+
+
+def serve_intake(app, host, port):
+    """Serve the Flask app on the listening socket inherited from the supervisor.
+
+    Intake counters (rejected emails, ...) are published like a delivery process's, so every process's
+    /metrics adds up the same totals, and folded into retired.json when the process exits.
+    """
+    from werkzeug.serving import make_server
+
+    _init_child()
+    publish_metrics()
+    server = make_server(host, port, app, threaded=True, fd=int(os.environ["SERVER_LISTEN_FD"]))
+
+    def stop():
+        # serve_forever() returns once the requests being handled are done
+        server.shutdown()
+        time.sleep(INTAKE_STOP_SECONDS)
+        # The last counts, for the supervisor to fold into retired.json
+        try:
+            write_metrics()
+        except OSError as e:
+            print(f"Failed to publish metrics: {e}")
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=stop, name="intake-stop", daemon=True).start())
+    server.serve_forever()
+
+
+def run_delivery(start):
+    """Start delivering with `start()` and keep this process alive until it is told to stop, then drain."""
+    _init_child()
+    delivery_lifecycle.handle_signals(restart=False)
+    publish_metrics()
+    publish_traces()
+    publish_stats()
+    start()
+    while True:
+        time.sleep(3600)
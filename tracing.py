@@ -0,0 +1,213 @@
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from delivery_scheduler import Envelope
+from metrics import METRICS_DIR
+
+# Share of accepted emails that are traced (0 to 1); it can be changed at run time from the admin route
+# or terminal. The last TRACE_BUFFER_SIZE finished traces are kept in memory
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", 1000))
+
+# A traced email carries the time it was accepted in its queued payload under this key, so whichever
+# process delivers it carries on with the trace
+TRACE_PAYLOAD_KEY = "trace"
+
+# In multi-process mode each delivery process publishes its finished traces to METRICS_DIR this often
+TRACE_PUBLISH_INTERVAL = 1.0
+TRACE_FILE_SUFFIX = ".traces"
+
+
+class Trace:
+    """The timed spans of one email, from accept to its final status: accept, enqueue, then per
+    delivery attempt dequeue, build, connect, send and log."""
+
+    __slots__ = ("request_id", "started", "spans", "last_end", "status")
+
+    def __init__(self, request_id, started):
+        self.request_id = request_id
+        self.started = started
+        self.spans = []
+        self.last_end = started
+        self.status = None
+
+    def add(self, name, start, end, attributes=None):
+        span = {"name": name, "start": round(start - self.started, 6), "duration": round(end - start, 6)}
+        if attributes:
+            span.update(attributes)
+        self.spans.append(span)
+        self.last_end = max(self.last_end, end)
+
+    def to_dict(self):
+        return {"request_id": self.request_id, "status": self.status, "started": self.started,
+                "duration": round(self.last_end - self.started, 6),
+                # A worker may lease the email before the request that queued it has returned
+                "spans": sorted(self.spans, key=lambda span: span["start"])}
+
+
+class Tracer:
+    """Sampled per-email traces: open ones by request ID, finished ones in a ring buffer.
+
+    Spans are recorded against a trace given explicitly, looked up by request ID, or against the traces of
+    the job the current thread or asyncio task is delivering (see activate()).
+    """
+
+    def __init__(self, rate=TRACE_SAMPLE_RATE, size=TRACE_BUFFER_SIZE):
+        self.rate = rate
+        self.size = size
+        self.finished_total = 0
+        self._open = OrderedDict()
+        self._finished = deque(maxlen=size)
+        self._current = contextvars.ContextVar("traces", default=())
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        self.rate = min(1.0, max(0.0, rate))
+
+    def start(self, request_id, payload, accepted):
+        """Decide whether to trace a newly accepted email; if so, mark its payload and return its Trace.
+
+        `accepted` is the time.time() the request arrived; the accept span runs from it to now.
+        """
+        if not self.rate or random.random() >= self.rate:
+            return None
+        payload[TRACE_PAYLOAD_KEY] = accepted
+        trace = Trace(request_id, accepted)
+        trace.add("accept", accepted, time.time())
+        with self._lock:
+            self._add_open_locked(trace)
+        return trace
+
+    def _add_open_locked(self, trace):
+        self._open[trace.request_id] = trace
+        # Traces continued by another process, or whose email was never queued, are never finished here
+        while len(self._open) > self.size:
+            self._open.popitem(last=False)
+
+    def resume(self, job):
+        """Carry on the traces of a leased job or Envelope's traced emails, starting a dequeue span for each
+        that ends now; returns those traces (usually none)."""
+        traces = []
+        for member in job.jobs if isinstance(job, Envelope) else (job,):
+            accepted = member.payload.get(TRACE_PAYLOAD_KEY)
+            if accepted is None:
+                continue
+            with self._lock:
+                trace = self._open.get(member.request_id)
+                if trace is None:
+                    trace = Trace(member.request_id, accepted)
+                    self._add_open_locked(trace)
+            trace.add("dequeue", trace.last_end, time.time(), {"attempt": member.attempts})
+            member.trace = trace
+            traces.append(trace)
+        return traces
+
+    def activate(self, traces):
+        """Record spans without an explicit trace against `traces` in this thread or task; returns a token
+        for deactivate()."""
+        return self._current.set(tuple(traces)) if traces else None
+
+    def deactivate(self, token):
+        if token is not None:
+            self._current.reset(token)
+
+    @contextmanager
+    def span(self, name, traces=None, request_id=None):
+        """Time the block as a span of `traces`, of the open trace of `request_id`, or of the active traces.
+
+        Yields a dict the block may add attributes of the span to; an exception is recorded as "error".
+        """
+        if request_id is not None:
+            trace = self._open.get(request_id)
+            traces = (trace,) if trace is not None else ()
+        elif traces is None:
+            traces = self._current.get()
+        else:
+            traces = [trace for trace in traces if trace is not None]
+        if not traces:
+            yield {}
+            return
+        attributes = {}
+        start = time.time()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes["error"] = str(e) or type(e).__name__
+            raise
+        finally:
+            end = time.time()
+            for trace in traces:
+                trace.add(name, start, end, attributes)
+
+    def finish(self, job, status):
+        """Record a delivery attempt's outcome; the trace is finished unless the email was deferred."""
+        trace = getattr(job, "trace", None)
+        if trace is None:
+            return
+        trace.status = status
+        if status.startswith("deferred"):
+            return
+        with self._lock:
+            self._open.pop(trace.request_id, None)
+            self._finished.append(trace)
+            self.finished_total += 1
+
+    def recent(self, limit=None):
+        """Finished traces as dicts, newest first."""
+        with self._lock:
+            traces = list(self._finished)
+        traces.reverse()
+        return [trace.to_dict() for trace in traces[:limit]]
+
+    def get_stats(self):
+        with self._lock:
+            return {"sample_rate": self.rate, "open": len(self._open), "finished": len(self._finished),
+                    "buffer_size": self.size}
+
+
+def publish_traces(directory=METRICS_DIR, interval=TRACE_PUBLISH_INTERVAL):
+    """Write this process's finished traces to `directory` whenever there are new ones, from a background thread."""
+
+    def publish():
+        path = os.path.join(directory, f"{os.getpid()}{TRACE_FILE_SUFFIX}")
+        published = 0
+        while True:
+            finished = tracer.finished_total
+            if finished != published:
+                try:
+                    with open(path + ".tmp", "w") as file:
+                        json.dump(tracer.recent(), file)
+                    os.replace(path + ".tmp", path)
+                    published = finished
+                except OSError as e:
+                    # Tried again next time round: a full disk or a removed directory may come right again
+                    print(f"Failed to publish traces: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=publish, name="trace-publisher", daemon=True).start()
+
+
+def recent_traces(limit=None, directory=METRICS_DIR):
+    """Finished traces of this process and those other processes published to `directory`, newest first."""
+    traces = tracer.recent()
+    if directory:
+        own = f"{os.getpid()}{TRACE_FILE_SUFFIX}"
+        for name in os.listdir(directory):
+            if name.endswith(TRACE_FILE_SUFFIX) and name != own:
+                try:
+                    with open(os.path.join(directory, name)) as file:
+                        traces.extend(json.load(file))
+                except (OSError, ValueError):
+                    continue
+        traces.sort(key=lambda trace: trace["started"], reverse=True)
+    return traces[:limit]
+
+
+# Shared tracer used by the intake endpoints, both delivery engines, the SMTP pool and the admin terminal
+tracer = Tracer()
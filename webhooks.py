@@ -0,0 +1,222 @@
+import os
+import hashlib
+import hmac
+import http.client
+import ipaddress
+import json
+import socket
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+# Status webhooks: emails sent with a "webhook_url" have their status changes POSTed there as
+# {"events": [...]}. Changes are collected for WEBHOOK_BATCH_INTERVAL seconds, and only the latest
+# change of each email is sent, up to WEBHOOK_MAX_BATCH per request
+WEBHOOK_DISPATCH = os.getenv("WEBHOOK_DISPATCH", "true").lower() == "true"
+WEBHOOK_BATCH_INTERVAL = float(os.getenv("WEBHOOK_BATCH_INTERVAL", 1))
+WEBHOOK_MAX_BATCH = int(os.getenv("WEBHOOK_MAX_BATCH", 500))
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT", 10))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", 8))
+
+# A failing endpoint is retried after 1s, 2s, 4s, ... up to WEBHOOK_MAX_DELAY; after WEBHOOK_MAX_ATTEMPTS
+# its pending events are dropped
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 8))
+WEBHOOK_MAX_DELAY = float(os.getenv("WEBHOOK_MAX_DELAY", 300))
+
+# When set, every request carries X-Webhook-Signature: sha256=<HMAC of the body with this secret>
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Webhook URLs come from whoever sends an email, so they may only point at public addresses, never at
+# this server's own network (loopback, private, link-local or cloud metadata addresses).
+# WEBHOOK_ALLOWED_HOSTS, a comma-separated list of host names, limits them further; receivers on a private
+# network need WEBHOOK_ALLOW_PRIVATE=true
+WEBHOOK_ALLOWED_HOSTS = {host.strip().lower() for host in os.getenv("WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip()}
+WEBHOOK_ALLOW_PRIVATE = os.getenv("WEBHOOK_ALLOW_PRIVATE", "false").lower() == "true"
+
+CURSOR_NAME = "webhooks"
+
+
+class WebhookError(Exception):
+    """A webhook URL that may not be called, or an endpoint that didn't acknowledge a batch."""
+
+
+def is_public_address(address):
+    ip = ipaddress.ip_address(address)
+    return ip.is_global and not ip.is_multicast
+
+
+def get_webhook_url_error(url):
+    """Return the reason a webhook URL may not be called, or None; checks the host, not what it resolves to."""
+    try:
+        host = urllib.parse.urlsplit(url).hostname
+    except ValueError:
+        host = None
+    if not host:
+        return "Invalid webhook URL"
+    if WEBHOOK_ALLOWED_HOSTS and host not in WEBHOOK_ALLOWED_HOSTS:
+        return "Webhook host is not allowed"
+    try:
+        public = is_public_address(host)
+    except ValueError:
+        # A host name; its addresses are checked when it is called
+        return None
+    if not public and not WEBHOOK_ALLOW_PRIVATE:
+        return "Webhook URL must not point to a private address"
+    return None
+
+
+def resolve_webhook_address(host, port):
+    """The address to call a webhook host at; raises WebhookError if any of its addresses isn't public."""
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+    except socket.gaierror as e:
+        raise WebhookError(f"Cannot resolve {host}: {e}")
+    if not WEBHOOK_ALLOW_PRIVATE and not all(is_public_address(address.split("%")[0]) for address in addresses):
+        raise WebhookError(f"{host} resolves to a private address")
+    return addresses[0]
+
+
+def post_webhook(url, body, headers, timeout=WEBHOOK_TIMEOUT):
+    """POST `body` to a webhook URL that passes get_webhook_url_error; raises unless it answers 2xx.
+
+    Redirects are not followed, so a public URL can't bounce the request to a private one.
+    """
+    error = get_webhook_url_error(url)
+    if error:
+        raise WebhookError(error)
+    parts = urllib.parse.urlsplit(url)
+    https = parts.scheme == "https"
+    port = parts.port or (443 if https else 80)
+    address = resolve_webhook_address(parts.hostname, port)
+    connection = (http.client.HTTPSConnection if https else http.client.HTTPConnection)(parts.hostname, port, timeout=timeout)
+    # Connect to the address that was checked, not to whatever the name resolves to next (DNS rebinding)
+    connection._create_connection = lambda _, *args: socket.create_connection((address, port), *args)
+    try:
+        connection.request("POST", urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, "")), body, headers)
+        response = connection.getresponse()
+        response.read()
+    finally:
+        connection.close()
+    if not 200 <= response.status < 300:
+        raise WebhookError(f"HTTP {response.status} {response.reason}")
+
+
+class Endpoint:
+    """Events waiting for one webhook URL, coalesced by request ID, and its retry state."""
+
+    __slots__ = ("url", "events", "first_id", "failures", "retry_at", "busy")
+
+    def __init__(self, url):
+        self.url = url
+        self.events = {}
+        self.first_id = None
+        self.failures = 0
+        self.retry_at = 0.0
+        self.busy = False
+
+    def add(self, event):
+        if self.first_id is None:
+            self.first_id = event["id"]
+        # Insertion order follows the first change; the payload is the latest one
+        self.events[event["request_id"]] = event
+
+
+class WebhookDispatcher:
+    """Deliver status events to webhook URLs from the queue's status_events table.
+
+    Its position in the table is saved in the queue, at the oldest event not yet delivered, so after a
+    restart undelivered events are sent again (webhooks are at-least-once; receivers dedupe by event id).
+    Run it in one process only.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._endpoints = {}
+        self._executor = ThreadPoolExecutor(WEBHOOK_CONCURRENCY, thread_name_prefix="webhook")
+        self._lock = threading.Lock()
+        self._last_id = None
+        self._saved_id = None
+
+    def start(self):
+        threading.Thread(target=self._run, name="webhook-dispatcher", daemon=True).start()
+
+    def _run(self):
+        self._saved_id = self.queue.get_cursor(CURSOR_NAME)
+        self._last_id = self.queue.last_event_id() if self._saved_id is None else self._saved_id
+        while True:
+            time.sleep(WEBHOOK_BATCH_INTERVAL)
+            try:
+                self._collect()
+                self._flush()
+                self._save_cursor()
+            except Exception as e:
+                print(f"Failed to dispatch webhooks: {e}")
+
+    def _collect(self):
+        while True:
+            events = self.queue.status_events(self._last_id, limit=WEBHOOK_MAX_BATCH, webhooks_only=True)
+            with self._lock:
+                for event, url in events:
+                    endpoint = self._endpoints.get(url)
+                    if endpoint is None:
+                        endpoint = self._endpoints[url] = Endpoint(url)
+                    endpoint.add(event)
+            if events:
+                self._last_id = events[-1][0]["id"]
+            if len(events) < WEBHOOK_MAX_BATCH:
+                return
+
+    def _flush(self):
+        now = time.monotonic()
+        with self._lock:
+            for endpoint in self._endpoints.values():
+                if endpoint.events and not endpoint.busy and now >= endpoint.retry_at:
+                    endpoint.busy = True
+                    batch = list(endpoint.events.values())[:WEBHOOK_MAX_BATCH]
+                    self._executor.submit(self._post, endpoint, batch)
+
+    def _save_cursor(self):
+        with self._lock:
+            # Endpoints with nothing left are forgotten; the rest hold the cursor back
+            for url in [url for url, endpoint in self._endpoints.items() if not endpoint.events and not endpoint.busy]:
+                del self._endpoints[url]
+            pending = [endpoint.first_id for endpoint in self._endpoints.values() if endpoint.first_id is not None]
+        cursor = min(pending) - 1 if pending else self._last_id
+        if cursor != self._saved_id:
+            self.queue.set_cursor(CURSOR_NAME, cursor)
+            self._saved_id = cursor
+
+    def _post(self, endpoint, batch):
+        body = json.dumps({"events": batch}).encode()
+        headers = {"Content-Type": "application/json", "User-Agent": "email-service-webhooks"}
+        if WEBHOOK_SECRET:
+            signature = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+            headers["X-Webhook-Signature"] = f"sha256={signature}"
+        try:
+            post_webhook(endpoint.url, body, headers)
+            error = None
+        except Exception as e:
+            error = e
+
+        with self._lock:
+            endpoint.busy = False
+            if error is None or endpoint.failures + 1 >= WEBHOOK_MAX_ATTEMPTS:
+                if error is not None:
+                    print(f"Dropping {len(batch)} status events for {endpoint.url} after {WEBHOOK_MAX_ATTEMPTS} attempts: {error}")
+                endpoint.failures = 0
+                endpoint.retry_at = 0.0
+                # Changes that arrived while the batch was in flight stay queued
+                for event in batch:
+                    if endpoint.events.get(event["request_id"]) is event:
+                        del endpoint.events[event["request_id"]]
+                endpoint.first_id = min((event["id"] for event in endpoint.events.values()), default=None)
+            else:
+                endpoint.failures += 1
+                endpoint.retry_at = time.monotonic() + min(WEBHOOK_MAX_DELAY, 2 ** (endpoint.failures - 1))
+
+
+def start_webhook_dispatcher(queue):
+    """Start delivering status webhooks, if this process is the one that should."""
+    if WEBHOOK_DISPATCH:
+        WebhookDispatcher(queue).start()